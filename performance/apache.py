@@ -1,8 +1,12 @@
 import argparse
+import cProfile
 import datetime
-import shlex
+import locale
+import sys
+from core import logformat
+from core import paths
 from core import performance
-from warnings import warn
+from core import profiling
 
 def component_from_filename(filename):
     return 'example'
@@ -10,37 +14,231 @@ def component_from_filename(filename):
 def request_filter(request):
     return True
 
-class ApacheRequest():
-    def __init__(self, line):
-        self._fields = shlex.split(line)
+def time_buckets(value):
+    return [performance.TimeBucket(b) for b in value.split(',')]
+
+def output_formats(value):
+    return [performance.OutputFormat(f) for f in value.split(',')]
+
+def utc_datetime(value):
+    # ISO 8601, times without an offset are UTC
+    d = datetime.datetime.fromisoformat(value)
+    if d.tzinfo is None:
+        return d.replace(tzinfo=datetime.timezone.utc)
+    return d.astimezone(datetime.timezone.utc)
+
+def methods(value):
+    return value.split(',')
+
+def statuses(value):
+    codes = value.upper().split(',')
+    for code in codes:
+        if len(code) != 3 or not code[0].isdigit() or not (code[1:].isdigit() or code[1:] == 'XX'):
+            raise ValueError(f'status must be a code or a class, e.g. 404 or 5XX - status->"{code}"')
+    return codes
+
+# combined log format followed by the connection status and the time taken to serve the request
+LOG_FORMAT = logformat.COMBINED + ' %X %{ms}T'
+
+_LOG_FORMAT = logformat.LogFormat(LOG_FORMAT)
+
+def _duration(value):
+    try:
+        return int(value)
+    except ValueError:
+        if isinstance(value, bytes):
+            value = value.decode('ascii', 'replace')
+        raise ValueError(f'duration in unexpected format - duration->"{value}"') from None
+
+class ApacheRequest(performance.RequestRecord):
+    __slots__ = ()
+
+    def __init__(self, line, log_format=_LOG_FORMAT):
+        fields = log_format.split(line)
 
         # direct fields
-        self.url = self._fields[5].split(" ")[1]
-        self.http_method = self._fields[5].split(" ")[0]
-        self.http_response_code = self._fields[6]
-        self.duration = self._fields[11]
-
-        # processed from direct fields
-        self.path = self.url.split('?')[0]
-        self.query_params = {}
-        if '?' in self.url:
-            self.query = self.url.split('?')[1]
-            for pair in self.query.split('&'):
-                l = pair.split('=')
-                if len(l) != 2:
-                    warn(f'skipped query parameter in unexpected format, length !=2 after split on "=" - param->"{pair}"')
+        request = logformat.unescape(fields[log_format.request_index]).split(' ')
+        if len(request) < 2:
+            raise ValueError(f'request in unexpected format - request->"{fields[log_format.request_index]}"')
+        self.url = request[1]
+        self.http_method = request[0]
+        self.http_response_code = fields[log_format.status_index]
+        self.duration = None
+        if log_format.duration_index is not None and fields[log_format.duration_index] != '-':
+            self.duration = _duration(fields[log_format.duration_index]) * log_format.duration_scale
+        self.request_time = log_format.decode_time(fields[log_format.time_index])
+
+class ApacheRequestParser():
+    # request parser for a log format, with the raw line checks the engine uses to apply
+    # RequestFilters before a line is parsed
+    def __init__(self, log_format=_LOG_FORMAT):
+        self.log_format = log_format
+        self.encoding = locale.getpreferredencoding(False)
+        # the request line is quoted and the status is a space separated token in the usual formats,
+        # the raw method, path and status checks are only used when that holds
+        self._quoted_request = '"%r"' in log_format.log_format
+        self._spaced_status = ' %>s ' in log_format.log_format or ' %s ' in log_format.log_format
+
+    def __call__(self, line):
+        return ApacheRequest(line, self.log_format)
+
+    def scan_buffer(self, buffer, start, end, filters=None, on_error=None):
+        # requests for the lines in buffer[start:end] of a memory mapped log, without decoding the lines
+        # lines that can not be parsed are passed to on_error(error, line) and skipped, or raise if it is None
+        # only the request, status, time and duration fields are decoded, and methods and statuses
+        # repeat so each distinct one is only decoded once
+        # lines are copied out of the map by readline, which in CPython is cheaper than matching the
+        # map in place, and only decoded whole when there are filters to check against them
+        log_format = self.log_format
+        match = log_format.report_pattern.match
+        groups = log_format.report_groups
+        decode_time = log_format.decode_time
+        duration_scale = log_format.duration_scale
+        encoding = self.encoding
+        line_filter = self.line_filter(filters) if filters is not None else None
+        new = ApacheRequest.__new__
+        methods = {}
+        statuses = {}
+        last_timestamp = None
+        buffer.seek(start)
+        readline = buffer.readline
+        position = start
+        while position < end:
+            line = readline()
+            if not line:
+                break
+            position += len(line)
+            try:
+                if line_filter is not None and not line_filter(line.decode(encoding, 'replace')):
                     continue
-                self.query_params[l[0]] = l[1]
-
-        self.request_time = datetime.datetime.strptime(f'{self._fields[3]} {self._fields[4]}', '[%d/%b/%Y:%H:%M:%S %z]').astimezone(datetime.timezone.utc)
-        
-parser = argparse.ArgumentParser(
-    description = 'Calculate statistics from access logs and output simple HTML report with the results'
-)
-parser.add_argument('--time-bucket', '-t', help='Which time period to bucket the results', choices=list(performance.TimeBucket), type=performance.TimeBucket)
-parser.add_argument('--include-query', '-q', help='Include query string when sorting URLs', action='store_true')
-parser.add_argument('log', nargs='+', help='The log files to calculate statistics from')
-parser.set_defaults(include_query=False,time_bucket=performance.TimeBucket.NONE)
-args = parser.parse_args()     
-
-performance.performance_report(args.log, ApacheRequest, component_from_filename, request_filter, args.time_bucket, args.include_query)
+                fields = match(line)
+                if fields is None:
+                    raise ValueError(f'line does not match log format "{log_format.log_format}" - line->"{line.decode(encoding, "replace").rstrip()}"')
+                request_line, status, timestamp, duration = fields.group(*groups)
+                if b'\\' in request_line:
+                    request = logformat.unescape(request_line.decode(encoding, 'replace')).encode(encoding).split(b' ')
+                else:
+                    request = request_line.split(b' ')
+                if len(request) < 2:
+                    raise ValueError(f'request in unexpected format - request->"{request_line.decode(encoding, "replace")}"')
+                req = new(ApacheRequest)
+                method = methods.get(request[0])
+                if method is None:
+                    method = methods[request[0]] = request[0].decode(encoding, 'replace')
+                req.http_method = method
+                req.url = request[1].decode(encoding, 'replace')
+                code = statuses.get(status)
+                if code is None:
+                    code = statuses[status] = status.decode(encoding, 'replace')
+                req.http_response_code = code
+                req.duration = None
+                if duration and duration != b'-':
+                    req.duration = _duration(duration) * duration_scale
+                if timestamp != last_timestamp:
+                    request_time = decode_time(timestamp)
+                    last_timestamp = timestamp
+                req.request_time = request_time
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(e, line.decode(encoding, 'replace'))
+                continue
+            yield req
+
+    def line_time(self, line):
+        # request time from the first bracketed field without parsing the line, None if it isn't a timestamp
+        i = line.find('[')
+        if i < 0 or line[i + 27:i + 28] != ']':
+            return None
+        try:
+            return self.log_format.decode_time(line[i + 1:i + 27])
+        except ValueError:
+            return None
+
+    def line_filter(self, filters):
+        # rejects lines that can not match the filters, lines that pass are checked again once
+        # parsed, so the raw checks only need to be necessary conditions
+        checks = []
+        if filters.since is not None or filters.until is not None:
+            def in_window(line):
+                t = self.line_time(line)
+                return t is None or filters.in_window(t)
+            checks.append(in_window)
+        if filters.methods is not None and self._quoted_request:
+            method_needles = tuple(f'"{method} ' for method in filters.methods)
+            checks.append(lambda line: any(needle in line for needle in method_needles))
+        if filters.path_prefix is not None and self._quoted_request and '"' not in filters.path_prefix and '\\' not in filters.path_prefix:
+            path_needle = ' ' + filters.path_prefix
+            checks.append(lambda line: path_needle in line)
+        if filters.statuses is not None and self._spaced_status and all(status.isdigit() for status in filters.statuses):
+            status_needles = tuple(f' {status} ' for status in filters.statuses)
+            checks.append(lambda line: any(needle in line for needle in status_needles))
+        if len(checks) == 0:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda line: all(check(line) for check in checks)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Calculate statistics from access logs and output simple HTML report with the results'
+    )
+    parser.add_argument('--time-bucket', '-t', help=f'Comma separated time periods to bucket the results by - {",".join(b.value for b in performance.TimeBucket)}, the logs are read once and coarser periods are rolled up from the finest one', type=time_buckets)
+    parser.add_argument('--include-query', '-q', help='Include query string when sorting URLs', action='store_true')
+    parser.add_argument('--quantiles', '-p', help='How percentiles are calculated - exact keeps every duration in memory, ddsketch keeps a fixed size sketch per bucket with percentiles within 1%% of the exact value', choices=list(performance.QuantileEstimator), type=performance.QuantileEstimator)
+    parser.add_argument('--log-format', '-f', help=f'Apache LogFormat string the logs were written with, must include %%t, %%r, %%>s and a duration (%%D, %%T or %%{{UNIT}}T) - default \'{LOG_FORMAT.replace("%", "%%")}\'')
+    parser.add_argument('--workers', '-w', help='Number of processes used to parse the logs, large logs are split between them', type=int)
+    parser.add_argument('--state', '-s', help='State file for incremental runs - only lines appended since the last run with the same state file are parsed, and the report is generated from the state', dest='state_file')
+    parser.add_argument('--follow', '-F', help='Follow the logs like tail -F and keep rewriting the report with new requests until interrupted', action='store_true')
+    parser.add_argument('--refresh', '-r', help='Seconds between report rewrites when following logs', type=float, dest='refresh_interval')
+    parser.add_argument('--format', '-o', help=f'Comma separated output formats written under out/ - {",".join(f.value for f in performance.OutputFormat)}, parquet requires pyarrow, snapshot is a compact binary aggregate for comparing runs with compare.py', type=output_formats, dest='formats')
+    parser.add_argument('--templates', '-T', help='Collapse numeric, UUID and hex path segments into {id}, {uuid} and {hex} templates', action='store_true')
+    parser.add_argument('--path-rule', '-R', help='REGEX=REPLACEMENT rule applied to paths with re.sub before they are aggregated, can be given more than once, e.g. "^/orders/[^/]+=/orders/{order}"', action='append', type=paths.parse_rule, dest='path_rules')
+    parser.add_argument('--max-paths', '-m', help='Maximum distinct paths per component, requests for paths beyond this are counted under "other"', type=int)
+    parser.add_argument('--since', help='Only requests at or after this ISO 8601 time, UTC unless it has an offset - time sorted logs are seeked to it rather than read from the start', type=utc_datetime)
+    parser.add_argument('--until', help='Only requests before this ISO 8601 time, UTC unless it has an offset', type=utc_datetime)
+    parser.add_argument('--path-prefix', help='Only requests with a path starting with this')
+    parser.add_argument('--method', help='Only requests with one of these comma separated methods, e.g. GET,POST', type=methods, dest='methods')
+    parser.add_argument('--status', help='Only requests with one of these comma separated response codes or classes, e.g. 404,5XX', type=statuses, dest='statuses')
+    parser.add_argument('--index', '-i', help='Build a sidecar index (LOG.idx) of each log the first time it is read and use it to skip logs and seek to the --since/--until window on later runs, meant for archived logs - only used with --since, --until or --path-prefix and without --state, a log that changed since it was indexed is indexed again', action='store_true', dest='use_index')
+    parser.add_argument('--mmap', help='Memory map uncompressed logs and scan them as bytes instead of reading them as text - only for logs that are not written to while they are read, a log truncated during the read (copytruncate rotation) crashes the run', action='store_true', dest='use_mmap')
+    parser.add_argument('--progress', help='Print to stderr as the logs of each component are processed and its page is rendered', action='store_true')
+    parser.add_argument('--profile', '-P', help='Time each stage of the run (reading, parsing, filtering, aggregating, rendering) and print a summary with throughput and peak memory to stderr - per line stages are timed around every call, which slows the run down', action='store_true')
+    parser.add_argument('--profile-trace', help='With --profile, also write the stages as a Chrome trace (chrome://tracing, ui.perfetto.dev) to this file', dest='profile_trace')
+    parser.add_argument('--cprofile', help='Run under cProfile and write the stats to this file (python -m pstats FILE) - worker processes are not included')
+    parser.add_argument('log', nargs='+', help='The log files to calculate statistics from - .gz, .bz2 and .xz files are decompressed on the fly, - reads from stdin')
+    parser.set_defaults(include_query=False,time_bucket=[performance.TimeBucket.NONE],workers=1,quantiles=performance.QuantileEstimator.EXACT,follow=False,refresh_interval=10,formats=[performance.OutputFormat.HTML],templates=False,path_rules=[],max_paths=None,use_index=False,use_mmap=False,progress=False,profile=False)
+    args = parser.parse_args()
+
+    request_parser = ApacheRequestParser()
+    if args.log_format is not None:
+        log_format = logformat.LogFormat(args.log_format)
+        if None in [log_format.request_index, log_format.status_index, log_format.time_index, log_format.duration_index]:
+            parser.error('--log-format must include %t, %r, %>s and a duration (%D, %T or %{UNIT}T)')
+        request_parser = ApacheRequestParser(log_format)
+
+    filters = None
+    if any(f is not None for f in [args.since, args.until, args.path_prefix, args.methods, args.statuses]):
+        filters = performance.RequestFilters(args.since, args.until, args.path_prefix, args.methods, args.statuses)
+
+    path_normalizer = None
+    if args.templates or len(args.path_rules) > 0:
+        path_normalizer = paths.PathNormalizer(args.path_rules, args.templates)
+
+    profiler = None
+    if args.profile or args.profile_trace is not None:
+        profiler = profiling.Profiler()
+    profile = None
+    if args.cprofile is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        performance.performance_report(args.log, request_parser, component_from_filename, request_filter, args.time_bucket, args.include_query, args.workers, args.quantiles, args.state_file, args.follow, args.refresh_interval, args.formats, path_normalizer, args.max_paths, filters, args.use_index, args.use_mmap, profiler, args.progress)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.cprofile)
+        if profiler is not None:
+            print(profiler.summary(), file=sys.stderr)
+            if args.profile_trace is not None:
+                profiler.write_trace(args.profile_trace)
@@ -0,0 +1,323 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shlex
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from apache import ApacheRequest, ApacheRequestParser, request_filter
+from core import aggregate
+from core import performance
+import synthetic
+
+_METHODS = ['GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE']
+_CODES = ['200', '200', '200', '201', '404', '500', '0']
+
+def _synthetic_log(filename, lines, seed=0):
+    synthetic.SyntheticLog(lines, seed=seed).write(filename)
+
+def _measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+def _ingest_streaming(filename):
+    count = 0
+    with performance._open_log(filename) as file:
+        for line in file:
+            count += 1
+    return count
+
+def _ingest_readlines(filename):
+    count = 0
+    with open(filename, 'r') as file:
+        for line in file.readlines():
+            count += 1
+    return count
+
+def ingest_benchmark(args):
+    print(f'{"reader":<16}{"lines":>10}{"seconds":>10}{"peak memory":>16}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for multiplier in [1, 4, 16]:
+            lines = args.lines * multiplier
+            for suffix in ['log', 'log.gz']:
+                filename = os.path.join(tmp, f'access-{lines}.{suffix}')
+                _synthetic_log(filename, lines)
+                readers = [('streaming', _ingest_streaming)]
+                if suffix == 'log' and not args.skip_readlines:
+                    readers.append(('readlines', _ingest_readlines))
+                for label, reader in readers:
+                    if suffix == 'log.gz':
+                        label += ' (gz)'
+                    count, elapsed, peak = _measure(lambda: reader(filename))
+                    print(f'{label:<16}{count:>10}{elapsed:>10.2f}{peak / 1024:>13.0f}KiB')
+
+class _ShlexApacheRequest():
+    # the shlex based parser ApacheRequest replaced, kept as the baseline for the parse benchmark
+    def __init__(self, line):
+        self._fields = shlex.split(line)
+        self.url = self._fields[5].split(" ")[1]
+        self.http_method = self._fields[5].split(" ")[0]
+        self.http_response_code = self._fields[6]
+        self.duration = self._fields[11]
+        self.path = self.url.split('?')[0]
+        self.request_time = datetime.datetime.strptime(f'{self._fields[3]} {self._fields[4]}', '[%d/%b/%Y:%H:%M:%S %z]').astimezone(datetime.timezone.utc)
+
+def parse_benchmark(args):
+    lines = list(synthetic.SyntheticLog(args.lines))
+    print(f'{"parser":<16}{"lines":>10}{"seconds":>10}{"lines/sec":>12}')
+    for label, request_parser in [('shlex', _ShlexApacheRequest), ('logformat', ApacheRequest)]:
+        start = time.perf_counter()
+        for line in lines:
+            request_parser(line)
+        elapsed = time.perf_counter() - start
+        print(f'{label:<16}{len(lines):>10}{elapsed:>10.2f}{len(lines) / elapsed:>12.0f}')
+
+def _read_text(filename, request_parser):
+    count = 0
+    with open(filename, 'r') as file:
+        for req in map(request_parser, file):
+            count += 1
+    return count
+
+def _read_mmap(filename, request_parser):
+    count = 0
+    with performance._map_log(filename) as buffer:
+        for req in request_parser.scan_buffer(buffer, 0, len(buffer)):
+            count += 1
+    return count
+
+def read_benchmark(args):
+    # best of args.repeat runs, memory is measured on a separate run as tracing slows the readers down
+    request_parser = ApacheRequestParser()
+    print(f'{"reader":<16}{"lines":>10}{"seconds":>10}{"lines/sec":>12}{"peak memory":>16}')
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'access.log')
+        _synthetic_log(filename, args.lines)
+        for label, reader in [('text', _read_text), ('mmap', _read_mmap)]:
+            elapsed = []
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                count = reader(filename, request_parser)
+                elapsed.append(time.perf_counter() - start)
+            _, _, peak = _measure(lambda: reader(filename, request_parser))
+            print(f'{label:<16}{count:>10}{min(elapsed):>10.2f}{count / min(elapsed):>12.0f}{peak / 1024:>13.0f}KiB')
+
+def _nested_dict_store(requests):
+    # the url -> date -> minute -> method dict tree AggregateStore replaced
+    data = {}
+    for url, request_time, method, code, duration in requests:
+        root = data.setdefault(url, {}).setdefault(str(request_time.date()), {})
+        k = f'{request_time.hour}:0{request_time.minute}' if request_time.minute < 10 else f'{request_time.hour}:{request_time.minute}'
+        root = root.setdefault(k, {})
+        if method not in root:
+            root[method] = {'count': 0, 'duration': [], 'response': {}}
+        root = root[method]
+        root['count'] += 1
+        root['duration'].append(duration)
+        code = code[0] + 'XX' if code[0] in ['2', '4', '5'] else code
+        root['response'][code] = root['response'].get(code, 0) + 1
+    return data
+
+def _aggregate_store(requests):
+    store = aggregate.AggregateStore()
+    for url, request_time, method, code, duration in requests:
+        store.bucket(url, performance._time_key(request_time, performance.TimeBucket.MINUTE), method).add(code, duration)
+    return store
+
+def store_benchmark(args):
+    rand = random.Random(0)
+    request_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    requests = []
+    for i in range(args.requests):
+        requests.append((f'/api/resource{rand.randint(1, args.urls)}', request_time + datetime.timedelta(seconds=i * 60 * args.minutes // args.requests),
+                         rand.choice(_METHODS), rand.choice(_CODES), rand.randint(1, 2000)))
+    buckets = len(_aggregate_store(requests))
+    print(f'{args.requests} requests, {buckets} minute buckets')
+    print(f'{"store":<16}{"seconds":>10}{"memory":>14}{"bytes/bucket":>14}')
+    for label, build in [('nested dict', _nested_dict_store), ('AggregateStore', _aggregate_store)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        store = build(requests)
+        elapsed = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del store
+        print(f'{label:<16}{elapsed:>10.2f}{memory / 1024:>11.0f}KiB{memory / buckets:>14.0f}')
+
+def render_benchmark(args):
+    # urls x minutes x one method, so the url and date cells span many rows
+    store = aggregate.AggregateStore()
+    rand = random.Random(0)
+    minutes = max(1, args.rows // args.urls)
+    start_key = performance._time_key(datetime.datetime(2024, 1, 1), performance.TimeBucket.MINUTE)
+    for u in range(args.urls):
+        for m in range(minutes):
+            store.bucket(f'/api/resource{u}', start_key + m, 'GET').add(rand.choice(_CODES), rand.randint(1, 2000))
+    rows = len(store)
+    table_headers = ['url', 'date', 'minute', 'method', 'requests'] + performance._HTTP_RESPONSE_FIELDS + performance._PERCENTILE_FIELDS
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'index.html')
+        start = time.perf_counter()
+        with open(filename, 'w') as html_file:
+            performance._write_table(html_file, performance._table_rows(store, performance.TimeBucket.MINUTE), 'inbound', table_headers, 3, performance.http_performance_data_handler)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(filename)
+    print(f'{"rows":>10}{"seconds":>10}{"rows/sec":>12}{"html":>14}')
+    print(f'{rows:>10}{elapsed:>10.2f}{rows / elapsed:>12.0f}{size / 1024 / 1024:>11.0f}MiB')
+
+def _suite_parse(filename, request_parser, use_mmap):
+    # number of requests parsed the way _process_log reads the log
+    if use_mmap:
+        with performance._map_log(filename) as buffer:
+            return sum(1 for req in request_parser.scan_buffer(buffer, 0, len(buffer)))
+    with performance._open_log(filename) as file:
+        return sum(1 for req in performance._parse_lines(file, request_parser, None, functools.partial(performance._skipped_lines.add, filename)))
+
+def _suite_run(filename, time_bucket, repeat=1, use_mmap=False):
+    # runs in a fresh process, so the peak RSS is that of a single report
+    # parsing is timed on its own, aggregation is the time to parse and aggregate less the time to parse,
+    # each is the best of repeat runs
+    # the log is read as text as it is by default, or memory mapped as with --mmap
+    request_parser = ApacheRequestParser()
+    parse_seconds = []
+    process_seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        lines = _suite_parse(filename, request_parser, use_mmap)
+        parse_seconds.append(time.perf_counter() - start)
+
+        times = {'example': {}}
+        inbound_http = {'example': performance._new_store(performance.QuantileEstimator.EXACT)}
+        start = time.perf_counter()
+        performance._process_log(filename, None, None, 'example', request_parser, request_filter, times, inbound_http, time_bucket, False, None, None, use_mmap)
+        process_seconds.append(time.perf_counter() - start)
+    parse_seconds = min(parse_seconds)
+    aggregate_seconds = max(min(process_seconds) - parse_seconds, 1e-9)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        performance._write_report(os.path.join(tmp, 'out'), {'example'}, times, inbound_http, time_bucket)
+        render_seconds = time.perf_counter() - start
+        html_bytes = os.path.getsize(os.path.join(tmp, 'out', 'example', 'index.html'))
+
+    return {
+        'lines': lines,
+        'buckets': len(inbound_http['example']),
+        'parse_seconds': parse_seconds,
+        'parse_lines_per_sec': lines / parse_seconds,
+        'aggregate_seconds': aggregate_seconds,
+        'aggregate_lines_per_sec': lines / aggregate_seconds,
+        'render_seconds': render_seconds,
+        'html_bytes': html_bytes,
+        # KiB on Linux, bytes on macOS
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+# metric -> True if higher is better
+_SUITE_METRICS = {
+    'parse_lines_per_sec': True,
+    'aggregate_lines_per_sec': True,
+    'render_seconds': False,
+    'peak_rss': False,
+}
+
+def _git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def suite_benchmark(args):
+    log = synthetic.from_arguments(args)
+    results = {}
+    print(f'{"bucket":<10}{"lines":>10}{"buckets":>10}{"parse/sec":>12}{"aggregate/sec":>15}{"render":>10}{"peak rss":>12}')
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'access.log')
+        log.write(filename)
+        for time_bucket in performance.TimeBucket:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                r = results[time_bucket.value] = executor.submit(_suite_run, filename, time_bucket, args.repeat, args.use_mmap).result()
+            print(f'{time_bucket.value:<10}{r["lines"]:>10}{r["buckets"]:>10}{r["parse_lines_per_sec"]:>12.0f}{r["aggregate_lines_per_sec"]:>15.0f}{r["render_seconds"]:>9.2f}s{r["peak_rss"]:>12}')
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'log': log.options(),
+        'reader': 'mmap' if args.use_mmap else 'text',
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        _compare(baseline, report)
+
+def _compare(baseline, report):
+    # change of each metric from the baseline, positive is better
+    if baseline['log'] != report['log']:
+        print('warning: the baseline was run on a different log, the results are not comparable')
+    if baseline.get('reader', 'mmap') != report['reader']:
+        print(f'warning: the baseline read the log with the {baseline.get("reader", "mmap")} reader, the results are not comparable')
+    print(f'compared with {baseline.get("revision")} ({baseline["created"]})')
+    print(f'{"bucket":<10}' + ''.join(f'{metric:>26}' for metric in _SUITE_METRICS))
+    for bucket, result in report['results'].items():
+        if bucket not in baseline['results']:
+            continue
+        changes = []
+        for metric, higher_is_better in _SUITE_METRICS.items():
+            before, after = baseline['results'][bucket][metric], result[metric]
+            change = (after - before) / before * 100 if before else 0
+            changes.append(change if higher_is_better else -change)
+        print(f'{bucket:<10}' + ''.join(f'{change:>+25.1f}%' for change in changes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Benchmarks for the performance report'
+    )
+    subparsers = parser.add_subparsers(required=True)
+    suite = subparsers.add_parser('suite', help='Parse rate, aggregation rate, render time and peak RSS for each time bucket on a synthetic log, saved as JSON to compare versions')
+    synthetic.add_arguments(suite)
+    suite.add_argument('--output', '-o', help='Write the results to this JSON file')
+    suite.add_argument('--compare', '-c', help='Compare the results with a JSON file written by an earlier run')
+    suite.add_argument('--repeat', type=int, help='Number of timed runs of parsing and aggregation, the best is reported')
+    suite.add_argument('--mmap', help='Read the log through a memory map as with apache.py --mmap instead of as text', action='store_true', dest='use_mmap')
+    suite.set_defaults(func=suite_benchmark, lines=1000000, output=None, compare=None, repeat=1, use_mmap=False)
+    ingest = subparsers.add_parser('ingest', help='Peak memory of streaming line ingestion as the log grows')
+    ingest.add_argument('--lines', type=int, help='Number of lines in the smallest generated log')
+    ingest.add_argument('--skip-readlines', help='Do not run the file.readlines() reader for comparison', action='store_true')
+    ingest.set_defaults(func=ingest_benchmark, lines=100000, skip_readlines=False)
+    parse = subparsers.add_parser('parse', help='Lines per second of ApacheRequest compared with the shlex based parser')
+    parse.add_argument('--lines', type=int, help='Number of lines to parse')
+    parse.set_defaults(func=parse_benchmark, lines=100000)
+    read = subparsers.add_parser('read', help='Lines per second of the memory mapped reader compared with reading the log as text')
+    read.add_argument('--lines', type=int, help='Number of lines in the generated log')
+    read.add_argument('--repeat', type=int, help='Number of timed runs of each reader, the best is reported')
+    read.set_defaults(func=read_benchmark, lines=1000000, repeat=3)
+    store = subparsers.add_parser('store', help='Memory per bucket of the aggregate store at minute granularity compared with nested dicts')
+    store.add_argument('--requests', type=int, help='Number of requests to aggregate')
+    store.add_argument('--urls', type=int, help='Number of distinct urls')
+    store.add_argument('--minutes', type=int, help='Time span of the requests in minutes')
+    store.set_defaults(func=store_benchmark, requests=500000, urls=200, minutes=24 * 60)
+    render = subparsers.add_parser('render', help='Time to render a per-minute table from a synthetic aggregate')
+    render.add_argument('--rows', type=int, help='Number of rows in the table')
+    render.add_argument('--urls', type=int, help='Number of distinct urls')
+    render.set_defaults(func=render_benchmark, rows=1000000, urls=1000)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,26 @@
+import argparse
+import time
+from core import performance
+
+def output_formats(value):
+    return [performance.OutputFormat(f) for f in value.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Compare two reports written with --format snapshot and output the endpoints whose latency or 5XX rate moved, without reading the logs again'
+    )
+    parser.add_argument('--p90', help='Percent change in 90p that is reported', type=float, dest='p90_change')
+    parser.add_argument('--p99', help='Percent change in 99p that is reported', type=float, dest='p99_change')
+    parser.add_argument('--errors', '-e', help='Change in 5XX rate, in percentage points, that is reported', type=float, dest='error_rate_change')
+    parser.add_argument('--min-requests', '-n', help='Only compare endpoints with at least this many requests in both', type=int)
+    parser.add_argument('--format', '-o', help='Comma separated output formats - html, csv, jsonl', type=output_formats, dest='formats')
+    parser.add_argument('--out', help='Directory the comparison is written to', dest='root_path')
+    parser.add_argument('baseline', help='Report directory (out) or .snapshot file to compare against, e.g. last week')
+    parser.add_argument('current', help='Report directory (out) or .snapshot file to compare, e.g. this hour')
+    parser.set_defaults(p90_change=20,p99_change=20,error_rate_change=1,min_requests=20,formats=[performance.OutputFormat.HTML],root_path='compare')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows, compared = performance.compare_snapshots(args.baseline, args.current, args.p90_change, args.p99_change, args.error_rate_change, args.min_requests, args.formats, args.root_path)
+    regressions = sum(1 for row in rows if row[-1] > 0)
+    print(f'{compared} endpoints compared, {regressions} regressed and {len(rows) - regressions} improved beyond the thresholds in {time.perf_counter() - start:.2f}s - see {args.root_path}/')
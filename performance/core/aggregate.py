@@ -0,0 +1,140 @@
+from core import quantiles
+
+# response classes counted per bucket, in report column order
+RESPONSE_FIELDS = ['2XX', '4XX', '5XX', 'No Response', 'Other']
+
+# url the requests for any url beyond max_urls are counted under
+OTHER_URL = 'other'
+
+# bits reserved for each part of a bucket key
+_METHOD_BITS = 16
+_TIME_BITS = 32
+
+class Bucket():
+    # counters for one url/time bucket/method combination
+    __slots__ = ('count', 'ok', 'client_error', 'server_error', 'no_response', 'other', 'duration')
+
+    def __init__(self, duration):
+        self.count = 0
+        self.ok = 0
+        self.client_error = 0
+        self.server_error = 0
+        self.no_response = 0
+        self.other = 0
+        self.duration = duration
+
+    def add(self, http_response_code, duration=None):
+        self.count += 1
+        if http_response_code == '0':
+            self.no_response += 1
+        else:
+            c = http_response_code[:1]
+            if c == '2':
+                self.ok += 1
+            elif c == '4':
+                self.client_error += 1
+            elif c == '5':
+                self.server_error += 1
+            else:
+                self.other += 1
+        if duration is not None:
+            self.duration.add(duration)
+
+    def add_many(self, responses):
+        # responses are counts in RESPONSE_FIELDS order
+        ok, client_error, server_error, no_response, other = responses
+        self.count += ok + client_error + server_error + no_response + other
+        self.ok += ok
+        self.client_error += client_error
+        self.server_error += server_error
+        self.no_response += no_response
+        self.other += other
+
+    def merge(self, other):
+        self.count += other.count
+        self.ok += other.ok
+        self.client_error += other.client_error
+        self.server_error += other.server_error
+        self.no_response += other.no_response
+        self.other += other.other
+        self.duration.merge(other.duration)
+
+    def responses(self):
+        # counts in RESPONSE_FIELDS order
+        return [self.ok, self.client_error, self.server_error, self.no_response, self.other]
+
+class AggregateStore():
+    # flat store of buckets keyed by url, time bucket and method
+    # urls and methods are interned to integer ids and packed with the integer time key into a single int,
+    # so each bucket costs one small int key and one slotted Bucket instead of a chain of nested dicts
+    # max_urls caps the number of distinct urls, once it is reached new urls are counted under OTHER_URL
+    __slots__ = ('duration_summary', 'max_urls', 'urls', 'methods', '_url_ids', '_method_ids', '_buckets')
+
+    def __init__(self, duration_summary=quantiles.ExactQuantiles, max_urls=None):
+        self.duration_summary = duration_summary
+        self.max_urls = max_urls
+        self.urls = []
+        self.methods = []
+        self._url_ids = {}
+        self._method_ids = {}
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def bucket(self, url, time_key, method):
+        # bucket for the combination, created if needed
+        url_id = self._url_ids.get(url)
+        if url_id is None:
+            if self.max_urls is not None and len(self.urls) >= self.max_urls:
+                url = OTHER_URL
+                url_id = self._url_ids.get(url)
+            if url_id is None:
+                url_id = self._url_ids[url] = len(self.urls)
+                self.urls.append(url)
+        method_id = self._method_ids.get(method)
+        if method_id is None:
+            method_id = self._method_ids[method] = len(self.methods)
+            self.methods.append(method)
+        key = (((url_id << _TIME_BITS) | time_key) << _METHOD_BITS) | method_id
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(self.duration_summary())
+        return bucket
+
+    def reserve(self, urls):
+        # interns urls before there are any requests for them, e.g. the urls another store has kept under
+        # max_urls, so requests for them are not counted under OTHER_URL when this store is full
+        for url in urls:
+            if url not in self._url_ids:
+                self._url_ids[url] = len(self.urls)
+                self.urls.append(url)
+
+    def add(self, url, time_key, method, http_response_code, duration=None):
+        self.bucket(url, time_key, method).add(http_response_code, duration)
+
+    def merge(self, other):
+        # urls new to this store are added in the order other first saw them, so stores merged in the order
+        # their requests were seen keep the same urls under max_urls as adding the requests to one store
+        for url, time_key, method, bucket in other.items():
+            self.bucket(url, time_key, method).merge(bucket)
+
+    def regroup(self, time_key):
+        # new store with the time key of every bucket mapped by time_key, buckets that end up with the same
+        # url, time key and method are merged
+        store = AggregateStore(self.duration_summary)
+        for url, key, method, bucket in self.items():
+            store.bucket(url, time_key(key), method).merge(bucket)
+        return store
+
+    def items(self):
+        # (url, time key, method, bucket) in no particular order
+        for key, bucket in self._buckets.items():
+            method_id = key & ((1 << _METHOD_BITS) - 1)
+            time_key = (key >> _METHOD_BITS) & ((1 << _TIME_BITS) - 1)
+            url_id = key >> (_METHOD_BITS + _TIME_BITS)
+            yield self.urls[url_id], time_key, self.methods[method_id], bucket
+
+    def rows(self):
+        # (url, time key, method, bucket) sorted by url, time and method
+        return sorted(self.items(), key=lambda row: row[:3])
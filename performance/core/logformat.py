@@ -0,0 +1,155 @@
+import datetime
+import re
+
+# mod_log_config directive, e.g. %h, %>s, %{Referer}i, %{ms}T
+_DIRECTIVE = re.compile(r'%([<>]?)(?:!?[0-9,]+)?(?:\{([^}]*)\})?([a-zA-Z%])')
+
+# (before, field, after) patterns, the field is captured if the directive is needed
+# unrolled (normal* (special normal*)*) so the regex engine doesn't try an alternation per character
+_QUOTED = ('', r'[^"\\]*(?:\\.[^"\\]*)*', '')
+_BRACKETED = (r'\[', r'[^\]]*', r'\]')
+_TIME = ('', '.*?', '')
+_TOKEN = ('', r'\S*', '')
+
+_MONTHS = {m: i + 1 for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+# duration directive -> multiplier to convert to milliseconds
+_DURATIONS = {
+    '%{ms}T': 1,
+    '%{us}T': 0.001,
+    '%{s}T': 1000,
+    '%D': 0.001,
+    '%T': 1000,
+}
+
+COMMON = '%h %l %u %t "%r" %>s %b'
+COMBINED = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'
+
+class LogFormat():
+    # compiles an Apache LogFormat string into a single regular expression
+    # split returns every field as a string in the order the directives appear in the format
+    def __init__(self, log_format):
+        self.log_format = log_format
+        self.directives = []
+        self._parts = []
+        literal = ''
+        position = 0
+        for match in _DIRECTIVE.finditer(log_format):
+            literal += log_format[position:match.start()]
+            position = match.end()
+            if match.group(3) == '%':
+                literal += '%'
+                continue
+            directive = '%' + match.group(1) + (f'{{{match.group(2)}}}' if match.group(2) is not None else '') + match.group(3)
+            if literal.endswith('"') and log_format[position:position + 1] == '"':
+                field = _QUOTED
+            elif directive == '%t':
+                field = _BRACKETED
+            elif match.group(3) == 't':
+                field = _TIME
+            else:
+                field = _TOKEN
+            self._parts.append((literal, field))
+            self.directives.append(directive)
+            literal = ''
+        self._end = literal + log_format[position:]
+        self._pattern = re.compile(self._regex(range(len(self.directives))))
+
+        # fields needed by the performance report
+        self.request_index = self.index('%r')
+        self.status_index = self.index('%>s', '%s')
+        self.time_index = self.index('%t')
+        self.duration_index = self.index(*_DURATIONS)
+        self.duration_scale = None
+        if self.duration_index is not None:
+            self.duration_scale = _DURATIONS[self.directives[self.duration_index]]
+        self.decode_time = TimestampDecoder()
+
+        # bytes pattern capturing only the request, status, time and duration fields, in that order
+        # with report_pattern.match(line).group(*report_groups) - the duration is empty if the format has none
+        indexes = [self.request_index, self.status_index, self.time_index, self.duration_index]
+        captured = sorted(i for i in indexes if i is not None)
+        pattern = self._regex(captured)
+        if self.duration_index is None:
+            pattern = pattern[:-len(r'\s*$')] + r'()\s*$'
+            captured.append(None)
+        self.report_pattern = re.compile(pattern.encode('utf-8'))
+        self.report_groups = tuple(captured.index(i) + 1 for i in indexes)
+
+    def _regex(self, captured):
+        # pattern for the format, capturing the fields of the directives at the captured indexes
+        pattern = []
+        for i, (literal, (before, field, after)) in enumerate(self._parts):
+            group = f'({field})' if i in captured else f'(?:{field})'
+            pattern.append(re.escape(literal) + before + group + after)
+        return ''.join(pattern) + re.escape(self._end) + r'\s*$'
+
+    def __getstate__(self):
+        return self.log_format
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def index(self, *directives):
+        # index of the first of directives present in the format, or None
+        for directive in directives:
+            if directive in self.directives:
+                return self.directives.index(directive)
+        return None
+
+    def split(self, line):
+        match = self._pattern.match(line)
+        if match is None:
+            raise ValueError(f'line does not match log format "{self.log_format}" - line->"{line.rstrip()}"')
+        return match.groups()
+
+def unescape(value):
+    # apache escapes quotes and backslashes inside quoted fields
+    if '\\' not in value:
+        return value
+    return value.replace('\\"', '"').replace('\\\\', '\\')
+
+class TimestampDecoder():
+    # decodes %t timestamps (10/Oct/2000:13:55:36 -0700) to UTC datetimes
+    # consecutive lines usually share the same second, or at least the same day, so the last
+    # timestamp and the start of the last day are cached
+    def __init__(self):
+        self._last = None
+        self._last_time = None
+        self._day = None
+        self._day_start = None
+
+    def __call__(self, timestamp):
+        # timestamp can also be bytes, the cache then compares the bytes without decoding them
+        if timestamp == self._last:
+            return self._last_time
+        key = timestamp
+        if isinstance(timestamp, bytes):
+            timestamp = timestamp.decode('ascii', 'replace')
+        if len(timestamp) != 26 or timestamp[2] != '/' or timestamp[6] != '/' or timestamp[11] != ':' or timestamp[20] != ' ':
+            raise ValueError(f'timestamp in unexpected format - timestamp->"{timestamp}"')
+        day = timestamp[:11] + timestamp[20:]
+        if day != self._day:
+            self._day_start = _day_start(timestamp)
+            self._day = day
+        try:
+            seconds = int(timestamp[12:14]) * 3600 + int(timestamp[15:17]) * 60 + int(timestamp[18:20])
+        except ValueError:
+            raise ValueError(f'timestamp in unexpected format - timestamp->"{timestamp}"')
+        self._last = key
+        self._last_time = self._day_start + datetime.timedelta(seconds=seconds)
+        return self._last_time
+
+def _day_start(timestamp):
+    # UTC time of local midnight for the day in the timestamp
+    try:
+        offset = int(timestamp[22:24]) * 60 + int(timestamp[24:26])
+        if timestamp[21] == '-':
+            offset = -offset
+        elif timestamp[21] != '+':
+            raise ValueError
+        tz = datetime.timezone(datetime.timedelta(minutes=offset))
+        local = datetime.datetime(int(timestamp[7:11]), _MONTHS[timestamp[3:6]], int(timestamp[0:2]), tzinfo=tz)
+    except (KeyError, ValueError):
+        raise ValueError(f'timestamp in unexpected format - timestamp->"{timestamp}"')
+    return local.astimezone(datetime.timezone.utc)
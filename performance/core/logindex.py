@@ -0,0 +1,112 @@
+import bisect
+import gzip
+import os
+import pickle
+
+# bumped when the layout of the sidecar changes, older sidecars are rebuilt
+_VERSION = 1
+
+# distinct paths kept in an index, beyond this the path set is dropped as unknown
+MAX_PATHS = 10000
+
+class LogIndex():
+    # summary of a log saved next to it (<log>.idx) so repeated queries over archived logs can skip
+    # files that can not match and seek to a time window instead of scanning the whole log
+    # minutes holds each minute (minutes since 0001-01-01) that is later than every line before it,
+    # with the byte offset of the first line in it, so every line before offsets[i] is earlier than minutes[i]
+    # offsets of compressed logs are in the decompressed data
+    # sorted is set if no line is more than slack earlier than a line before it, only then can the
+    # end of a window be found from the minutes
+    # the index is only valid for a log with the same size and modification time
+    __slots__ = ('size', 'mtime', 'slack', 'lines', 'start', 'end', 'sorted', 'minutes', 'offsets', 'paths')
+
+    def __init__(self, size, mtime, slack):
+        self.size = size
+        self.mtime = mtime
+        self.slack = slack
+        self.lines = 0
+        self.start = None
+        self.end = None
+        self.sorted = True
+        self.minutes = []
+        self.offsets = []
+        self.paths = set()
+
+    def add(self, offset, request=None):
+        # called for every line in order, request is None for lines that could not be parsed
+        self.lines += 1
+        if request is None:
+            return
+        t = request.request_time
+        if self.start is None or t < self.start:
+            self.start = t
+        if self.end is None or t > self.end:
+            self.end = t
+        elif self.end - t > self.slack:
+            self.sorted = False
+        minute = _minute(t)
+        if len(self.minutes) == 0 or minute > self.minutes[-1]:
+            self.minutes.append(minute)
+            self.offsets.append(offset)
+        if self.paths is not None:
+            self.paths.add(request.path)
+            if len(self.paths) > MAX_PATHS:
+                self.paths = None
+
+    def range(self, start, end, filters):
+        # byte range of start to end (None for the start or end of the log) that can hold requests
+        # matching filters, None if none can
+        if filters is None:
+            return start, end
+        if self.start is None:
+            return None
+        if (filters.since is not None and self.end < filters.since) or (filters.until is not None and self.start >= filters.until):
+            return None
+        if filters.path_prefix is not None and self.paths is not None and not any(p.startswith(filters.path_prefix) for p in self.paths):
+            return None
+        low, high = start, end
+        if filters.since is not None:
+            offset = self._offset(_minute(filters.since))
+            if offset is not None and (low is None or offset > low):
+                low = offset
+        if filters.until is not None and self.sorted:
+            offset = self._offset(_minute(filters.until + self.slack) + 1)
+            if offset is not None and (high is None or offset < high):
+                high = offset
+        if low is not None and high is not None and low >= high:
+            return None
+        return low, high
+
+    def _offset(self, minute):
+        # offset of the first line of the first indexed minute at or after minute, None if there is none
+        i = bisect.bisect_left(self.minutes, minute)
+        if i == len(self.minutes):
+            return None
+        return self.offsets[i]
+
+def load(filename, stat):
+    # index saved for the log, None if there is none or the log has changed since it was saved
+    try:
+        with gzip.open(_sidecar(filename), 'rb') as file:
+            version, state = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if version != _VERSION or state['size'] != stat.st_size or state['mtime'] != stat.st_mtime_ns:
+        return None
+    index = LogIndex(state['size'], state['mtime'], state['slack'])
+    for name in LogIndex.__slots__:
+        setattr(index, name, state[name])
+    return index
+
+def save(filename, index):
+    path = _sidecar(filename)
+    tmp = f'{path}.tmp'
+    with gzip.open(tmp, 'wb') as file:
+        pickle.dump((_VERSION, {name: getattr(index, name) for name in LogIndex.__slots__}), file)
+    os.replace(tmp, path)
+
+def _sidecar(filename):
+    return f'{filename}.idx'
+
+def _minute(t):
+    return (t.toordinal() * 24 + t.hour) * 60 + t.minute
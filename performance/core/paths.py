@@ -0,0 +1,52 @@
+import re
+
+_UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+_HEX = re.compile(r'(?=[a-fA-F]*[0-9])[0-9a-fA-F]{8,}')
+
+class PathNormalizer():
+    # collapses paths with ids in them to a template, e.g. /orders/83712/items -> /orders/{id}/items
+    # rules are (regex, replacement) pairs applied in order with re.sub, then if detect_ids is set
+    # numeric, UUID and hex (8+ characters with a digit) segments are replaced
+    # results are memoized, so a path that was seen before costs a single dict lookup
+    def __init__(self, rules=(), detect_ids=True, cache_size=100000):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.detect_ids = detect_ids
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def __getstate__(self):
+        return [(r.pattern, replacement) for r, replacement in self.rules], self.detect_ids, self.cache_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __call__(self, path):
+        template = self._cache.get(path)
+        if template is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            template = self._cache[path] = self._template(path)
+        return template
+
+    def _template(self, path):
+        for pattern, replacement in self.rules:
+            path = pattern.sub(replacement, path)
+        if self.detect_ids:
+            segments = path.split('/')
+            for i, segment in enumerate(segments):
+                if segment.isdigit():
+                    segments[i] = '{id}'
+                elif _UUID.fullmatch(segment):
+                    segments[i] = '{uuid}'
+                elif _HEX.fullmatch(segment):
+                    segments[i] = '{hex}'
+            path = '/'.join(segments)
+        return path
+
+def parse_rule(rule):
+    # REGEX=REPLACEMENT, split on the last =
+    pattern, sep, replacement = rule.rpartition('=')
+    if not sep:
+        raise ValueError(f'path rule must be in the format REGEX=REPLACEMENT - rule->"{rule}"')
+    re.compile(pattern)
+    return pattern, replacement
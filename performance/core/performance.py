@@ -1,10 +1,32 @@
 import argparse
+import bz2
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
+import csv
 import datetime
 from enum import Enum
 import errno
+import functools
+import glob
+import gzip
+import hashlib
 import json
+import locale
+import lzma
+import mmap
 import os
+import pickle
+import queue
+import sys
+import threading
+import time
 from warnings import warn
+from core import aggregate
+from core import logindex
+from core import profiling
+from core import quantiles
+from core import snapshot
 
 class TimeBucket(Enum):
     NONE = 'none'
@@ -12,40 +34,80 @@ class TimeBucket(Enum):
     HOUR = 'hour'
     MINUTE = 'minute'
 
-class Request():
-    def __init__(self, line, separator, http_method_index, url_index, response_code_index, duration_index, date_index=None, time_index=None, datetime_index=None, datetime_format=None):
-        self._fields = line.split(separator)
+class QuantileEstimator(Enum):
+    EXACT = 'exact'
+    DDSKETCH = 'ddsketch'
 
-        # direct fields
-        self.url = self._fields[url_index]
-        self.http_method = self._fields[http_method_index]
-        self.http_response_code = self._fields[response_code_index]
-        self.duration = self._fields[duration_index]
-
-        # processed from direct fields
-        self.path = self.url.split('?')[0]
-        self.query_params = {}
+class OutputFormat(Enum):
+    HTML = 'html'
+    CSV = 'csv'
+    JSONL = 'jsonl'
+    PARQUET = 'parquet'
+    SNAPSHOT = 'snapshot'
+
+class RequestRecord():
+    # base for parsed requests - subclasses set the slots used by the report
+    # everything else is computed on access, and query parameters are only parsed the first time they are used
+    __slots__ = ('url', 'http_method', 'http_response_code', 'duration', 'request_time', '_query_params')
+
+    @property
+    def path(self):
+        return self.url.partition('?')[0]
+
+    @property
+    def query(self):
+        if '?' not in self.url:
+            return None
+        return self.url.split('?')[1]
+
+    @property
+    def query_params(self):
+        try:
+            return self._query_params
+        except AttributeError:
+            pass
+        self._query_params = {}
         if '?' in self.url:
-            self.query = self.url.split('?')[1]
             for pair in self.query.split('&'):
                 l = pair.split('=')
                 if len(l) != 2:
-                    warn(f'skipped query parameter in unexpected format, length !=2 after split on "=" - param->"{pair}"')
+                    # summarized at the end of the report rather than warning for every line
+                    _skipped_query_params['count'] += 1
+                    if _skipped_query_params['example'] is None:
+                        _skipped_query_params['example'] = pair
                     continue
-                self.query_params[l[0]] = l[1]
+                self._query_params[l[0]] = l[1]
+        return self._query_params
+
+class Request(RequestRecord):
+    __slots__ = ()
+
+    def __init__(self, line, separator, http_method_index, url_index, response_code_index, duration_index, date_index=None, time_index=None, datetime_index=None, datetime_format=None):
+        fields = line.split(separator)
+
+        # direct fields
+        self.url = fields[url_index]
+        self.http_method = fields[http_method_index]
+        self.http_response_code = fields[response_code_index]
+        self.duration = fields[duration_index]
 
         if not (date_index and time_index) and not datetime_index:
             raise Exception('must specify either (date_index and time_index) or datetime_index')
         if datetime_index:
-            datetime_str = self._fields[datetime_index]
+            datetime_str = fields[datetime_index]
         else:
-            datetime_str = f'{self._fields[date_index]} {self._fields[time_index]}'
+            datetime_str = f'{fields[date_index]} {fields[time_index]}'
         if datetime_format:
-            self.request_time = datetime.strptime(datetime_str, datetime_format)
+            self.request_time = datetime.datetime.strptime(datetime_str, datetime_format)
         else:
-            self.request_time = datetime.fromisoformat(datetime_str)
+            self.request_time = datetime.datetime.fromisoformat(datetime_str)
+
+# malformed query parameters seen by RequestRecord.query_params
+_skipped_query_params = {'count': 0, 'example': None}
+# profiling.Profiler of the run when it is profiled, stages are only timed if it is set
+_profiler = None
 
-_HTTP_RESPONSE_FIELDS = ['2XX', '4XX', '5XX', 'No Response', 'Other']
+_HTTP_RESPONSE_FIELDS = aggregate.RESPONSE_FIELDS
 _PERCENTILE_FIELDS = ['50p', '75p', '90p', '99p']
 
 def date_filter(request, start_date=None, end_date=None):
@@ -57,7 +119,7 @@ def date_filter(request, start_date=None, end_date=None):
     return True
 
 def url_filter(request, pattern, reverse_match=False):
-    if request.path.contains(pattern):
+    if pattern in request.path:
         if reverse_match:
             return False
         else:
@@ -68,10 +130,106 @@ def url_filter(request, pattern, reverse_match=False):
         else:
             return False
 
-def performance_report(logs, request_parser, component_parser, request_filter, time_bucket: TimeBucket = TimeBucket.NONE, include_query=False):
-    no_bucket, by_day, by_hour, by_minute = _time_bucket_bools(time_bucket)
+class RequestFilters():
+    # filters declared to the engine instead of applied in request_filter, so they can be checked
+    # against the raw line before it is parsed (request parsers with a line_filter method) and
+    # time sorted logs can be seeked to the requested window (request parsers with a line_time method)
+    # since is inclusive and until exclusive, statuses are codes (404) or classes (5XX)
+    __slots__ = ('since', 'until', 'path_prefix', 'methods', 'statuses')
+
+    def __init__(self, since=None, until=None, path_prefix=None, methods=None, statuses=None):
+        self.since = since
+        self.until = until
+        self.path_prefix = path_prefix
+        self.methods = frozenset(methods) if methods is not None else None
+        self.statuses = frozenset(s.upper() for s in statuses) if statuses is not None else None
+
+    def in_window(self, request_time):
+        if self.since is not None and request_time < self.since:
+            return False
+        if self.until is not None and request_time >= self.until:
+            return False
+        return True
+
+    def matches(self, request):
+        if not self.in_window(request.request_time):
+            return False
+        if self.path_prefix is not None and not request.path.startswith(self.path_prefix):
+            return False
+        if self.methods is not None and request.http_method not in self.methods:
+            return False
+        if self.statuses is not None and request.http_response_code not in self.statuses and request.http_response_code[:1] + 'XX' not in self.statuses:
+            return False
+        return True
+
+class SkippedLines():
+    # lines that could not be parsed, counted by reason with a few examples of each, so a corrupt line
+    # costs neither the run nor unbounded memory
+    # the reason is the exception type and the message up to its detail (" - detail->value"), reasons
+    # beyond max_reasons are counted together
+    def __init__(self, max_samples=10, max_reasons=100):
+        self.max_samples = max_samples
+        self.max_reasons = max_reasons
+        self.clear()
+
+    def clear(self):
+        # reason -> [count, samples]
+        self.reasons = {}
+
+    def add(self, filename, error, line):
+        entry = self._entry(f'{type(error).__name__}: {str(error).split(" - ")[0]}')
+        entry[0] += 1
+        if len(entry[1]) < self.max_samples:
+            entry[1].append({'file': filename, 'error': str(error)[:_SKIPPED_LINE_LENGTH], 'line': line.rstrip('\n')[:_SKIPPED_LINE_LENGTH]})
+
+    def merge(self, other):
+        for reason, (count, samples) in other.reasons.items():
+            entry = self._entry(reason)
+            entry[0] += count
+            entry[1].extend(samples[:self.max_samples - len(entry[1])])
+
+    def _entry(self, reason):
+        # [count, samples] of the reason, created if needed - once there are max_reasons, new reasons share 'other'
+        entry = self.reasons.get(reason)
+        if entry is None:
+            if len(self.reasons) >= self.max_reasons:
+                reason = 'other'
+                entry = self.reasons.get(reason)
+            if entry is None:
+                entry = self.reasons[reason] = [0, []]
+        return entry
+
+    def __len__(self):
+        return sum(count for count, _ in self.reasons.values())
+
+    def write(self, path):
+        # JSON Lines, one record per reason with its count and samples, most frequent first
+        with open(path, 'w') as file:
+            for reason, (count, samples) in sorted(self.reasons.items(), key=lambda item: -item[1][0]):
+                file.write(json.dumps({'reason': reason, 'count': count, 'samples': samples}) + '\n')
+
+# longest line or error message kept in a SkippedLines sample
+_SKIPPED_LINE_LENGTH = 1000
+# lines of the current run that could not be parsed
+_skipped_lines = SkippedLines()
+
+def performance_report(logs, request_parser, component_parser, request_filter, time_bucket: TimeBucket = TimeBucket.NONE, include_query=False, workers=1, quantile_estimator: QuantileEstimator = QuantileEstimator.EXACT, state_file=None, follow=False, refresh_interval=10, formats=(OutputFormat.HTML,), path_normalizer=None, max_paths=None, filters=None, use_index=False, use_mmap=False, profiler=None, progress=False):
+    global _profiler
+    _profiler = profiler
+    try:
+        _performance_report(logs, request_parser, component_parser, request_filter, time_bucket, include_query, workers, quantile_estimator, state_file, follow, refresh_interval, formats, path_normalizer, max_paths, filters, use_index, use_mmap, progress)
+    finally:
+        _profiler = None
+
+def _performance_report(logs, request_parser, component_parser, request_filter, time_bucket, include_query, workers, quantile_estimator, state_file, follow, refresh_interval, formats, path_normalizer, max_paths, filters, use_index, use_mmap, progress):
+    # time_bucket can be a list of time buckets, the logs are aggregated at the finest one and the
+    # coarser ones are rolled up from it when the report is rendered
+    time_buckets = [time_bucket] if isinstance(time_bucket, TimeBucket) else list(dict.fromkeys(time_bucket))
+    time_bucket = max(time_buckets, key=_TIME_BUCKET_ORDER.index)
+    _skipped_lines.clear()
+    if OutputFormat.PARQUET in formats:
+        _import_pyarrow()
 
-    skipped = []
     components = set()
 
     dicts = []
@@ -80,66 +238,339 @@ def performance_report(logs, request_parser, component_parser, request_filter, t
     response_code_details = {}
     dicts.append(response_code_details)
     inbound_http = {}
-    dicts.append(inbound_http)
     
+    # previous runs
+    state = None
+    if state_file is not None:
+        if follow:
+            raise Exception('a state file can not be used when following logs')
+        with _stage('load state', state_file):
+            state = _load_state(state_file, time_bucket, include_query, quantile_estimator, max_paths)
+        for component, (component_times, store) in state['components'].items():
+            components.add(component)
+            for d in dicts:
+                d[component] = {}
+            times[component] = component_times
+            inbound_http[component] = store
+
     # process the logs
+    ranges = {}
     for filename in logs:
-        with open(filename, 'r') as file:
-            component = component_parser(filename)
-            if component not in components:
-                components.add(component)
-                for d in dicts:
-                    d[component] = {}
-            for line in file.readlines():
-                req = request_parser(line)
-                if not request_filter(req):
-                    continue
-                _process_times(req, component, times)
-                if req.duration is None or req.duration == 0:
-                    _process_performance(req, component, inbound_http, time_bucket, include_query, omit_duration=True)
+        component = component_parser(filename)
+        if component not in components:
+            components.add(component)
+            for d in dicts:
+                d[component] = {}
+            inbound_http[component] = _new_store(quantile_estimator, max_paths)
+        if state is not None:
+            ranges[filename] = _resume(state, filename)
+        else:
+            ranges[filename] = (None, None)
+        if ranges[filename] is not None and not follow:
+            with _stage('seek', filename):
+                # logs resumed from a state file are still being written, so their index would be rebuilt every run
+                if use_index and state is None and filename != '-' and _index_filters(filters):
+                    ranges[filename] = _log_index(filename, request_parser).range(*ranges[filename], filters)
                 else:
-                    _process_performance(req, component, inbound_http, time_bucket, include_query)
+                    ranges[filename] = _time_range(filename, *ranges[filename], request_parser, filters)
+    logs = [filename for filename in logs if ranges[filename] is not None]
+    if follow:
+        # only lines appended from now on are processed, the report is rewritten every refresh_interval seconds
+        write_report = lambda: _write_report('out', components, times, inbound_http, time_bucket, workers, formats, time_buckets)
+        _follow(logs, request_parser, component_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, refresh_interval, write_report)
+    else:
+        # every component is processed, rendered and released on its own
+        _write_index('out', components, times, formats)
+        _run_pipelines('out', components, logs, ranges, component_parser, request_parser, request_filter, times, inbound_http, time_bucket, include_query, workers, quantile_estimator, path_normalizer, max_paths, filters, use_mmap, formats, time_buckets, state is not None, progress)
+    if state is not None:
+        with _stage('save state', state_file):
+            _save_state(state_file, state, times, inbound_http)
 
-    # generate the report
-    root_path = 'out'
-    _mkdir(root_path)
-    index = open(f'{root_path}/index.html', 'w')
-    cfiles = {}
-    _init(index, times)
-    index.write('<table>\n<tr>\n<th>Component</th>\n</tr>\n')
+    if len(_skipped_lines) > 0:
+        _skipped_lines.write('skipped.json')
+        reasons = ', '.join(f'{count} {reason}' for reason, (count, _) in sorted(_skipped_lines.reasons.items(), key=lambda item: -item[1][0]))
+        warn(f'skipped {len(_skipped_lines)} lines that could not be parsed - {reasons} - see skipped.json for examples')
+        _skipped_lines.clear()
+    if _skipped_query_params['count'] > 0:
+        warn(f'skipped {_skipped_query_params["count"]} query parameters in unexpected format, length !=2 after split on "=" - first param->"{_skipped_query_params["example"]}"')
+        _skipped_query_params.update(count=0, example=None)
 
-    for component in sorted(components):
-        index.write(f'<tr><td><a href="{component}/index.html">{component}</a></td></tr>\n')
-
-    for label, data in zip(['inbound'], [inbound_http]):
-        for component in data:
-            if component not in cfiles:
-                _mkdir(f'{root_path}/{component}')
-                cfiles[component] = open(f'{root_path}/{component}/index.html', 'w')
-                _init(cfiles[component], component)
-            if len(data[component].keys()) == 0:
-                continue
-            output = cfiles[component]
-            if no_bucket:
-                table_headers = ['url', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
-                mergeable_columns = 1
-            if by_day:
-                table_headers = ['url', 'date', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
-                mergeable_columns = 2
-            if by_hour:
-                table_headers = ['url', 'date', 'hour', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
-                mergeable_columns = 3
-            if by_minute:
-                table_headers = ['url', 'date', 'minute', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
-                mergeable_columns = 3
-            data_handler = http_performance_data_handler
-            _write_table(output, data[component], label, table_headers, mergeable_columns, data_handler)
-
-    if len(skipped) > 0:
-        with open('skipped.json', 'w') as skipped_file:
-            for j in skipped:
-                skipped_file.write(json.dumps(j))
-        warn(f'skipped {len(skipped)} records - see skipped.json for details')
+def _stage(name, detail=None):
+    # times a coarse stage of the run when it is profiled
+    if _profiler is None:
+        return nullcontext()
+    return _profiler.stage(name, detail)
+
+_COMPRESSED_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+
+def _open_log(filename):
+    # logs are iterated lazily line by line, so memory use does not depend on the size of the log
+    # '-' reads from stdin, e.g. zcat access.log.*.gz | python apache.py -
+    if filename == '-':
+        return _Stdin()
+    _, ext = os.path.splitext(filename)
+    if ext in _COMPRESSED_OPENERS:
+        return _COMPRESSED_OPENERS[ext](filename, 'rt', errors='replace')
+    return open(filename, 'r', errors='replace')
+
+def _replace_errors(file):
+    # stdin may have been replaced by something that isn't a TextIOWrapper
+    if hasattr(file, 'reconfigure'):
+        file.reconfigure(errors='replace')
+
+class _Stdin():
+    # context manager that leaves stdin open on exit, undecodable bytes are replaced as in the other readers
+    def __enter__(self):
+        _replace_errors(sys.stdin)
+        return sys.stdin
+
+    def __exit__(self, *args):
+        return False
+
+# files smaller than this are not split between workers
+_MIN_CHUNK_SIZE = 16 * 1024 * 1024
+
+def _chunks(filename, workers, start=None, end=None):
+    # byte ranges of the file, or of start to end of the file, aligned to line boundaries
+    # stdin and compressed logs can't be seeked, so they are always processed whole
+    _, ext = os.path.splitext(filename)
+    if filename == '-' or ext in _COMPRESSED_OPENERS:
+        return [(start, end)]
+    low = start if start is not None else 0
+    high = end if end is not None else os.path.getsize(filename)
+    count = min(workers, -(-(high - low) // _MIN_CHUNK_SIZE))
+    if count <= 1:
+        return [(start, end)]
+    boundaries = [low]
+    with open(filename, 'rb') as file:
+        for i in range(1, count):
+            file.seek(max(low + (high - low) * i // count, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), high))
+    boundaries.append(high)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+def _read_range(filename, start, end):
+    # lines from byte offset start up to end (or the end of the file if None)
+    # offsets in compressed logs are in the decompressed data
+    _, ext = os.path.splitext(filename)
+    opener = _COMPRESSED_OPENERS.get(ext, open)
+    encoding = locale.getpreferredencoding(False)
+    with opener(filename, 'rb') as file:
+        file.seek(start)
+        position = start
+        for line in file:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode(encoding, 'replace')
+
+# how far out of order the lines of a sorted log can be - requests are logged when they complete,
+# with the time they started
+_TIME_SORT_SLACK = datetime.timedelta(minutes=5)
+# ranges smaller than this are scanned rather than bisected further
+_BISECT_MIN_SIZE = 64 * 1024
+# offsets sampled to check a log is sorted before it is bisected
+_SORT_SAMPLES = 8
+
+def _time_range(filename, start, end, request_parser, filters):
+    # narrows the byte range of a time sorted log to the lines around filters.since and filters.until
+    # lines just outside the window are still dropped by the filters, so the range only has to be close
+    # the range is returned unchanged for stdin, compressed logs, logs that are not sorted and
+    # request parsers without line_time, None if no line in the range can be in the window
+    if filters is None or (filters.since is None and filters.until is None) or not hasattr(request_parser, 'line_time'):
+        return start, end
+    _, ext = os.path.splitext(filename)
+    if filename == '-' or ext in _COMPRESSED_OPENERS:
+        return start, end
+    low = start if start is not None else 0
+    high = end if end is not None else os.path.getsize(filename)
+    encoding = locale.getpreferredencoding(False)
+    line_time = lambda line: request_parser.line_time(line.decode(encoding, 'replace'))
+    with open(filename, 'rb') as file:
+        samples = [_probe_time(file, low + (high - low) * i // _SORT_SAMPLES, low, high, line_time)[1] for i in range(_SORT_SAMPLES)]
+        samples = [t for t in samples if t is not None]
+        if any(a - b > _TIME_SORT_SLACK for a, b in zip(samples, samples[1:])):
+            return start, end
+        if filters.since is not None:
+            low, _ = _bisect_time(file, low, high, line_time, filters.since - _TIME_SORT_SLACK)
+        if filters.until is not None:
+            _, until_high = _bisect_time(file, low, high, line_time, filters.until + _TIME_SORT_SLACK)
+            if until_high < high:
+                # the end must be a line boundary
+                file.seek(until_high - 1)
+                file.readline()
+                high = min(file.tell(), high)
+    if low >= high:
+        return None
+    return low, high
+
+def _index_filters(filters):
+    # the index is built by reading the whole log once more, which only pays off if it can skip the log or
+    # seek in it
+    return filters is not None and (filters.since is not None or filters.until is not None or filters.path_prefix is not None)
+
+def _log_index(filename, request_parser):
+    # sidecar index of the log, built and saved next to it if it is missing or the log has changed
+    stat = os.stat(filename)
+    index = logindex.load(filename, stat)
+    if index is not None:
+        return index
+    index = logindex.LogIndex(stat.st_size, stat.st_mtime_ns, _TIME_SORT_SLACK)
+    _, ext = os.path.splitext(filename)
+    encoding = locale.getpreferredencoding(False)
+    position = 0
+    with _COMPRESSED_OPENERS.get(ext, open)(filename, 'rb') as file:
+        for line in file:
+            # lines the request parser fails on are skipped, as they are when the log is processed
+            try:
+                request = request_parser(line.decode(encoding, 'replace'))
+            except Exception:
+                request = None
+            index.add(position, request)
+            position += len(line)
+    try:
+        logindex.save(filename, index)
+    except OSError as e:
+        warn(f'could not save the index of {filename} - {e}')
+    return index
+
+def _bisect_time(file, low, high, line_time, target):
+    # offsets around the first line with a time at or after target, low is always a line start
+    while high - low > _BISECT_MIN_SIZE:
+        mid = (low + high) // 2
+        position, t = _probe_time(file, mid, low, high, line_time)
+        if t is not None and t < target:
+            low = position
+        else:
+            high = mid
+    return low, high
+
+def _probe_time(file, offset, low, high, line_time):
+    # start and time of the first line with a time that starts at or after offset and before high
+    if offset > low:
+        file.seek(offset - 1)
+        file.readline()
+    else:
+        file.seek(low)
+    position = file.tell()
+    while position < high:
+        line = file.readline()
+        if not line:
+            break
+        t = line_time(line)
+        if t is not None:
+            return position, t
+        position += len(line)
+    return None, None
+
+#
+# Incremental state
+#
+
+# bytes at the start of a log used to recognize it after it has been rotated or compressed
+_HEAD_SIZE = 4096
+# seconds a log is remembered after the last run that was given it, a rotated log that is only given
+# again after that is processed from the start
+_STATE_FILE_MAX_AGE = 7 * 24 * 60 * 60
+
+def _load_state(state_file, time_bucket, include_query, quantile_estimator, max_paths):
+    options = [time_bucket.value, include_query, quantile_estimator.value, max_paths]
+    if not os.path.exists(state_file):
+        return {'options': options, 'files': [], 'components': {}}
+    with gzip.open(state_file, 'rb') as file:
+        state = pickle.load(file)
+    if state['options'] != options:
+        raise Exception(f'state file {state_file} was written with different options (time bucket, include query, quantiles, max paths) - {state["options"]}')
+    return state
+
+def _save_state(state_file, state, times, inbound_http):
+    # logs that were deleted or rotated away would otherwise be kept, and compared with every log, forever
+    oldest = time.time() - _STATE_FILE_MAX_AGE
+    state['files'] = [e for e in state['files'] if e.get('seen', 0) >= oldest]
+    state['components'] = {component: (times[component], inbound_http[component]) for component in inbound_http}
+    tmp = f'{state_file}.tmp'
+    with gzip.open(tmp, 'wb') as file:
+        pickle.dump(state, file)
+    os.replace(tmp, state_file)
+
+def _resume(state, filename):
+    # byte range of the log that has not been processed by a previous run, None if there is nothing new
+    # logs are recognized by device/inode and the hash of their first bytes, so a log that was
+    # rotated (renamed, or compressed) is picked up where it was left, and a log that was truncated
+    # or replaced is processed from the start
+    if filename == '-':
+        raise Exception('stdin can not be used with a state file')
+    _, ext = os.path.splitext(filename)
+    compressed = ext in _COMPRESSED_OPENERS
+    stat = os.stat(filename)
+    with _COMPRESSED_OPENERS.get(ext, open)(filename, 'rb') as file:
+        head = file.read(_HEAD_SIZE)
+
+    candidates = [e for e in state['files'] if len(head) >= e['head_size'] and hashlib.sha1(head[:e['head_size']]).digest() == e['head']]
+    same_file = [e for e in candidates if e['dev'] == stat.st_dev and e['inode'] == stat.st_ino]
+    previous = None
+    if len(same_file) > 0:
+        previous = same_file[0]
+    else:
+        candidates = [e for e in candidates if e['head_size'] > 0]
+        if len(candidates) > 0:
+            previous = max(candidates, key=lambda e: e['offset'])
+
+    start = 0
+    if previous is not None:
+        state['files'].remove(previous)
+        if previous['complete']:
+            start = None
+        elif not compressed and stat.st_size < previous['offset']:
+            warn(f'{filename} was truncated since the last run - processing it from the start')
+        else:
+            start = previous['offset']
+
+    entry = {
+        'path': filename,
+        'dev': stat.st_dev,
+        'inode': stat.st_ino,
+        'head_size': len(head),
+        'head': hashlib.sha1(head).digest(),
+        'offset': start,
+        'complete': compressed,
+        'seen': time.time(),
+    }
+    state['files'].append(entry)
+    if start is None:
+        return None
+    if compressed:
+        # rotated logs are compressed once they are complete
+        return start, None
+    # stop at the last complete line, a partially written line is processed by the next run
+    entry['offset'] = _last_line_end(filename, stat.st_size, start)
+    if entry['offset'] == start:
+        return None
+    return start, entry['offset']
+
+def _last_line_end(filename, size, start):
+    # offset just after the last newline between start and size
+    with open(filename, 'rb') as file:
+        end = size
+        while end > start:
+            block_start = max(start, end - 65536)
+            file.seek(block_start)
+            block = file.read(end - block_start)
+            i = block.rfind(b'\n')
+            if i >= 0:
+                return block_start + i + 1
+            end = block_start
+    return start
+
+# time buckets from the coarsest to the finest
+_TIME_BUCKET_ORDER = [TimeBucket.NONE, TimeBucket.DAY, TimeBucket.HOUR, TimeBucket.MINUTE]
+# minutes in a unit of each time key - a time key times this is minutes since 0001-01-01
+_TIME_BUCKET_MINUTES = {TimeBucket.DAY: 24 * 60, TimeBucket.HOUR: 60, TimeBucket.MINUTE: 1}
 
 def _time_bucket_bools(time_bucket: TimeBucket):
     # no_bucket, by_day, by_hour, by_minute = _time_bucket_bools(time_bucket)
@@ -153,84 +584,465 @@ def _time_bucket_bools(time_bucket: TimeBucket):
 # Log processing
 #
 
-def _get_root(data, req, prepend_keys, time_bucket):
+def _time_key(request_time, time_bucket):
+    # integer key of the time bucket the request falls in - days, hours or minutes since 0001-01-01
+    if time_bucket == TimeBucket.NONE:
+        return 0
+    key = request_time.toordinal()
+    if time_bucket == TimeBucket.DAY:
+        return key
+    key = key * 24 + request_time.hour
+    if time_bucket == TimeBucket.HOUR:
+        return key
+    return key * 60 + request_time.minute
+
+def _time_columns(time_key, time_bucket):
+    # report columns for a time key - date and hour/minute
     no_bucket, by_day, by_hour, by_minute = _time_bucket_bools(time_bucket)
-    root = data
-    for key in prepend_keys:
-        if key not in root:
-            root[key] = {}
-        root = root[key]
-    if by_day or by_hour or by_minute:
-        req_date = str(req.request_time.date())
-        if req_date not in root:
-            root[req_date] = {}
-        root = root[req_date]
+    if no_bucket:
+        return []
+    if by_day:
+        return [str(datetime.date.fromordinal(time_key))]
     if by_hour:
-        req_hour = req.request_time.hour
-        k = f'{req_hour}:00'
-        if k not in root:
-            root[k] = {}
-        root = root[k]
-    if by_minute:
-        req_hour = req.request_time.hour
-        req_min = req.request_time.minute
-        k = f'{req_hour}:0{req_min}' if req_min < 10 else f'{req_hour}:{req_min}'
-        if k not in root:
-            root[k] = {}
-        root = root[k]
-    return root
-
-
-def _process_times(req, component, times):
-    if 'start' not in times[component] or times[component]['start'] > req.request_time:
-        times[component]['start'] = req.request_time
-    if 'end' not in times[component] or times[component]['end'] < req.request_time:
-        times[component]['end'] = req.request_time
-
-def _process_performance(req, component, inbound_http, time_bucket, include_query, omit_duration=False):
-    # bucket the response code
-    if req.http_response_code != '0':
-        if req.http_response_code[0] in ['2','4','5']:
-            req.http_response_code = req.http_response_code[0] + 'XX'
-        else:
-            req.http_response_code = 'Other'
-    
+        day, hour = divmod(time_key, 24)
+        return [str(datetime.date.fromordinal(day)), f'{hour}:00']
+    day, minute = divmod(time_key, 24 * 60)
+    return [str(datetime.date.fromordinal(day)), f'{minute // 60}:{minute % 60:02d}']
+
+def _process_log(filename, start, end, component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, use_mmap):
+    # the whole log, or the byte range start to end of it
+    # with use_mmap, uncompressed logs are memory mapped and scanned as bytes if the request parser can
+    # (scan_buffer) - it is off by default, a log that is truncated while it is mapped (copytruncate
+    # rotation of a live log) crashes the process, and reading the log as text is about as fast
+    _, ext = os.path.splitext(filename)
+    if use_mmap and filename != '-' and ext not in _COMPRESSED_OPENERS and hasattr(request_parser, 'scan_buffer'):
+        if os.path.getsize(filename) == 0:
+            # empty files can't be mapped
+            return
+        with _map_log(filename) as buffer:
+            requests = request_parser.scan_buffer(buffer, start or 0, len(buffer) if end is None else min(end, len(buffer)), filters, functools.partial(_skipped_lines.add, filename))
+            if _profiler is not None:
+                # lines are read and parsed together
+                requests = _profiler.iterate('read+parse', requests)
+            _process_requests(requests, component, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters)
+    elif start is None:
+        with _open_log(filename) as file:
+            _process_lines(file, component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, filename)
+    else:
+        _process_lines(_read_range(filename, start, end), component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, filename)
+
+@contextmanager
+def _map_log(filename):
+    # read only memory map of the log, pages are read by the OS as they are scanned rather than
+    # copied through a read buffer
+    # a log that is truncated while it is mapped can not be read past the new end (SIGBUS)
+    with open(filename, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+def _process_lines(lines, component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters=None, filename=None):
+    # lines that can not be parsed are counted in _skipped_lines under filename
+    line_filter = _line_filter(request_parser, filters)
+    if _profiler is not None:
+        lines = _profiler.iterate('read', lines)
+        request_parser = _profiler.timed('parse', request_parser)
+        if line_filter is not None:
+            line_filter = _profiler.timed('line filter', line_filter, rejects=True)
+    requests = _parse_lines(lines, request_parser, line_filter, functools.partial(_skipped_lines.add, filename))
+    _process_requests(requests, component, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters)
+
+def _parse_lines(lines, request_parser, line_filter, on_error):
+    # requests for the lines that pass line_filter, lines the request parser fails on are passed to on_error
+    for line in lines:
+        if line_filter is not None and not line_filter(line):
+            continue
+        try:
+            req = request_parser(line)
+        except Exception as e:
+            on_error(e, line)
+            continue
+        yield req
+
+def _process_requests(requests, component, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters=None):
+    store = inbound_http[component]
+    if _profiler is not None:
+        request_filter = _profiler.timed('request filter', request_filter, rejects=True)
+        if filters is not None:
+            filters = _profiler.wrap('filters', filters, ['matches'], rejects=True)
+        store = _profiler.wrap('aggregate', store, ['add'])
+    request_time = None
+    for req in requests:
+        if not request_filter(req) or (filters is not None and not filters.matches(req)):
+            continue
+        # consecutive requests usually share the same timestamp
+        if req.request_time is not request_time:
+            request_time = req.request_time
+            time_key = _time_key(request_time, time_bucket)
+            _process_times(request_time, component, times)
+        _process_performance(req, store, time_key, include_query, path_normalizer)
+
+def _line_filter(request_parser, filters):
+    # raw line check for the filters supplied by the request parser, None if there is nothing to check
+    if filters is None or not hasattr(request_parser, 'line_filter'):
+        return None
+    return request_parser.line_filter(filters)
+
+def _process_chunk(filename, start, end, component, request_parser, request_filter, time_bucket, include_query, quantile_estimator, path_normalizer, filters=None, use_mmap=False, profile=False, max_paths=None, kept_paths=()):
+    # runs in a worker process - returns the partial aggregates for the chunk to be merged by the parent,
+    # and the stage times of the chunk if profile is set
+    # kept_paths are the paths the parent had kept when the chunk was started, they are counted as they are
+    # and the chunk keeps new paths up to max_paths in the order it first sees them
+    global _profiler
+    times = {component: {}}
+    inbound_http = {component: _new_store(quantile_estimator, max_paths)}
+    inbound_http[component].reserve(kept_paths)
+    _skipped_query_params.update(count=0, example=None)
+    _skipped_lines.clear()
+    _profiler = profiling.Profiler() if profile else None
+    with _stage('process', filename):
+        _process_log(filename, start, end, component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, use_mmap)
+    return component, times, inbound_http, dict(_skipped_query_params), _skipped_lines, None if _profiler is None else _profiler.state()
+
+def _process_times(request_time, component, times):
+    if 'start' not in times[component] or times[component]['start'] > request_time:
+        times[component]['start'] = request_time
+    if 'end' not in times[component] or times[component]['end'] < request_time:
+        times[component]['end'] = request_time
+
+def _new_store(quantile_estimator, max_paths=None):
+    if quantile_estimator == QuantileEstimator.DDSKETCH:
+        return aggregate.AggregateStore(quantiles.DDSketch, max_paths)
+    return aggregate.AggregateStore(quantiles.ExactQuantiles, max_paths)
+
+def _process_performance(req, store, time_key, include_query, path_normalizer=None):
     # standardize the url
     url_key = req.path
+    if path_normalizer is not None:
+        url_key = path_normalizer(url_key)
     if include_query:
-        url_key = req.url
-    
-    # determine correct place to write data
-    # assume inbound for now
-    data = inbound_http[component]
+        url_key = req.url if path_normalizer is None else url_key + req.url[len(req.path):]
 
     # write it
-    root = _get_root(data, req, [url_key], time_bucket)
-    if req.http_method not in root:
-        root[req.http_method] = {}
-    root = root[req.http_method]
-    if 'count' not in root:
-        root['count'] = 1
-        if omit_duration:
-            root['duration'] = []
-        else:
-            root['duration'] = [req.duration]
-        root['response'] = {}
-        root['response'][req.http_response_code] = 1
+    # assume inbound for now
+    if req.duration is None:
+        store.add(url_key, time_key, req.http_method, req.http_response_code)
     else:
-        root['count'] += 1
-        if not omit_duration:
-            root['duration'].append(req.duration)
-        if req.http_response_code not in root['response']:
-            root['response'][req.http_response_code] = 1
-        else:
-            root['response'][req.http_response_code] += 1
+        store.add(url_key, time_key, req.http_method, req.http_response_code, req.duration)
+
+
+#
+# Component pipelines
+#
+
+def _run_pipelines(root_path, components, logs, ranges, component_parser, request_parser, request_filter, times, inbound_http, time_bucket, include_query, workers, quantile_estimator, path_normalizer, max_paths, filters, use_mmap, formats, time_buckets, keep, progress):
+    # each component is rendered as soon as its logs are processed, and its aggregate is then released
+    # unless keep is set (it is saved to the state file), so only the components in progress are in memory
+    # with more than one worker, chunks of the logs and component pages run in a pool of processes, at
+    # most workers at a time, so a component that is done is rendered before chunks that haven't started
+    # chunks are merged in log order whatever order they finish in, and at most workers chunks that finished
+    # early are held, so max_paths keeps the same paths as processing the logs in one process and bounds
+    # the memory of the chunks as well
+    order = sorted(components)
+    component_logs = {component: [] for component in order}
+    for filename in logs:
+        component_logs[component_parser(filename)].append(filename)
+
+    if workers <= 1:
+        for i, component in enumerate(order):
+            for filename in component_logs[component]:
+                with _stage('process', filename):
+                    _process_log(filename, *ranges[filename], component, request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, use_mmap)
+            with _stage('render', component):
+                _write_component(root_path, component, {'inbound': inbound_http[component]}, time_bucket, formats, time_buckets, times[component])
+            if not keep:
+                del inbound_http[component]
+            _progress(progress, component, f'rendered ({i + 1}/{len(order)} components)')
+        return
+
+    tasks = deque()
+    chunks = dict.fromkeys(order, 0)
+    for component in order:
+        for filename in component_logs[component]:
+            for start, end in _chunks(filename, workers, *ranges[filename]):
+                tasks.append((chunks[component], (filename, start, end, component, request_parser, request_filter, time_bucket, include_query, quantile_estimator, path_normalizer, filters, use_mmap, _profiler is not None, max_paths)))
+                chunks[component] += 1
+    merged = dict.fromkeys(order, 0)
+    # component -> chunk number -> result, of chunks that finished before a chunk ahead of them
+    finished_chunks = {component: {} for component in order}
+    # results in finished_chunks, no new chunk is started while workers of them are waiting
+    held = 0
+    renders = deque(component for component in order if chunks[component] == 0)
+    rendered = 0
+    # future -> (component, None, None, None) for renders, (component, chunk number, task, number of paths
+    # kept when it was started) for chunks
+    running = {}
+
+    def submit_chunk(position, task):
+        # the chunk counts the paths the component has kept so far as they are, if more are kept before it is
+        # merged and the chunk had to count some paths as other, it is processed again
+        kept_paths = () if max_paths is None else list(inbound_http[task[3]].urls)
+        running[executor.submit(_process_chunk, *task, kept_paths)] = (task[3], position, task, len(kept_paths))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(tasks) > 0 or len(renders) > 0 or len(running) > 0:
+            while len(running) < workers and (len(renders) > 0 or (len(tasks) > 0 and held < workers)):
+                if len(renders) > 0:
+                    component = renders.popleft()
+                    data = {'inbound': inbound_http[component] if keep else inbound_http.pop(component)}
+                    running[executor.submit(_write_component, root_path, component, data, time_bucket, formats, time_buckets, times[component])] = (component, None, None, None)
+                    del data
+                else:
+                    submit_chunk(*tasks.popleft())
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                component, position, task, kept = running.pop(future)
+                if position is None:
+                    future.result()
+                    rendered += 1
+                    _progress(progress, component, f'rendered ({rendered}/{len(order)} components)')
+                    continue
+                finished_chunks[component][position] = (future.result(), task, kept)
+                held += 1
+                while merged[component] in finished_chunks[component]:
+                    result, task, kept = finished_chunks[component].pop(merged[component])
+                    held -= 1
+                    _, partial_times, partial_inbound_http, skipped_query_params, skipped_lines, profile = result
+                    store = inbound_http[component]
+                    if max_paths is not None and aggregate.OTHER_URL in partial_inbound_http[component].urls and any(url != aggregate.OTHER_URL for url in store.urls[kept:]):
+                        submit_chunk(merged[component], task)
+                        break
+                    with _stage('merge'):
+                        for t in partial_times[component].values():
+                            _process_times(t, component, times)
+                        store.merge(partial_inbound_http[component])
+                    del partial_inbound_http, result
+                    if profile is not None:
+                        _profiler.merge(profile)
+                    _skipped_lines.merge(skipped_lines)
+                    _skipped_query_params['count'] += skipped_query_params['count']
+                    if _skipped_query_params['example'] is None:
+                        _skipped_query_params['example'] = skipped_query_params['example']
+                    merged[component] += 1
+                    _progress(progress, component, f'{merged[component]}/{chunks[component]} chunks processed')
+                if merged[component] == chunks[component]:
+                    renders.append(component)
+
+def _progress(progress, component, message):
+    if progress:
+        print(f'{component}: {message}', file=sys.stderr, flush=True)
+
+#
+# Following logs
+#
+
+# seconds to wait for new lines when all logs are idle
+_FOLLOW_POLL_INTERVAL = 0.5
+# bytes read from a log at a time
+_FOLLOW_READ_SIZE = 1024 * 1024
+
+def _follow(logs, request_parser, component_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, refresh_interval, write_report):
+    # runs until interrupted, or stdin is closed if that is the only log
+    followers = []
+    for filename in logs:
+        _, ext = os.path.splitext(filename)
+        if ext in _COMPRESSED_OPENERS:
+            raise Exception(f'compressed logs can not be followed - {filename}')
+        followers.append(_StdinFollower() if filename == '-' else _Follower(filename))
+    write_report()
+    next_refresh = time.monotonic() + refresh_interval
+    try:
+        while not all(follower.done for follower in followers):
+            idle = True
+            for follower in followers:
+                lines = follower.lines()
+                if len(lines) > 0:
+                    idle = False
+                    _process_lines(lines, component_parser(follower.filename), request_parser, request_filter, times, inbound_http, time_bucket, include_query, path_normalizer, filters, follower.filename)
+            if time.monotonic() >= next_refresh:
+                write_report()
+                next_refresh = time.monotonic() + refresh_interval
+            if idle:
+                time.sleep(_FOLLOW_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    # once more on exit, with the lines since the last refresh
+    write_report()
+
+class _Follower():
+    # returns lines appended to a log, like tail -F
+    # when the log is rotated the rest of the old file is read, then the new file from the start
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = False
+        self._file = None
+        self._id = None
+        self._partial = b''
+        self._encoding = locale.getpreferredencoding(False)
+        self._open(from_end=True)
+
+    def _open(self, from_end):
+        try:
+            file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+        if self._file is not None:
+            self._file.close()
+        stat = os.fstat(file.fileno())
+        if from_end:
+            file.seek(0, os.SEEK_END)
+        self._file = file
+        self._id = (stat.st_dev, stat.st_ino)
+        self._partial = b''
+
+    def lines(self):
+        # complete lines appended since the last call
+        if self._file is None:
+            self._open(from_end=False)
+            if self._file is None:
+                return []
+        data = self._file.read(_FOLLOW_READ_SIZE)
+        if not data:
+            try:
+                stat = os.stat(self.filename)
+            except FileNotFoundError:
+                # rotated, and the new log hasn't been created yet
+                return []
+            if (stat.st_dev, stat.st_ino) != self._id:
+                self._open(from_end=False)
+                data = self._file.read(_FOLLOW_READ_SIZE)
+            elif stat.st_size < self._file.tell():
+                warn(f'{self.filename} was truncated - following it from the start')
+                self._file.seek(0)
+                self._partial = b''
+                data = self._file.read(_FOLLOW_READ_SIZE)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        return [line.decode(self._encoding, 'replace') + '\n' for line in lines]
+
+class _StdinFollower():
+    # stdin blocks, so it is read on a background thread
+    def __init__(self):
+        self.filename = '-'
+        self.done = False
+        self._queue = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        _replace_errors(sys.stdin)
+        for line in sys.stdin:
+            self._queue.put(line)
+        self._queue.put(None)
+
+    def lines(self):
+        lines = []
+        while len(lines) < 10000:
+            try:
+                line = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                self.done = True
+                break
+            lines.append(line)
+        return lines
 
 
 #
 # Report Generation
 #
 
+def _write_report(root_path, components, times, inbound_http, time_bucket, workers=1, formats=(OutputFormat.HTML,), time_buckets=None):
+    # every page is written to a temporary file and renamed into place, so a partially written page is never visible
+    # with more than one worker, component pages are rendered concurrently in separate processes
+    _write_index(root_path, components, times, formats)
+    tasks = []
+    for component in sorted(components):
+        data = {label: d[component] for label, d in zip(['inbound'], [inbound_http])}
+        tasks.append((root_path, component, data, time_bucket, formats, time_buckets, times[component]))
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in as_completed([executor.submit(_write_component, *task) for task in tasks]):
+                future.result()
+    else:
+        for task in tasks:
+            _write_component(*task)
+
+def _write_index(root_path, components, times, formats=(OutputFormat.HTML,)):
+    _mkdir(root_path)
+    if OutputFormat.HTML in formats:
+        with _atomic_open(f'{root_path}/index.html') as index:
+            _init(index, times)
+            index.write('<table>\n<tr>\n<th>Component</th>\n</tr>\n')
+            for component in sorted(components):
+                index.write(f'<tr><td><a href="{component}/index.html">{component}</a></td></tr>\n')
+
+def _write_component(root_path, component, data, time_bucket, formats=(OutputFormat.HTML,), time_buckets=None, times=None):
+    # data is aggregated by time_bucket, each of time_buckets (only time_bucket if None) is rendered as its
+    # own table and export, the coarser ones rolled up from data
+    # a snapshot is only written of data, at time_bucket, with the start and end of times
+    if time_buckets is None:
+        time_buckets = [time_bucket]
+    _mkdir(f'{root_path}/{component}')
+    with _atomic_open(f'{root_path}/{component}/index.html') if OutputFormat.HTML in formats else nullcontext() as output:
+        if output is not None:
+            _init(output, component)
+        for label, store in data.items():
+            if OutputFormat.SNAPSHOT in formats:
+                _write_snapshot(f'{root_path}/{component}/{label}.snapshot', component, label, store, time_bucket, times or {})
+            for table_bucket in time_buckets:
+                table_store = store if table_bucket == time_bucket else _rollup(store, time_bucket, table_bucket)
+                name, header = label, label
+                if len(time_buckets) > 1:
+                    name, header = f'{label}_{table_bucket.value}', f'{label} {_ROLLUP_HEADERS[table_bucket]}'
+                for output_format in formats:
+                    if output_format in _EXPORTERS:
+                        _EXPORTERS[output_format](f'{root_path}/{component}/{name}.{output_format.value}', _export_rows(component, table_store, table_bucket))
+                if output is None or len(table_store) == 0:
+                    continue
+                no_bucket, by_day, by_hour, by_minute = _time_bucket_bools(table_bucket)
+                if no_bucket:
+                    table_headers = ['url', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
+                    mergeable_columns = 1
+                if by_day:
+                    table_headers = ['url', 'date', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
+                    mergeable_columns = 2
+                if by_hour:
+                    table_headers = ['url', 'date', 'hour', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
+                    mergeable_columns = 3
+                if by_minute:
+                    table_headers = ['url', 'date', 'minute', 'method', 'requests'] + _HTTP_RESPONSE_FIELDS + _PERCENTILE_FIELDS
+                    mergeable_columns = 3
+                data_handler = http_performance_data_handler
+                _write_table(output, _table_rows(table_store, table_bucket), header, table_headers, mergeable_columns, data_handler)
+
+# table headers of the rolled up tables when more than one time bucket is rendered
+_ROLLUP_HEADERS = {
+    TimeBucket.NONE: 'total',
+    TimeBucket.DAY: 'by day',
+    TimeBucket.HOUR: 'by hour',
+    TimeBucket.MINUTE: 'by minute',
+}
+
+def _rollup(store, time_bucket, target):
+    # store aggregated by time_bucket regrouped by the coarser target, the counts and duration summaries
+    # of the buckets that fall in the same target bucket are merged
+    if target == TimeBucket.NONE:
+        return store.regroup(lambda time_key: 0)
+    scale = _TIME_BUCKET_MINUTES[time_bucket]
+    target_scale = _TIME_BUCKET_MINUTES[target]
+    return store.regroup(lambda time_key: time_key * scale // target_scale)
+
+@contextmanager
+def _atomic_open(path, mode='w', **kwargs):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, mode, **kwargs) as file:
+            yield file
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
 def _init(html, times, header=None):
     html.write('<html>\n<link rel="stylesheet" href="https://unpkg.com/mvp.css">\n')
     html.write('<style>\ntable {\noverflow-x: visible;\n}\n')
@@ -258,14 +1070,13 @@ def _table_header(html_file, column_labels):
         html_file.write(f'<th>{column_label}</th>\n')
     html_file.write('</tr>\n')
 
-def _table_row(html_file, data, rowspan=None):
-    if rowspan is None:
-        rowspan = []
-    html_file.write('<tr>\n')
+def _table_row_html(data, rowspan):
+    # rowspan applies to the first cells of the row
+    cells = ['<tr>\n']
     for index, d in enumerate(data):
         rowspan_html = ''
-        if len(rowspan) > 0:
-            rowspan_html = f' class="merged-cell" rowspan="{rowspan.pop(0)}"'
+        if index < len(rowspan):
+            rowspan_html = f' class="merged-cell" rowspan="{rowspan[index]}"'
         if isinstance(d, str) and len(d) > 80:
             full = d
             while len(d) > 80:
@@ -275,104 +1086,255 @@ def _table_row(html_file, data, rowspan=None):
                 else:
                     d = d[-79:]
                     preslash = ''
-            html_file.write(f'<td{rowspan_html} title="full">...{preslash}{str(d).replace("<", "&lt;").replace(">", "&gt;")}</td>\n')
+            cells.append(f'<td{rowspan_html} title="full">...{preslash}{str(d).replace("<", "&lt;").replace(">", "&gt;")}</td>\n')
         else:
-            html_file.write(f'<td{rowspan_html}>{str(d).replace("<", "&lt;").replace(">", "&gt;")}</td>\n')
-    html_file.write('</tr>\n')
+            cells.append(f'<td{rowspan_html}>{str(d).replace("<", "&lt;").replace(">", "&gt;")}</td>\n')
+    cells.append('</tr>\n')
+    return ''.join(cells)
 
 def _parse(root):
     http_responses = []
-    for field in _HTTP_RESPONSE_FIELDS:
-        f = field
-        if field == 'No Response':
-            f = '0'
-        if f in root['response']:
-            http_responses.append(f'{round((root["response"][f] / root["count"]) * 100)}% ({root["response"][f]})')
+    for count in root.responses():
+        if count > 0:
+            http_responses.append(f'{round((count / root.count) * 100)}% ({count})')
         else:
             http_responses.append('-')
-    durations = root['duration']
-    durations.sort()
-
-    p50 = '-'
-    p75 = '-'
-    p90 = '-'
-    p99 = '-'
-    if len(durations) > 0:
-        p50 = f'{durations[round((len(durations) - 1) / 2)]}ms'
-    if len(durations) > 2:
-        p75 = f'{durations[round(3 * (len(durations) - 1) / 4)]}ms'
-    if len(durations) > 4:
-        p90 = f'{durations[round(9 * (len(durations) - 1) / 10)]}ms'
-    if len(durations) > 10:
-        p99 = f'{durations[round(99 * (len(durations) - 1) / 100)]}ms'
-    return http_responses, [p50, p75, p90, p99]
-
-def _get_merged_size(data, target_depth, depth=1):
-    if depth == target_depth:
-        return len(data)
-    size = 0
-    for key in data:
-        size += _get_merged_size(data[key], target_depth, depth + 1)
-    return size
-
-def _write_table(html_file, data, header, table_headers, mergeable_columns, data_handler):
+    percentiles = [f'{d}ms' if d is not None else '-' for d in _percentiles(root.duration)]
+    return http_responses, percentiles
+
+def _percentiles(durations):
+    # p50, p75, p90, p99 - a percentile is only given once there are enough durations for it to be meaningful
+    n = len(durations)
+    ranks = [round((n - 1) / 2), round(3 * (n - 1) / 4), round(9 * (n - 1) / 10), round(99 * (n - 1) / 100)]
+    ranks = [rank for rank, minimum in zip(ranks, [0, 2, 4, 10]) if n > minimum]
+    percentiles = durations.ranked(ranks)
+    return percentiles + [None] * (4 - len(percentiles))
+
+def _table_rows(store, time_bucket):
+    # (columns, bucket) sorted by url, time and method
+    for url, time_key, method, bucket in store.rows():
+        yield [url] + _time_columns(time_key, time_bucket) + [method], bucket
+
+# rows rendered between writes to the file
+_WRITE_BATCH_ROWS = 4096
+
+def _write_table(html_file, rows, header, table_headers, mergeable_columns, data_handler):
+    # the first mergeable_columns columns are merged across consecutive rows with the same values
     html_file.write(f'<h2>{header}</h2>\n')
     _table_header(html_file, table_headers)
-    merged_index = 0
-    current = data
-    merge_count = []
-    iterators = []
-    values = []
-    data_row = []
-    while True:
-        # get the mergeable parts
-        while len(iterators) < mergeable_columns + 1:
-            iterators.append(iter(sorted(current)))
-            values.append(next(iterators[-1]))
-            if len(iterators) < mergeable_columns:
-                merge_count.append(_get_merged_size(current[values[-1]], target_depth=mergeable_columns, depth=len(merge_count) + 1))
-            else:
-                merge_count.append(1)
-            data_row.append(values[-1])
-            current = current[values[-1]]
-        
-        # fill in the rest of the data row
-        data_row += data_handler(current)
-
-        # print it
-        _table_row(html_file, data_row, rowspan=[x for x in merge_count[merged_index:-1] if x > 1])
-
-        # clean up
-        merge_count = [x - 1 for x in merge_count]
-        while merge_count[-1] == 0 and (len(merge_count) > 1 and merge_count[-2] == 0):
-            merge_count.pop()
-            iterators.pop()
-            values.pop()
-        
-        # setup for next data row
-        data_row = []
-        current = data
-        merge_count.pop()
-        merged_index = len(merge_count)
-        values.pop()
-        try:
-            values.append(next(iterators[-1]))
-        except StopIteration:
-            # we're done
-            break
-        for value in values:
-            current = current[value]
-        if len(iterators) <= mergeable_columns:
-            merge_count.append(_get_merged_size(current, target_depth=mergeable_columns, depth=len(merge_count) + 1))
-        else:
-            merge_count.append(1)
-        data_row.append(values[-1])
-    
+    rows = list(rows)
+    buffer = []
+    for (columns, root), spans in zip(rows, _merged_spans(rows, mergeable_columns)):
+        # merged cells started by an earlier row are left out
+        data_row = columns[mergeable_columns - len(spans):] + data_handler(root)
+        buffer.append(_table_row_html(data_row, [x for x in spans if x > 1]))
+        if len(buffer) >= _WRITE_BATCH_ROWS:
+            html_file.write(''.join(buffer))
+            buffer = []
+    html_file.write(''.join(buffer))
     html_file.write('</table></br>\n')
 
+def _merged_spans(rows, mergeable_columns):
+    # rowspans of the merged cells each row starts, in a single bottom-up pass
+    # a row starts a merged cell in every mergeable column from the first one that differs from the row above
+    spans = [None] * len(rows)
+    counts = [0] * mergeable_columns
+    for i in range(len(rows) - 1, -1, -1):
+        columns = rows[i][0]
+        first = 0
+        if i > 0:
+            previous = rows[i - 1][0]
+            while first < mergeable_columns and previous[first] == columns[first]:
+                first += 1
+        for c in range(mergeable_columns):
+            counts[c] += 1
+        spans[i] = counts[first:]
+        counts = counts[:first] + [0] * (mergeable_columns - first)
+    return spans
+
+#
+# Export
+#
+
+_EXPORT_FIELDS = ['component', 'url', 'bucket', 'method', 'requests', '2xx', '4xx', '5xx', 'no_response', 'other', 'p50', 'p75', 'p90', 'p99']
+
+# rows per parquet row group
+_PARQUET_BATCH_ROWS = 65536
+
+def _export_rows(component, store, time_bucket):
+    # rows are produced one at a time as they are written
+    for url, time_key, method, bucket in store.rows():
+        yield [component, url, _bucket_start(time_key, time_bucket), method, bucket.count] + bucket.responses() + _percentiles(bucket.duration)
+
+def _bucket_start(time_key, time_bucket):
+    # ISO 8601 start of the time bucket, None without time buckets
+    if time_bucket == TimeBucket.NONE:
+        return None
+    if time_bucket == TimeBucket.DAY:
+        return datetime.date.fromordinal(time_key).isoformat()
+    if time_bucket == TimeBucket.HOUR:
+        day, hour = divmod(time_key, 24)
+        return f'{datetime.date.fromordinal(day).isoformat()}T{hour:02d}:00'
+    day, minute = divmod(time_key, 24 * 60)
+    return f'{datetime.date.fromordinal(day).isoformat()}T{minute // 60:02d}:{minute % 60:02d}'
+
+def _write_csv(path, rows, fields=_EXPORT_FIELDS):
+    with _atomic_open(path, newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+
+def _write_jsonl(path, rows, fields=_EXPORT_FIELDS):
+    with _atomic_open(path) as file:
+        for row in rows:
+            file.write(json.dumps(dict(zip(fields, row))))
+            file.write('\n')
+
+def _write_parquet(path, rows):
+    pa, pq = _import_pyarrow()
+    types = [pa.string()] * 4 + [pa.int64()] * 6 + [pa.float64()] * 4
+    schema = pa.schema(list(zip(_EXPORT_FIELDS, types)))
+    with _atomic_open(path, 'wb') as file:
+        with pq.ParquetWriter(file, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= _PARQUET_BATCH_ROWS:
+                    writer.write_table(pa.Table.from_pylist([dict(zip(_EXPORT_FIELDS, r)) for r in batch], schema=schema))
+                    batch = []
+            if len(batch) > 0:
+                writer.write_table(pa.Table.from_pylist([dict(zip(_EXPORT_FIELDS, r)) for r in batch], schema=schema))
+
+def _import_pyarrow():
+    # parquet export is optional and needs pyarrow
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('parquet output requires pyarrow - pip install pyarrow')
+    return pyarrow, pyarrow.parquet
+
+def _write_snapshot(path, component, label, store, time_bucket, times):
+    with _atomic_open(path, 'wb') as file:
+        snapshot.write(file, component, label, store, time_bucket.value, times.get('start'), times.get('end'))
+
+_EXPORTERS = {
+    OutputFormat.CSV: _write_csv,
+    OutputFormat.JSONL: _write_jsonl,
+    OutputFormat.PARQUET: _write_parquet,
+}
+
 def http_performance_data_handler(root):
     http_responses, percentiles = _parse(root)
-    return [root['count']] + http_responses + percentiles
+    return [root.count] + http_responses + percentiles
 
 def other_data_handler(root):
-    return [root['count']]
\ No newline at end of file
+    return [root.count]
+#
+# Comparing snapshots
+#
+
+_COMPARE_FIELDS = ['component', 'url', 'method', 'baseline_requests', 'requests', 'baseline_p90', 'p90', 'baseline_p99', 'p99', 'baseline_5xx_rate', '5xx_rate', 'impact']
+
+_COMPARE_HEADERS = ['component', 'url', 'method', 'requests', '90p', '99p', '5XX', 'impact']
+
+def compare_snapshots(baseline, current, p90_change=20, p99_change=20, error_rate_change=1, min_requests=20, formats=(OutputFormat.HTML,), root_path='compare'):
+    # renders the endpoints (url and method) whose p90 or p99 changed by more than p90_change or p99_change
+    # percent, or whose 5XX rate changed by more than error_rate_change percentage points, from baseline to
+    # current - each is a snapshot written with --format snapshot or a report directory holding them
+    # an endpoint is compared over the whole time of each snapshot, if it has at least min_requests requests in both
+    # impact is the largest change relative to its threshold times the requests in current, negative for
+    # improvements, and the endpoints are sorted by it with regressions first
+    # returns the rows written and the number of endpoints compared
+    for output_format in formats:
+        if output_format not in [OutputFormat.HTML, OutputFormat.CSV, OutputFormat.JSONL]:
+            raise Exception(f'{output_format.value} output is not supported when comparing snapshots')
+    thresholds = [p90_change, p99_change, error_rate_change]
+    if min(thresholds) <= 0:
+        raise ValueError(f'thresholds must be positive - p90->{p90_change} p99->{p99_change} 5XX->{error_rate_change}')
+    baseline_snapshots = _load_snapshots(baseline)
+    current_snapshots = _load_snapshots(current)
+
+    rows = []
+    compared = 0
+    for key in sorted(baseline_snapshots.keys() & current_snapshots.keys()):
+        before = _endpoints(baseline_snapshots[key].store)
+        after = _endpoints(current_snapshots[key].store)
+        for url, method in sorted(before.keys() & after.keys()):
+            b, a = before[url, method], after[url, method]
+            if b[0] < min_requests or a[0] < min_requests:
+                continue
+            compared += 1
+            changes = [_relative_change(b[1], a[1]), _relative_change(b[2], a[2]), (a[3] - b[3]) * 100]
+            ratios = [change / threshold for change, threshold in zip(changes, thresholds) if change is not None]
+            if len(ratios) == 0:
+                continue
+            ratio = max(ratios, key=abs)
+            if abs(ratio) < 1:
+                continue
+            rows.append([key[0], url, method, b[0], a[0], b[1], a[1], b[2], a[2], b[3], a[3], round(ratio * a[0], 1)])
+    rows.sort(key=lambda row: (row[-1] < 0, -abs(row[-1])))
+
+    _mkdir(root_path)
+    if OutputFormat.HTML in formats:
+        with _atomic_open(f'{root_path}/index.html') as output:
+            _init(output, None)
+            output.write('<h1>Comparison</h1>\n<p>\n')
+            for name, path, snapshots in [('baseline', baseline, baseline_snapshots), ('current', current, current_snapshots)]:
+                output.write(f'{name}: {path}{_snapshot_times(snapshots)}<br>\n')
+            output.write(f'{compared} endpoints with at least {min_requests} requests in both, {len(rows)} with a change of more than {p90_change}% in 90p, {p99_change}% in 99p or {error_rate_change} points in 5XX rate\n</p>\n')
+            for header, selected in [('regressions', [row for row in rows if row[-1] > 0]), ('improvements', [row for row in rows if row[-1] < 0])]:
+                if len(selected) > 0:
+                    _write_table(output, ((row[:3], row) for row in selected), header, _COMPARE_HEADERS, 1, _compare_data_handler)
+    for output_format in formats:
+        if output_format in _EXPORTERS:
+            _EXPORTERS[output_format](f'{root_path}/compare.{output_format.value}', rows, _COMPARE_FIELDS)
+    return rows, compared
+
+def _load_snapshots(path):
+    # (component, label) -> Snapshot, of a snapshot file or of the component directories of a report
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(glob.escape(path), '*', '*.snapshot')))
+        if len(paths) == 0:
+            raise Exception(f'no snapshots in {path} - reports write them with --format snapshot')
+    else:
+        paths = [path]
+    snapshots = {}
+    for p in paths:
+        with open(p, 'rb') as file:
+            s = snapshot.read(file)
+        snapshots[s.component, s.label] = s
+    return snapshots
+
+def _endpoints(store):
+    # (url, method) -> (requests, p90, p99, 5XX rate) over all time buckets
+    endpoints = {}
+    for url, _, method, bucket in store.regroup(lambda time_key: 0).items():
+        _, _, p90, p99 = _percentiles(bucket.duration)
+        endpoints[url, method] = (bucket.count, p90, p99, bucket.server_error / bucket.count)
+    return endpoints
+
+def _relative_change(before, after):
+    # percent, None if it can not be told
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before * 100
+
+def _snapshot_times(snapshots):
+    starts = [s.start for s in snapshots.values() if s.start is not None]
+    ends = [s.end for s in snapshots.values() if s.end is not None]
+    if len(starts) == 0 or len(ends) == 0:
+        return ''
+    return f' ({min(starts).strftime("%Y-%m-%d %H:%M:%S")} to {max(ends).strftime("%Y-%m-%d %H:%M:%S")} UTC)'
+
+def _compare_data_handler(row):
+    _, _, _, before_requests, requests, before_p90, p90, before_p99, p99, before_rate, rate, impact = row
+    return [f'{before_requests} -> {requests}', _change_cell(before_p90, p90), _change_cell(before_p99, p99), f'{before_rate * 100:.1f}% -> {rate * 100:.1f}% ({(rate - before_rate) * 100:+.1f})', impact]
+
+def _change_cell(before, after):
+    change = _relative_change(before, after)
+    before, after = ['-' if d is None else f'{d}ms' for d in [before, after]]
+    if change is None:
+        return f'{before} -> {after}'
+    return f'{before} -> {after} ({change:+.0f}%)'
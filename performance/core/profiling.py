@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import json
+import os
+import resource
+import time
+
+# Stage timing for report runs (--profile). The engine only times its stages when a Profiler is passed
+# to performance_report, so a normal run does not pay for it.
+
+# order of the stages in the summary, per line stages first
+_STAGE_ORDER = ['read', 'line filter', 'parse', 'read+parse', 'request filter', 'filters', 'aggregate', 'load state', 'seek', 'process', 'merge', 'render', 'save state']
+
+class Profiler():
+    # wall time, CPU time and counts per stage of a report run
+    # stages run once per line (read, parse, filters, aggregate) are timed around every call and only have
+    # wall time - reading the CPU clock for every line would cost more than most of the stages, and the
+    # timing itself adds to them, so they are best compared to each other rather than to an unprofiled run
+    # coarse stages (seek, process, merge, render, state) have CPU time too, and are kept as spans for a
+    # Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    def __init__(self):
+        # name -> [wall seconds, CPU seconds or None, count, rejected]
+        self.stages = {}
+        self.spans = []
+        self._start = time.perf_counter()
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0.0, None, 0, 0]
+        return stage
+
+    @contextmanager
+    def stage(self, name, detail=None):
+        # times a coarse stage, detail (e.g. the log) is shown on its span in the trace
+        stage = self._stage(name)
+        ts = time.time()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+            stage[0] += wall
+            stage[1] = (stage[1] or 0.0) + cpu
+            stage[2] += 1
+            span = {'name': name, 'ph': 'X', 'ts': ts * 1e6, 'dur': wall * 1e6, 'pid': os.getpid(), 'tid': 0}
+            if detail is not None:
+                span['args'] = {'detail': str(detail)}
+            self.spans.append(span)
+
+    def iterate(self, name, items):
+        # items, with the time taken to produce each one added to the stage
+        stage = self._stage(name)
+        clock = time.perf_counter
+        items = iter(items)
+        while True:
+            t = clock()
+            try:
+                item = next(items)
+            except StopIteration:
+                stage[0] += clock() - t
+                return
+            stage[0] += clock() - t
+            stage[2] += 1
+            yield item
+
+    def timed(self, name, function, rejects=False):
+        # function, with each call added to the stage - if rejects is set, false results are counted as rejected
+        stage = self._stage(name)
+        clock = time.perf_counter
+        def timed_function(*args):
+            t = clock()
+            result = function(*args)
+            stage[0] += clock() - t
+            stage[2] += 1
+            if rejects and not result:
+                stage[3] += 1
+            return result
+        return timed_function
+
+    def wrap(self, name, obj, methods, rejects=False):
+        # stands in for obj with calls to methods added to the stage
+        return _Timed(obj, {method: self.timed(name, getattr(obj, method), rejects) for method in methods})
+
+    def state(self):
+        # picklable stages and spans of a worker process, for merge
+        return {'stages': self.stages, 'spans': self.spans}
+
+    def merge(self, state):
+        # stage times of worker processes are added up, so they can be more than the wall time of the run
+        for name, (wall, cpu, count, rejected) in state['stages'].items():
+            stage = self._stage(name)
+            stage[0] += wall
+            if cpu is not None:
+                stage[1] = (stage[1] or 0.0) + cpu
+            stage[2] += count
+            stage[3] += rejected
+        self.spans.extend(state['spans'])
+
+    def summary(self):
+        # text table of the stages, throughput and peak memory
+        elapsed = time.perf_counter() - self._start
+        lines = [f'{"stage":<16}{"wall s":>10}{"cpu s":>10}{"count":>12}{"rejected":>12}{"us/call":>14}']
+        order = {name: i for i, name in enumerate(_STAGE_ORDER)}
+        for name in sorted(self.stages, key=lambda name: order.get(name, len(order))):
+            wall, cpu, count, rejected = self.stages[name]
+            if count == 0:
+                continue
+            cpu = '-' if cpu is None else f'{cpu:.3f}'
+            lines.append(f'{name:<16}{wall:>10.3f}{cpu:>10}{count:>12}{rejected:>12}{wall / count * 1e6:>14.2f}')
+        # lines are read and parsed together when a log is memory mapped
+        read = max(self.stages.get(name, [0, 0, 0])[2] for name in ['read', 'read+parse', 'parse'])
+        process = self.stages.get('process', [elapsed])[0]
+        skipped = sum(stage[3] for stage in self.stages.values())
+        lines.append(f'total {elapsed:.3f}s - {read} lines, {read / process if process > 0 else 0:,.0f} lines/s while processing, {skipped} skipped by filters')
+        lines.append(f'peak memory {_peak_rss_kib(resource.RUSAGE_SELF) / 1024:.1f} MiB, workers {_peak_rss_kib(resource.RUSAGE_CHILDREN) / 1024:.1f} MiB')
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        # Chrome trace event format, spans of worker processes are shown under their pid
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.spans, 'displayTimeUnit': 'ms'}, file)
+
+class _Timed():
+    # forwards everything but the timed methods to the wrapped object
+    def __init__(self, obj, methods):
+        self._obj = obj
+        self.__dict__.update(methods)
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+def _peak_rss_kib(who):
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss // 1024 if os.uname().sysname == 'Darwin' else rss
@@ -0,0 +1,127 @@
+import math
+
+# Duration summaries used for the percentile columns of the report.
+# Both implementations support add(value), add_all(values), merge(other), len() and ranked(ranks) so they can be
+# swapped without changing the aggregation, and both can be merged across buckets and workers.
+
+class ExactQuantiles():
+    # keeps every value - memory grows with the number of requests, but the percentiles are exact
+    __slots__ = ('_values', '_sorted')
+
+    def __init__(self):
+        self._values = []
+        self._sorted = True
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        self._values.append(value)
+        self._sorted = False
+
+    def add_all(self, values):
+        self._values += values
+        self._sorted = False
+
+    def merge(self, other):
+        self._values += other._values
+        self._sorted = False
+
+    def ranked(self, ranks):
+        # values at the given positions in sorted order
+        if not self._sorted:
+            self._values.sort()
+            self._sorted = True
+        return [self._values[rank] for rank in ranks]
+
+class DDSketch():
+    # DDSketch (Masson, Rim, Lee - VLDB 2019)
+    # values are counted in logarithmic bins, bin i holds values in (gamma^(i-1), gamma^i] where
+    # gamma = (1 + relative_accuracy) / (1 - relative_accuracy), and a bin is reported as
+    # 2 * gamma^i / (gamma + 1), which is within relative_accuracy of every value in the bin.
+    # So any quantile is reported within relative_accuracy (default 1%) of the exact value of that rank.
+    # With 1% accuracy, 1ms to 1 hour needs ~760 bins, so memory per bucket is bounded by max_bins
+    # regardless of the number of requests. If max_bins is exceeded the lowest bins are collapsed
+    # together, which only loses accuracy for the lowest quantiles.
+    __slots__ = ('relative_accuracy', 'max_bins', '_log_gamma', '_bins', '_zero_count', '_count')
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self._bins = {}
+        self._zero_count = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        self._count += 1
+        if value <= 0:
+            self._zero_count += 1
+            return
+        i = math.ceil(math.log(value) / self._log_gamma)
+        bins = self._bins
+        if i in bins:
+            bins[i] += 1
+        else:
+            bins[i] = 1
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def add_all(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other._log_gamma != self._log_gamma:
+            raise ValueError('can not merge sketches with different relative accuracy')
+        self._count += other._count
+        self._zero_count += other._zero_count
+        for i, count in other._bins.items():
+            self._bins[i] = self._bins.get(i, 0) + count
+        if len(self._bins) > self.max_bins:
+            self._collapse()
+
+    def ranked(self, ranks):
+        # estimated values at the given positions in sorted order, ranks must be ascending
+        result = []
+        bins = sorted(self._bins.items())
+        b = 0
+        seen = self._zero_count
+        for rank in ranks:
+            while seen <= rank and b < len(bins):
+                seen += bins[b][1]
+                b += 1
+            if b == 0:
+                result.append(0)
+            else:
+                result.append(_significant(2 * math.exp(bins[b - 1][0] * self._log_gamma) / (1 + math.exp(self._log_gamma))))
+        return result
+
+    def bins(self):
+        # count of zero values and (bin, count) in bin order, e.g. to save the sketch
+        return self._zero_count, sorted(self._bins.items())
+
+    def add_bins(self, zero_count, bins):
+        # adds the counts from bins() of a sketch with the same relative accuracy
+        self._count += zero_count
+        self._zero_count += zero_count
+        for i, count in bins:
+            self._count += count
+            self._bins[i] = self._bins.get(i, 0) + count
+        if len(self._bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        indexes = sorted(self._bins)
+        excess = indexes[:len(indexes) - self.max_bins]
+        target = indexes[len(excess)]
+        for i in excess:
+            self._bins[target] += self._bins.pop(i)
+
+def _significant(value):
+    # the sketch is accurate to ~1%, so don't report more than 4 significant digits
+    value = float(f'{value:.4g}')
+    return int(value) if value.is_integer() else value
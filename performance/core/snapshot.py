@@ -0,0 +1,106 @@
+import datetime
+import gzip
+import json
+import struct
+from core import aggregate
+from core import quantiles
+
+# Compact binary snapshot of the aggregate of one component (--format snapshot), so runs can be compared
+# later without reading the logs again.
+# After a magic number and version, a JSON header holds the component, time bucket, log times, urls and
+# methods, followed by one record per bucket with its response counts and its durations as DDSketch bins.
+# Exact durations are turned into a sketch when the snapshot is written, so a snapshot does not grow with
+# the number of requests, and percentiles read from it are within relative_accuracy of the exact value.
+# The whole file is gzip compressed.
+
+_MAGIC = b'PERFSNAP'
+# bumped when the layout changes, older snapshots can not be read
+_VERSION = 1
+
+_PREFIX = struct.Struct('<8sHI')
+# url id, time key, method id, response counts in RESPONSE_FIELDS order, zero durations, number of bins
+_BUCKET = struct.Struct('<IIH5QQI')
+# sketch bin index and count
+_BIN = struct.Struct('<iQ')
+
+# records are written to the file in batches of this many
+_WRITE_BATCH = 4096
+
+class Snapshot():
+    # store holds DDSketch durations, start and end are the first and last request time (None if unknown)
+    __slots__ = ('component', 'label', 'time_bucket', 'start', 'end', 'store')
+
+    def __init__(self, component, label, time_bucket, start, end, store):
+        self.component = component
+        self.label = label
+        self.time_bucket = time_bucket
+        self.start = start
+        self.end = end
+        self.store = store
+
+def write(file, component, label, store, time_bucket, start=None, end=None, relative_accuracy=0.01):
+    # file is opened for binary writing, time_bucket is the value of the TimeBucket the store is aggregated by
+    rows = list(store.items())
+    header = {
+        'component': component,
+        'label': label,
+        'time_bucket': time_bucket,
+        'start': None if start is None else start.isoformat(),
+        'end': None if end is None else end.isoformat(),
+        'relative_accuracy': relative_accuracy,
+        'urls': store.urls,
+        'methods': store.methods,
+        'buckets': len(rows),
+    }
+    url_ids = {url: i for i, url in enumerate(store.urls)}
+    method_ids = {method: i for i, method in enumerate(store.methods)}
+    # past level 6 compression gets much slower for little gain on these records
+    with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=6, mtime=0) as output:
+        encoded = json.dumps(header).encode()
+        output.write(_PREFIX.pack(_MAGIC, _VERSION, len(encoded)))
+        output.write(encoded)
+        buffer = []
+        for url, time_key, method, bucket in rows:
+            zero_count, bins = _sketch(bucket.duration, relative_accuracy).bins()
+            buffer.append(_BUCKET.pack(url_ids[url], time_key, method_ids[method], *bucket.responses(), zero_count, len(bins)))
+            buffer.extend(_BIN.pack(i, count) for i, count in bins)
+            if len(buffer) >= _WRITE_BATCH:
+                output.write(b''.join(buffer))
+                buffer = []
+        output.write(b''.join(buffer))
+
+def read(file):
+    # Snapshot from a file opened for binary reading
+    with gzip.GzipFile(fileobj=file, mode='rb') as source:
+        data = source.read()
+    magic, version, length = _PREFIX.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('not a snapshot')
+    if version != _VERSION:
+        raise ValueError(f'snapshot version {version} is not supported - expected {_VERSION}')
+    offset = _PREFIX.size
+    header = json.loads(data[offset:offset + length])
+    offset += length
+    relative_accuracy = header['relative_accuracy']
+    urls = header['urls']
+    methods = header['methods']
+    store = aggregate.AggregateStore(lambda: quantiles.DDSketch(relative_accuracy))
+    for _ in range(header['buckets']):
+        url_id, time_key, method_id, *responses, zero_count, count = _BUCKET.unpack_from(data, offset)
+        offset += _BUCKET.size
+        bins = [_BIN.unpack_from(data, offset + i * _BIN.size) for i in range(count)]
+        offset += count * _BIN.size
+        bucket = store.bucket(urls[url_id], time_key, methods[method_id])
+        bucket.add_many(responses)
+        bucket.duration.add_bins(zero_count, bins)
+    start, end = (None if t is None else datetime.datetime.fromisoformat(t) for t in [header['start'], header['end']])
+    return Snapshot(header['component'], header['label'], header['time_bucket'], start, end, store)
+
+def _sketch(durations, relative_accuracy):
+    if isinstance(durations, quantiles.DDSketch):
+        if durations.relative_accuracy != relative_accuracy:
+            raise ValueError(f'sketch has relative accuracy {durations.relative_accuracy} - expected {relative_accuracy}')
+        return durations
+    sketch = quantiles.DDSketch(relative_accuracy)
+    sketch.add_all(durations.ranked(range(len(durations))))
+    return sketch
@@ -0,0 +1,129 @@
+import argparse
+import datetime
+import gzip
+import itertools
+import math
+import random
+import sys
+from apache import LOG_FORMAT
+
+# Deterministic synthetic access logs in LOG_FORMAT for benchmarks - the same options and seed always
+# give the same log, so results can be compared between versions.
+
+def weights(value):
+    # "200:90,404:5,500:5" -> (['200', '404', '500'], [90.0, 5.0, 5.0])
+    items = []
+    for item in value.split(','):
+        key, sep, weight = item.rpartition(':')
+        if not sep or not key:
+            raise ValueError(f'weights must be in the format VALUE:WEIGHT,... - item->"{item}"')
+        items.append((key, float(weight)))
+    return [k for k, _ in items], [w for _, w in items]
+
+def duration(value):
+    # "lognormal:MEDIAN:SIGMA" or "uniform:LOW:HIGH", in milliseconds
+    kind, sep, rest = value.partition(':')
+    a, sep2, b = rest.partition(':')
+    if kind not in ['lognormal', 'uniform'] or not sep or not sep2:
+        raise ValueError(f'duration must be lognormal:MEDIAN:SIGMA or uniform:LOW:HIGH - duration->"{value}"')
+    return kind, float(a), float(b)
+
+class SyntheticLog():
+    # iterates the lines of a synthetic log
+    # urls: number of distinct paths, chosen with a Zipf distribution with exponent skew (0 is uniform)
+    # query_fraction: fraction of requests with a query string
+    # statuses, methods: (values, weights) as returned by weights()
+    # durations: (kind, a, b) as returned by duration()
+    # span: seconds between the first and the last request, requests are spread evenly and in order
+    def __init__(self, lines=100000, urls=100, skew=1.0, query_fraction=0.2, statuses=None, methods=None, durations=('lognormal', 100, 1.0), span=24 * 3600, start=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc), seed=0):
+        self.lines = lines
+        self.urls = urls
+        self.skew = skew
+        self.query_fraction = query_fraction
+        self.statuses = statuses if statuses is not None else weights('200:85,201:5,302:2,404:5,500:2,503:0.5,0:0.5')
+        self.methods = methods if methods is not None else weights('GET:80,POST:12,PUT:5,DELETE:3')
+        self.durations = durations
+        self.span = span
+        self.start = start
+        self.seed = seed
+
+    def options(self):
+        # json serializable description of the log
+        return {
+            'lines': self.lines,
+            'urls': self.urls,
+            'skew': self.skew,
+            'query_fraction': self.query_fraction,
+            'statuses': dict(zip(*self.statuses)),
+            'methods': dict(zip(*self.methods)),
+            'durations': list(self.durations),
+            'span': self.span,
+            'start': self.start.isoformat(),
+            'seed': self.seed,
+        }
+
+    def paths(self):
+        # the distinct paths, most frequent first
+        sections = ['api', 'static', 'account', 'search', 'admin']
+        return [f'/{sections[i % len(sections)]}/resource{i}' for i in range(self.urls)]
+
+    def __iter__(self):
+        rand = random.Random(self.seed)
+        paths = self.paths()
+        path_weights = list(itertools.accumulate(1 / (rank + 1) ** self.skew for rank in range(self.urls)))
+        status_weights = list(itertools.accumulate(self.statuses[1]))
+        method_weights = list(itertools.accumulate(self.methods[1]))
+        kind, a, b = self.durations
+        mu = math.log(a) if kind == 'lognormal' else 0
+        timestamp = None
+        second = None
+        for i in range(self.lines):
+            s = self.span * i // self.lines if self.lines > 0 else 0
+            if s != second:
+                second = s
+                timestamp = (self.start + datetime.timedelta(seconds=s)).strftime('%d/%b/%Y:%H:%M:%S %z')
+            path = rand.choices(paths, cum_weights=path_weights)[0]
+            if rand.random() < self.query_fraction:
+                path += f'?id={rand.randint(1, 100000)}'
+            method = rand.choices(self.methods[0], cum_weights=method_weights)[0]
+            status = rand.choices(self.statuses[0], cum_weights=status_weights)[0]
+            if kind == 'lognormal':
+                d = rand.lognormvariate(mu, b)
+            else:
+                d = rand.uniform(a, b)
+            yield (f'10.{i % 7}.{i % 251}.{i % 241} - - [{timestamp}] "{method} {path} HTTP/1.1" {status} {rand.randint(100, 50000)} '
+                   f'"-" "synthetic" X {max(1, round(d))}\n')
+
+    def write(self, filename):
+        # .gz logs are compressed, - writes to stdout
+        if filename == '-':
+            sys.stdout.writelines(self)
+            return
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'wt') as file:
+            file.writelines(self)
+
+def add_arguments(parser):
+    # options of the generator, shared with the benchmarks
+    parser.add_argument('--lines', type=int, help='Number of lines')
+    parser.add_argument('--urls', type=int, help='Number of distinct paths')
+    parser.add_argument('--skew', type=float, help='Zipf exponent of the path popularity, 0 for uniform')
+    parser.add_argument('--query-fraction', type=float, help='Fraction of requests with a query string')
+    parser.add_argument('--statuses', type=weights, help='Status mix as STATUS:WEIGHT,..., e.g. 200:90,404:5,500:5')
+    parser.add_argument('--methods', type=weights, help='Method mix as METHOD:WEIGHT,..., e.g. GET:90,POST:10')
+    parser.add_argument('--durations', type=duration, help='Duration distribution in ms - lognormal:MEDIAN:SIGMA or uniform:LOW:HIGH')
+    parser.add_argument('--span', type=int, help='Seconds between the first and the last request')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.set_defaults(lines=100000, urls=100, skew=1.0, query_fraction=0.2, statuses=None, methods=None, durations=('lognormal', 100, 1.0), span=24 * 3600, seed=0)
+
+def from_arguments(args):
+    return SyntheticLog(args.lines, args.urls, args.skew, args.query_fraction, args.statuses, args.methods, args.durations, args.span, seed=args.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = f'Write a deterministic synthetic access log in the format \'{LOG_FORMAT.replace("%", "%%")}\''
+    )
+    add_arguments(parser)
+    parser.add_argument('output', help='File to write, .gz files are compressed, - writes to stdout')
+    args = parser.parse_args()
+    from_arguments(args).write(args.output)
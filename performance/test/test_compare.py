@@ -0,0 +1,68 @@
+import csv
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequestParser, component_from_filename, request_filter
+from core import performance
+from core import snapshot
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+
+def _write_log(filename, slow=(), failing=(), fast=()):
+    with open(filename, 'w') as file:
+        for i in range(2000):
+            path = f'/api/{i % 5}'
+            duration = 100 + i % 50
+            if path in slow:
+                duration *= 2
+            if path in fast:
+                duration //= 2
+            status = '500' if path in failing and i // 5 % 10 == 0 else '200'
+            timestamp = (START + datetime.timedelta(seconds=i * 7)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+            file.write(f'10.0.0.1 - - [{timestamp}] "GET {path} HTTP/1.1" {status} 10 "-" "test" X {duration}\n')
+
+def _report(log, root_path, quantile_estimator):
+    performance.performance_report([log], ApacheRequestParser(), component_from_filename, request_filter, performance.TimeBucket.HOUR, quantile_estimator=quantile_estimator, formats=[performance.OutputFormat.SNAPSHOT, performance.OutputFormat.CSV])
+    os.rename('out', root_path)
+
+@pytest.mark.parametrize('quantile_estimator', list(performance.QuantileEstimator))
+def test_snapshot_matches_report(tmp_path, monkeypatch, quantile_estimator):
+    monkeypatch.chdir(tmp_path)
+    _write_log('access.log')
+    _report('access.log', 'baseline', quantile_estimator)
+    with open('baseline/example/inbound.snapshot', 'rb') as file:
+        s = snapshot.read(file)
+    assert (s.component, s.label, s.time_bucket) == ('example', 'inbound', 'hour')
+    assert s.start == START and s.end == START + datetime.timedelta(seconds=1999 * 7)
+    with open('baseline/example/inbound.csv') as file:
+        rows = list(csv.DictReader(file))
+    assert len(rows) == len(s.store)
+    for row, (url, time_key, method, bucket) in zip(rows, s.store.rows()):
+        assert [row['url'], row['bucket'], row['method'], int(row['requests']), int(row['5xx'])] == [url, performance._bucket_start(time_key, performance.TimeBucket.HOUR), method, bucket.count, bucket.server_error]
+        for expected, actual in zip(performance._percentiles(bucket.duration), [row['p50'], row['p75'], row['p90'], row['p99']]):
+            assert float(actual) == pytest.approx(expected, rel=0.02)
+
+def test_compare_sorted_by_impact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _write_log('baseline.log')
+    _write_log('current.log', slow=['/api/1'], failing=['/api/2'], fast=['/api/3'])
+    _report('baseline.log', 'baseline', performance.QuantileEstimator.EXACT)
+    _report('current.log', 'current', performance.QuantileEstimator.DDSKETCH)
+    rows, compared = performance.compare_snapshots('baseline', 'current', formats=[performance.OutputFormat.HTML, performance.OutputFormat.CSV])
+    assert compared == 5
+    # 5XX rate up 10 points, p90 doubled, p90 halved
+    assert [row[1] for row in rows] == ['/api/2', '/api/1', '/api/3']
+    assert [row[-1] > 0 for row in rows] == [True, True, False]
+    with open('compare/compare.csv') as file:
+        assert [row['url'] for row in csv.DictReader(file)] == ['/api/2', '/api/1', '/api/3']
+    with open('compare/index.html') as file:
+        html = file.read()
+    assert '<h2>regressions</h2>' in html and '<h2>improvements</h2>' in html and '/api/4' not in html
+    # nothing moved
+    rows, compared = performance.compare_snapshots('baseline', 'baseline/example/inbound.snapshot')
+    assert (rows, compared) == ([], 5)
@@ -0,0 +1,97 @@
+import csv
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequestParser, request_filter
+from core import performance
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, 10, 58, tzinfo=UTC)
+# url -> durations - a percentile is only given once there are enough durations for it, and - leaves
+# the request out of the percentiles
+DURATIONS = {
+    '/one': [5],
+    '/three': [1, 2, 3],
+    '/twenty': list(range(20)),
+    '/none': ['-', '-'],
+}
+
+def _lines():
+    i = 0
+    for url, durations in DURATIONS.items():
+        for duration in durations:
+            # two minutes either side of 11:00, so every url is in both hours
+            timestamp = (START + datetime.timedelta(seconds=i % 240)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+            yield f'10.0.0.1 - - [{timestamp}] "GET {url} HTTP/1.1" {["200", "404", "500"][i % 3]} 10 "-" "test" X {duration}\n'
+            i += 61
+
+def _export(output_format, time_bucket=performance.TimeBucket.HOUR):
+    performance.performance_report(['access.log'], ApacheRequestParser(), lambda filename: 'example', request_filter, time_bucket, formats=[output_format])
+    return f'out/example/inbound.{output_format.value}'
+
+def _records(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+@pytest.fixture(autouse=True)
+def log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('access.log', 'w') as file:
+        file.writelines(_lines())
+
+def test_jsonl_schema():
+    records = _records(_export(performance.OutputFormat.JSONL))
+    assert len(records) > 0
+    for record in records:
+        assert list(record) == performance._EXPORT_FIELDS
+        assert record['component'] == 'example'
+        assert record['method'] == 'GET'
+        assert record['bucket'] in ['2024-01-01T10:00', '2024-01-01T11:00']
+        assert all(isinstance(record[field], int) for field in ['requests', '2xx', '4xx', '5xx', 'no_response', 'other'])
+        assert record['requests'] == sum(record[field] for field in ['2xx', '4xx', '5xx', 'no_response', 'other'])
+    assert sum(r['requests'] for r in records) == sum(len(d) for d in DURATIONS.values())
+    assert sorted({r['url'] for r in records}) == sorted(DURATIONS)
+
+def test_jsonl_without_time_buckets():
+    records = _records(_export(performance.OutputFormat.JSONL, performance.TimeBucket.NONE))
+    assert {r['url']: r['requests'] for r in records} == {url: len(d) for url, d in DURATIONS.items()}
+    assert all(r['bucket'] is None for r in records)
+
+def test_missing_percentiles_are_null():
+    records = _records(_export(performance.OutputFormat.JSONL, performance.TimeBucket.NONE))
+    percentiles = {r['url']: [r['p50'], r['p75'], r['p90'], r['p99']] for r in records}
+    assert percentiles == {
+        '/one': [5, None, None, None],
+        '/three': [2, 3, None, None],
+        '/twenty': [10, 14, 17, 19],
+        '/none': [None, None, None, None],
+    }
+    # the same rows as the csv, where missing percentiles are empty
+    with open(_export(performance.OutputFormat.CSV, performance.TimeBucket.NONE), newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert [[str(v) if v is not None else '' for v in r.values()] for r in records] == [list(r.values()) for r in rows]
+
+def test_parquet_matches_jsonl():
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = pq.read_table(_export(performance.OutputFormat.PARQUET))
+    assert table.schema.names == performance._EXPORT_FIELDS
+    assert table.schema.types == [pa.string()] * 4 + [pa.int64()] * 6 + [pa.float64()] * 4
+    assert table.to_pylist() == _records(_export(performance.OutputFormat.JSONL))
+    assert any(r['p75'] is None for r in table.to_pylist())
+
+def test_parquet_row_groups(monkeypatch):
+    # rows are written in row groups of _PARQUET_BATCH_ROWS
+    pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    monkeypatch.setattr(performance, '_PARQUET_BATCH_ROWS', 3)
+    path = _export(performance.OutputFormat.PARQUET)
+    rows = len(_records(_export(performance.OutputFormat.JSONL)))
+    metadata = pq.ParquetFile(path).metadata
+    assert metadata.num_rows == rows
+    assert metadata.num_row_groups == (rows + 2) // 3
@@ -0,0 +1,122 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequest, ApacheRequestParser, component_from_filename, request_filter
+from core import logindex
+from core import performance
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+PATHS = ['/', '/api/orders', '/api/customers', '/login']
+METHODS = ['GET', 'POST', 'DELETE']
+CODES = ['200', '201', '404', '500', '503']
+
+FILTERS = [
+    performance.RequestFilters(since=START + datetime.timedelta(hours=2)),
+    performance.RequestFilters(until=START + datetime.timedelta(hours=1)),
+    performance.RequestFilters(START + datetime.timedelta(hours=1, minutes=30), START + datetime.timedelta(hours=1, minutes=40)),
+    performance.RequestFilters(path_prefix='/api'),
+    performance.RequestFilters(methods=['POST', 'DELETE']),
+    performance.RequestFilters(statuses=['404', '5xx']),
+    performance.RequestFilters(START + datetime.timedelta(hours=3), path_prefix='/api/c', methods=['GET'], statuses=['200']),
+    performance.RequestFilters(since=START + datetime.timedelta(days=1)),
+]
+
+def _line(i, request_time):
+    timestamp = request_time.strftime('%d/%b/%Y:%H:%M:%S +0000')
+    path, method, code = PATHS[i % len(PATHS)], METHODS[i % len(METHODS)], CODES[i % len(CODES)]
+    return f'10.0.0.1 - - [{timestamp}] "{method} {path}?id={i} HTTP/1.1" {code} 10 "-" "test" X {i % 100}\n'
+
+@pytest.fixture
+def sorted_log(tmp_path):
+    filename = tmp_path / 'access.log'
+    with open(filename, 'w') as file:
+        for i in range(20000):
+            file.write(_line(i, START + datetime.timedelta(seconds=i)))
+    return str(filename)
+
+def _parsed(filename, start, end):
+    lines = performance._read_range(filename, start or 0, end)
+    return [ApacheRequest(line) for line in lines]
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_pushdown_matches_parsed_filter(sorted_log, filters, monkeypatch):
+    monkeypatch.setattr(performance, '_BISECT_MIN_SIZE', 1024)
+    monkeypatch.setattr(performance, '_TIME_SORT_SLACK', datetime.timedelta(0))
+    request_parser = ApacheRequestParser()
+    expected = [r.url for r in _parsed(sorted_log, None, None) if filters.matches(r)]
+
+    line_filter = request_parser.line_filter(filters)
+    window = performance._time_range(sorted_log, None, None, request_parser, filters)
+    actual = []
+    if window is not None:
+        for line in performance._read_range(sorted_log, window[0] or 0, window[1]):
+            if line_filter is None or line_filter(line):
+                r = request_parser(line)
+                if filters.matches(r):
+                    actual.append(r.url)
+    assert actual == expected
+    if filters.since is not None or filters.until is not None:
+        assert window is None or window[1] - window[0] < os.path.getsize(sorted_log)
+
+def test_unsorted_log_is_not_bisected(tmp_path, monkeypatch):
+    monkeypatch.setattr(performance, '_BISECT_MIN_SIZE', 1024)
+    filename = tmp_path / 'access.log'
+    with open(filename, 'w') as file:
+        for i in range(5000):
+            file.write(_line(i, START + datetime.timedelta(hours=i % 7)))
+    filters = performance.RequestFilters(since=START + datetime.timedelta(hours=6))
+    assert performance._time_range(str(filename), None, None, ApacheRequestParser(), filters) == (None, None)
+
+def test_url_filter():
+    req = ApacheRequest(_line(1, START))
+    assert performance.url_filter(req, '/api')
+    assert not performance.url_filter(req, '/api', reverse_match=True)
+    assert not performance.url_filter(req, '/login')
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_index_range_matches_parsed_filter(sorted_log, filters):
+    request_parser = ApacheRequestParser()
+    expected = [r.url for r in _parsed(sorted_log, None, None) if filters.matches(r)]
+    window = performance._log_index(sorted_log, request_parser).range(None, None, filters)
+    actual = []
+    if window is not None:
+        actual = [r.url for r in _parsed(sorted_log, *window) if filters.matches(r)]
+    assert actual == expected
+
+def test_index_is_rebuilt_when_log_changes(sorted_log):
+    request_parser = ApacheRequestParser()
+    assert performance._log_index(sorted_log, request_parser).lines == 20000
+    assert logindex.load(sorted_log, os.stat(sorted_log)) is not None
+    with open(sorted_log, 'a') as file:
+        file.write(_line(0, START + datetime.timedelta(days=1)))
+    assert logindex.load(sorted_log, os.stat(sorted_log)) is None
+    index = performance._log_index(sorted_log, request_parser)
+    assert (index.lines, index.end, index.sorted) == (20001, START + datetime.timedelta(days=1), True)
+
+@pytest.mark.parametrize('filters, state_file, indexed', [
+    (None, None, False),
+    (performance.RequestFilters(methods=['POST']), None, False),
+    (FILTERS[0], 'state', False),
+    (FILTERS[0], None, True),
+])
+def test_index_is_only_built_when_it_can_skip(sorted_log, tmp_path, monkeypatch, filters, state_file, indexed):
+    monkeypatch.chdir(tmp_path)
+    performance.performance_report([sorted_log], ApacheRequestParser(), component_from_filename, request_filter, state_file=state_file, filters=filters, use_index=True, formats=[performance.OutputFormat.CSV])
+    assert os.path.exists(f'{sorted_log}.idx') == indexed
+
+def test_index_skips_lines_the_parser_fails_on(sorted_log):
+    # any error, not only ValueError, skips the line as _parse_lines does
+    def request_parser(line):
+        if '?id=7 ' in line:
+            raise KeyError('id')
+        return ApacheRequest(line)
+    filters = FILTERS[0]
+    expected = [r.url for r in _parsed(sorted_log, None, None) if filters.matches(r)]
+    index = performance._log_index(sorted_log, request_parser)
+    assert index.lines == 20000
+    assert [r.url for r in _parsed(sorted_log, *index.range(None, None, filters)) if filters.matches(r)] == expected
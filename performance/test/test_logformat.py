@@ -0,0 +1,151 @@
+import csv
+import datetime
+import mmap
+import os
+import shlex
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequest, ApacheRequestParser, LOG_FORMAT
+from core import logformat
+from core import performance
+
+UTC = datetime.timezone.utc
+
+# line, method, url, response code, duration (ms), request time (UTC)
+CORPUS = [
+    (
+        '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "GET /index.html HTTP/1.1" 200 2326 "-" "curl/8.0" X 12',
+        'GET', '/index.html', '200', 12, datetime.datetime(2023, 10, 10, 13, 55, 36, tzinfo=UTC),
+    ),
+    (
+        '10.0.0.1 - frank [10/Oct/2023:13:55:36 -0700] "POST /api/orders?id=1&x=2 HTTP/1.1" 201 - "http://example.com/a b" "Mozilla/5.0 (X11; Linux x86_64)" + 1500',
+        'POST', '/api/orders?id=1&x=2', '201', 1500, datetime.datetime(2023, 10, 10, 20, 55, 36, tzinfo=UTC),
+    ),
+    (
+        # escaped quotes inside quoted fields
+        '10.0.0.1 - - [01/Jan/2024:00:00:00 +0530] "GET /search?q=\\"quoted\\" HTTP/1.1" 404 0 "-" "agent \\"with\\" quotes" - 3',
+        'GET', '/search?q="quoted"', '404', 3, datetime.datetime(2023, 12, 31, 18, 30, tzinfo=UTC),
+    ),
+    (
+        # escaped backslash at the end of a quoted field
+        '10.0.0.1 - - [29/Feb/2024:23:59:59 +0000] "GET /a HTTP/1.1" 500 10 "-" "ends with \\\\" X 7',
+        'GET', '/a', '500', 7, datetime.datetime(2024, 2, 29, 23, 59, 59, tzinfo=UTC),
+    ),
+    (
+        # no duration recorded, trailing whitespace
+        '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "DELETE /x HTTP/1.1" 0 - "-" "-" X -  \n',
+        'DELETE', '/x', '0', None, datetime.datetime(2023, 10, 10, 13, 55, 36, tzinfo=UTC),
+    ),
+]
+
+MALFORMED = [
+    '',
+    '\n',
+    'not an access log line',
+    # truncated
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "GET /index.html HTTP/1.1" 200',
+    # unterminated quote
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "GET /index.html HTTP/1.1 200 2326 "-" "curl/8.0" X 12',
+    # bad month
+    '10.0.0.1 - - [10/Foo/2023:13:55:36 +0000] "GET /index.html HTTP/1.1" 200 2326 "-" "curl/8.0" X 12',
+    # bad timezone
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 0000] "GET /index.html HTTP/1.1" 200 2326 "-" "curl/8.0" X 12',
+    # request line without url
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "-" 408 0 "-" "-" X 12',
+    # non numeric duration
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "GET / HTTP/1.1" 200 0 "-" "-" X abc',
+]
+
+@pytest.mark.parametrize('line, method, url, code, duration, request_time', CORPUS)
+def test_corpus(line, method, url, code, duration, request_time):
+    req = ApacheRequest(line)
+    assert req.http_method == method
+    assert req.url == url
+    assert req.path == url.split('?')[0]
+    assert req.http_response_code == code
+    assert req.duration == duration
+    assert req.request_time == request_time
+
+@pytest.mark.parametrize('line', [c[0] for c in CORPUS if c[4] is not None])
+def test_matches_shlex(line):
+    fields = shlex.split(line)
+    req = ApacheRequest(line)
+    assert req.http_method == fields[5].split(' ')[0]
+    assert req.url == fields[5].split(' ')[1]
+    assert req.http_response_code == fields[6]
+    assert req.duration == int(fields[11])
+    expected = datetime.datetime.strptime(f'{fields[3]} {fields[4]}', '[%d/%b/%Y:%H:%M:%S %z]').astimezone(UTC)
+    assert req.request_time == expected
+
+@pytest.mark.parametrize('line', MALFORMED)
+def test_malformed(line):
+    with pytest.raises(ValueError):
+        ApacheRequest(line)
+
+def test_custom_format():
+    log_format = logformat.LogFormat('%a %t %>s "%r" %D %%')
+    req = ApacheRequest('::1 [10/Oct/2023:13:55:36 +0000] 302 "GET /login HTTP/2" 2500 %', log_format)
+    assert (req.http_method, req.url, req.http_response_code, req.duration) == ('GET', '/login', '302', 2.5)
+    assert logformat.LogFormat(LOG_FORMAT).directives[-2:] == ['%X', '%{ms}T']
+
+def test_timestamp_cache():
+    decode = logformat.TimestampDecoder()
+    timestamps = [
+        '10/Oct/2023:13:55:36 +0000',
+        '10/Oct/2023:13:55:36 +0000',
+        '10/Oct/2023:13:55:37 +0000',
+        '10/Oct/2023:13:55:37 -0100',
+        '11/Oct/2023:00:00:00 -0100',
+        '10/Oct/2023:13:55:36 +0000',
+    ]
+    for timestamp in timestamps:
+        expected = datetime.datetime.strptime(timestamp, '%d/%b/%Y:%H:%M:%S %z').astimezone(UTC)
+        assert decode(timestamp) == expected
+
+def _scan(lines, log_format=None, on_error=None):
+    request_parser = ApacheRequestParser() if log_format is None else ApacheRequestParser(log_format)
+    data = ''.join(line if line.endswith('\n') else line + '\n' for line in lines).encode('utf-8')
+    buffer = mmap.mmap(-1, len(data))
+    buffer.write(data)
+    return list(request_parser.scan_buffer(buffer, 0, len(data), on_error=on_error))
+
+def test_scan_buffer_matches_text():
+    lines = [c[0] for c in CORPUS]
+    for req, line in zip(_scan(lines), lines):
+        expected = ApacheRequest(line)
+        assert (req.http_method, req.url, req.http_response_code, req.duration, req.request_time) == (expected.http_method, expected.url, expected.http_response_code, expected.duration, expected.request_time)
+
+@pytest.mark.parametrize('line', [line for line in MALFORMED if line.strip()])
+def test_scan_buffer_malformed(line):
+    with pytest.raises(ValueError):
+        _scan([line])
+
+def test_scan_buffer_without_duration():
+    [req] = _scan(['::1 [10/Oct/2023:13:55:36 +0000] 302 "GET /login HTTP/2"'], logformat.LogFormat('%a %t %>s "%r"'))
+    assert (req.http_method, req.url, req.http_response_code, req.duration) == ('GET', '/login', '302', None)
+
+def test_scan_buffer_skips_malformed():
+    good = [c[0] for c in CORPUS]
+    bad = [line for line in MALFORMED if line.strip()]
+    skipped = performance.SkippedLines(max_samples=2)
+    lines = [line for i, b in enumerate(bad) for line in (good[i % len(good)], b)]
+    requests = _scan(lines, on_error=lambda e, line: skipped.add('test.log', e, line))
+    assert [r.url for r in requests] == [ApacheRequest(good[i % len(good)]).url for i in range(len(bad))]
+    assert len(skipped) == len(bad)
+    assert all(len(samples) <= 2 for _, samples in skipped.reasons.values())
+
+def test_zero_durations_are_counted(tmp_path, monkeypatch):
+    # %{ms}T logs fast requests as 0, they are part of the percentiles, only - is left out
+    monkeypatch.chdir(tmp_path)
+    with open('access.log', 'w') as file:
+        for i in range(100):
+            duration = '-' if i % 10 == 9 else 0 if i < 80 else 50
+            file.write(f'10.0.0.1 - - [10/Oct/2023:13:55:{i % 60:02} +0000] "GET /a HTTP/1.1" 200 0 "-" "-" X {duration}\n')
+    performance.performance_report(['access.log'], ApacheRequestParser(), lambda filename: 'example', lambda req: True, performance.TimeBucket.NONE, formats=[performance.OutputFormat.CSV])
+    with open('out/example/inbound.csv') as file:
+        row = list(csv.DictReader(file))[0]
+    assert row['requests'] == '100'
+    assert [row['p50'], row['p75'], row['p90'], row['p99']] == ['0', '0', '50', '50']
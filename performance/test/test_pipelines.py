@@ -0,0 +1,102 @@
+import datetime
+import gzip
+import io
+import os
+import pickle
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequestParser, request_filter
+from core import performance
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+LOGS = ['web1-a.log', 'web2-a.log', 'web1-b.log.gz', 'web3-a.log']
+
+def _line(i):
+    timestamp = (START + datetime.timedelta(seconds=i * 7)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+    return f'10.0.0.1 - - [{timestamp}] "GET /api/{i % 11} HTTP/1.1" {["200", "404", "500"][i % 3]} 10 "-" "test" X {i % 97}\n'
+
+def component_from_filename(filename):
+    return filename.split('-')[0]
+
+def _pages(workers, logs=LOGS, state_file=None, max_paths=None):
+    performance.performance_report(logs, ApacheRequestParser(), component_from_filename, request_filter, performance.TimeBucket.HOUR, workers=workers, state_file=state_file, formats=[performance.OutputFormat.HTML, performance.OutputFormat.CSV], max_paths=max_paths)
+    pages = {}
+    for root, _, files in os.walk('out'):
+        for name in files:
+            with open(os.path.join(root, name)) as file:
+                pages[os.path.join(root, name)] = file.read()
+    return pages
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(performance, '_MIN_CHUNK_SIZE', 4096)
+    for n, filename in enumerate(LOGS):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'wt') as file:
+            file.writelines(_line(i) for i in range(n * 1000, n * 1000 + 2000))
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_workers_match_serial(logs, workers):
+    expected = _pages(1)
+    assert sorted(expected) == ['out/index.html'] + [f'out/{c}/{f}' for c in ['web1', 'web2', 'web3'] for f in ['inbound.csv', 'index.html']]
+    assert _pages(workers) == expected
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_max_paths_workers_match_serial(logs, workers):
+    # the paths kept are the first ones in the logs, not the first ones in the chunk that finishes first
+    expected = _pages(1, max_paths=4)
+    assert '/api/10,' not in expected['out/web1/inbound.csv'] and 'other,' in expected['out/web1/inbound.csv']
+    assert _pages(workers, max_paths=4) == expected
+
+def test_chunk_paths_are_capped(logs):
+    # the paths kept by the parent are counted as they are, new ones only up to max_paths
+    args = ('web1-a.log', 0, None, 'web1', ApacheRequestParser(), request_filter, performance.TimeBucket.HOUR, False, performance.QuantileEstimator.EXACT, None)
+    store = performance._process_chunk(*args, max_paths=4, kept_paths=['/api/7'])[2]['web1']
+    assert store.urls == ['/api/7', '/api/0', '/api/1', '/api/2', 'other']
+    assert sum(bucket.count for url, _, _, bucket in store.items() if url == '/api/7') == sum(1 for i in range(2000) if i % 11 == 7)
+
+def test_state_keeps_max_paths(logs):
+    _pages(1, state_file='state', max_paths=4)
+    with pytest.raises(Exception, match='different options'):
+        _pages(1, state_file='state', max_paths=5)
+
+def test_component_pages_do_not_depend_on_other_components(logs):
+    pages = _pages(2)
+    single = _pages(2, ['web1-a.log', 'web1-b.log.gz'])
+    assert single['out/web1/index.html'] == pages['out/web1/index.html']
+
+def test_state_keeps_every_component(logs):
+    expected = _pages(2)
+    assert _pages(2, state_file='state') == expected
+    with gzip.open('state', 'rb') as file:
+        assert sorted(pickle.load(file)['components']) == ['web1', 'web2', 'web3']
+    # nothing new - every page is rendered from the state
+    assert _pages(1, state_file='state') == expected
+
+@pytest.mark.parametrize('quantile_estimator', list(performance.QuantileEstimator))
+def test_rollups_match_direct_runs(logs, quantile_estimator):
+    performance.performance_report(LOGS, ApacheRequestParser(), component_from_filename, request_filter, list(performance.TimeBucket), quantile_estimator=quantile_estimator, formats=[performance.OutputFormat.CSV])
+    rollups = {}
+    for time_bucket in performance.TimeBucket:
+        with open(f'out/web1/inbound_{time_bucket.value}.csv') as file:
+            rollups[time_bucket] = file.read()
+    for time_bucket in performance.TimeBucket:
+        performance.performance_report(LOGS, ApacheRequestParser(), component_from_filename, request_filter, time_bucket, quantile_estimator=quantile_estimator, formats=[performance.OutputFormat.CSV])
+        with open('out/web1/inbound.csv') as file:
+            assert file.read() == rollups[time_bucket]
+
+def test_follow_writes_report_on_exit(logs, monkeypatch):
+    performance.performance_report(['web1-a.log'], ApacheRequestParser(), component_from_filename, request_filter, performance.TimeBucket.HOUR, formats=[performance.OutputFormat.CSV])
+    with open('out/web1/inbound.csv') as file:
+        expected = file.read()
+    with open('web1-a.log') as file:
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(file.read()))
+    # stdin closes long before the first refresh
+    performance.performance_report(['-'], ApacheRequestParser(), lambda filename: 'web1', request_filter, performance.TimeBucket.HOUR, follow=True, refresh_interval=60, formats=[performance.OutputFormat.CSV])
+    with open('out/web1/inbound.csv') as file:
+        assert file.read() == expected
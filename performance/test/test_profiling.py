@@ -0,0 +1,40 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequestParser, component_from_filename, request_filter
+from core import performance
+from core import profiling
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+
+def _line(i):
+    timestamp = (START + datetime.timedelta(seconds=i)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+    return f'10.0.0.1 - - [{timestamp}] "GET /api/{i % 7} HTTP/1.1" {["200", "404", "500"][i % 3]} 10 "-" "test" X {i % 100}\n'
+
+def _report(log, profiler, use_mmap):
+    filters = performance.RequestFilters(statuses=['500'])
+    performance.performance_report([log], ApacheRequestParser(), component_from_filename, request_filter, performance.TimeBucket.MINUTE, filters=filters, use_mmap=use_mmap, profiler=profiler)
+    with open('out/example/index.html') as file:
+        return file.read()
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_profiled_run_matches(tmp_path, monkeypatch, use_mmap):
+    monkeypatch.chdir(tmp_path)
+    with open('access.log', 'w') as file:
+        file.writelines(_line(i) for i in range(3000))
+    expected = _report('access.log', None, use_mmap)
+    profiler = profiling.Profiler()
+    assert _report('access.log', profiler, use_mmap) == expected
+    assert profiler.stages['aggregate'][2] == 1000
+    assert profiler.stages['process'][2] == 1
+    assert profiler.stages['render'][1] is not None
+    if not use_mmap:
+        assert profiler.stages['read'][2] == 3000
+        assert profiler.stages['line filter'][3] == 2000
+    assert 'lines/s' in profiler.summary()
+    assert performance._profiler is None
@@ -0,0 +1,40 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from core import quantiles
+
+def _values(n=20000):
+    rand = random.Random(0)
+    return [rand.lognormvariate(5, 1.5) for _ in range(n)]
+
+def test_ddsketch_relative_error():
+    values = _values()
+    exact = quantiles.ExactQuantiles()
+    sketch = quantiles.DDSketch(relative_accuracy=0.01)
+    for v in values:
+        exact.add(v)
+        sketch.add(v)
+    ranks = [0, len(values) // 2, 9 * len(values) // 10, len(values) - 1]
+    for e, s in zip(exact.ranked(ranks), sketch.ranked(ranks)):
+        assert abs(s - e) / e <= 0.011
+
+def test_ddsketch_merge_matches_single_sketch():
+    values = _values()
+    single = quantiles.DDSketch()
+    parts = [quantiles.DDSketch() for _ in range(4)]
+    for i, v in enumerate(values):
+        single.add(v)
+        parts[i % 4].add(v)
+    for part in parts[1:]:
+        parts[0].merge(part)
+    ranks = [0, 5000, 10000, 19999]
+    assert len(parts[0]) == len(single)
+    assert parts[0].ranked(ranks) == single.ranked(ranks)
+
+def test_ddsketch_bounded_bins():
+    sketch = quantiles.DDSketch(max_bins=100)
+    for v in _values():
+        sketch.add(v)
+    assert len(sketch._bins) <= 100
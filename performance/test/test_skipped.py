@@ -0,0 +1,83 @@
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequest, ApacheRequestParser, component_from_filename, request_filter
+from core import performance
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+# lines that fail for different reasons
+BAD = [
+    'not an access log line\n',
+    '10.0.0.1 - - [10/Foo/2023:13:55:36 +0000] "GET / HTTP/1.1" 200 0 "-" "-" X 12\n',
+    '10.0.0.1 - - [10/Oct/2023:13:55:36 +0000] "GET / HTTP/1.1" 200 0 "-" "-" X abc\n',
+]
+
+def _line(i):
+    timestamp = (START + datetime.timedelta(seconds=i)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+    return f'10.0.0.1 - - [{timestamp}] "GET /api/{i % 5} HTTP/1.1" 200 10 "-" "test" X {i % 50}\n'
+
+def _lines(n):
+    # every 7th line fails, cycling through BAD
+    return [BAD[i // 7 % len(BAD)] if i % 7 == 6 else _line(i) for i in range(n)]
+
+def _skipped(workers):
+    performance.performance_report(['access.log'], ApacheRequestParser(), component_from_filename, request_filter, workers=workers, formats=[performance.OutputFormat.CSV])
+    with open('skipped.json') as file:
+        return [json.loads(line) for line in file]
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(performance, '_MIN_CHUNK_SIZE', 4096)
+    with open('access.log', 'w') as file:
+        file.writelines(_lines(3000))
+
+def test_parse_lines_skips_failing_lines():
+    # any exception from the request parser only skips its line
+    def request_parser(line):
+        if '/api/3 ' in line:
+            raise KeyError('api')
+        return ApacheRequest(line)
+    errors = []
+    lines = _lines(100)
+    requests = list(performance._parse_lines(lines, request_parser, None, lambda e, line: errors.append((type(e), line))))
+    assert [r.url for r in requests] == [ApacheRequest(line).url for line in lines if line not in BAD and '/api/3 ' not in line]
+    assert [line for _, line in errors] == [line for line in lines if line in BAD or '/api/3 ' in line]
+    assert {e for e, _ in errors} == {ValueError, KeyError}
+
+def test_skipped_json(log):
+    with pytest.warns(UserWarning, match='skipped 428 lines'):
+        records = _skipped(1)
+    assert sum(r['count'] for r in records) == 428
+    assert [r['count'] for r in records] == sorted((r['count'] for r in records), reverse=True)
+    assert len(records) == len(BAD)
+    for record in records:
+        assert set(record) == {'reason', 'count', 'samples'}
+        assert len(record['samples']) == 10
+        assert all(set(sample) == {'file', 'error', 'line'} and sample['file'] == 'access.log' for sample in record['samples'])
+        assert all(sample['error'].startswith(record['reason'].split(': ', 1)[1]) for sample in record['samples'])
+    assert os.path.exists('out/example/inbound.csv')
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_workers_match_serial(log, workers):
+    with pytest.warns(UserWarning):
+        expected = _skipped(1)
+    with pytest.warns(UserWarning):
+        assert _skipped(workers) == expected
+
+def test_merge_caps_reasons():
+    skipped = performance.SkippedLines(max_samples=2, max_reasons=3)
+    for i in range(5):
+        chunk = performance.SkippedLines(max_samples=2, max_reasons=3)
+        for j in range(4):
+            chunk.add('access.log', ValueError(f'reason {i + j} - detail->{j}'), f'line {j}')
+        skipped.merge(chunk)
+    assert list(skipped.reasons) == ['ValueError: reason 0', 'ValueError: reason 1', 'ValueError: reason 2', 'other']
+    assert len(skipped) == 20
+    assert all(len(samples) <= 2 for _, samples in skipped.reasons.values())
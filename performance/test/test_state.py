@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import os
+import pickle
+import shutil
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apache import ApacheRequestParser, component_from_filename, request_filter
+from core import performance
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+LINES = [f'10.0.0.1 - - [{(START + datetime.timedelta(seconds=i * 13)).strftime("%d/%b/%Y:%H:%M:%S +0000")}] "GET /api/{i % 7} HTTP/1.1" {["200", "404", "500"][i % 3]} 10 "-" "test" X {i % 89}\n' for i in range(3000)]
+
+def _write(filename, lines, mode='w'):
+    with open(filename, mode) as file:
+        file.write(''.join(lines))
+
+def _report(*logs, state_file='state'):
+    shutil.rmtree('out', ignore_errors=True)
+    performance.performance_report(list(logs), ApacheRequestParser(), component_from_filename, request_filter, performance.TimeBucket.MINUTE, state_file=state_file, formats=[performance.OutputFormat.CSV])
+    with open('out/example/inbound.csv') as file:
+        return file.read()
+
+def _expected(lines):
+    # report of the lines processed in one run without a state file
+    _write('expected.log', lines)
+    return _report('expected.log', state_file=None)
+
+def _files():
+    with gzip.open('state', 'rb') as file:
+        return pickle.load(file)['files']
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def test_appended_lines_are_processed_once():
+    # the partially written last line is left for the next run
+    _write('access.log', LINES[:1000] + [LINES[1000][:30]])
+    _report('access.log')
+    _write('access.log', [LINES[1000][30:]] + LINES[1001:1500], 'a')
+    assert _report('access.log') == _expected(LINES[:1500])
+    # nothing new
+    assert _report('access.log') == _expected(LINES[:1500])
+
+def test_rotated_log_is_resumed():
+    # the rest of the rotated log is processed from where the last run stopped, the new log from the start
+    _write('access.log', LINES[:1000])
+    _report('access.log')
+    os.rename('access.log', 'access.log.1')
+    _write('access.log.1', LINES[1000:1200], 'a')
+    _write('access.log', LINES[1200:1500])
+    assert _report('access.log.1', 'access.log') == _expected(LINES[:1500])
+
+def test_compressed_log_is_resumed():
+    # a rotated log that was compressed after the last run is picked up where it was left, and it is
+    # complete once it is compressed
+    _write('access.log', LINES[:1000])
+    _report('access.log')
+    _write('access.log', LINES[1000:1200], 'a')
+    with open('access.log', 'rb') as source, gzip.open('access.log.1.gz', 'wb') as target:
+        target.write(source.read())
+    os.remove('access.log')
+    _write('access.log', LINES[1200:1500])
+    assert _report('access.log.1.gz', 'access.log') == _expected(LINES[:1500])
+    assert _report('access.log.1.gz', 'access.log') == _expected(LINES[:1500])
+
+def test_truncated_log_is_processed_from_start():
+    # same file and first bytes, but shorter than what was processed
+    _write('access.log', LINES[:1000])
+    _report('access.log')
+    _write('access.log', LINES[:300])
+    with pytest.warns(UserWarning, match='truncated'):
+        report = _report('access.log')
+    assert report == _expected(LINES[:1000] + LINES[:300])
+
+def test_replaced_log_is_processed_from_start():
+    _write('access.log', LINES[:1000])
+    _report('access.log')
+    _write('access.log', LINES[1000:1500])
+    assert _report('access.log') == _expected(LINES[:1500])
+
+def test_logs_that_are_gone_are_forgotten(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(performance.time, 'time', lambda: now)
+    _write('access.log', LINES[:1000])
+    _write('other.log', LINES[1000:1500])
+    _report('access.log', 'other.log')
+    assert [e['path'] for e in _files()] == ['access.log', 'other.log']
+    os.remove('other.log')
+    _write('access.log', LINES[1500:1600], 'a')
+    _report('access.log')
+    assert [e['path'] for e in _files()] == ['other.log', 'access.log']
+    now += performance._STATE_FILE_MAX_AGE + 1
+    assert _report('access.log') == _expected(LINES[:1600])
+    assert [e['path'] for e in _files()] == ['access.log']
@@ -10,4 +10,4 @@ export HISTCONTROL="erasedups"
 #export CLI_EDITOR="vi"
 export CLI_TOOLS='python yq kubectl helm node maven aws codefresh pulumi github ripgrep gron'
 
-python "$_DIR/script/dedup.py" ~/.bash_history
+python "$_DIR/script/dedup.py" --incremental ~/.bash_history
@@ -13,4 +13,4 @@ export CLI_EDITOR='np'
 export CLI_TOOLS='python yq kubectl helm node maven aws codefresh pulumi github ripgrep gron'
 export WIN_USERNAME=chris
 
-python "$_DIR/script/dedup.py" ~/.bash_history
+python "$_DIR/script/dedup.py" --incremental ~/.bash_history
@@ -1,20 +1,325 @@
+import argparse
+import fcntl
+import hashlib
+import math
+import os
+import sqlite3
+import stat
+import struct
 import sys
+import tempfile
 
-if len(sys.argv) == 1:
-    sys.stderr.write(f"usage: {sys.argv[0]} <file>")
-    exit(1)
-
-with open(sys.argv[1], "r") as file:
-    seen = set()
-    result = []
-    # inefficient, but for this use case it's fine
-    for line in reversed(list(file)):
-        line = line.rstrip()
-        if line not in seen:
-            seen.add(line)
-            result.append(line)
-
-with open(sys.argv[1], "w") as file:
-    for line in reversed(result):
-        file.write(line)
-        file.write("\n")
+# Removes duplicate lines from a file, keeping the last occurrence of each line in place.
+# Lines are compared without trailing whitespace and written back with it stripped.
+#
+# Memory does not depend on the size of the file: lines are compared by fixed size hashes, which are
+# kept in memory while they fit in --memory and beyond that spilled to partition files on disk (by
+# hash) and deduplicated one partition at a time. The result is written to a temporary file next to
+# the original and renamed over it, so a crash never leaves a truncated file.
+#
+# --incremental is for files that only grow, like shell history: a fingerprint index next to the file
+# (.<file>.dedup, an sqlite database of line hashes) remembers where the last run stopped, so only the
+# appended lines are read. Keeping the last occurrence of a line means removing the earlier one,
+# which needs the file to be rewritten, so appended duplicates are only counted, and the file is
+# rewritten once they are more than --compact of its lines. In between, the file holds the earlier
+# occurrences of up to that many lines. The index is rebuilt from a full run when the file was
+# replaced, truncated or edited since the last run. Edits are noticed from a fingerprint of the part
+# of the file the index covers, its length and a hash of blocks sampled across it, so an edit that
+# keeps the length of the file and falls between the sampled blocks goes unnoticed.
+
+# bytes of the hash kept per line, collisions are negligible (about 2**-64 at 2**32 distinct lines)
+HASH_SIZE = 16
+# default memory budget for the distinct lines, in MiB
+DEFAULT_MEMORY = 256
+# approximate bytes per distinct line held in memory besides its hash - dict slot, bytes object
+# header and line number
+_ENTRY_OVERHEAD = 112
+# bytes of lines read at a time
+_READ_SIZE = 1024 * 1024
+# (hash, line number) records in the partition files
+_RECORD = struct.Struct(f"{HASH_SIZE}sQ")
+# partitions are chosen by the first byte of the hash
+_MAX_PARTITIONS = 256
+# default fraction of duplicate lines an incremental run leaves before it rewrites the file
+DEFAULT_COMPACT = 0.1
+# bytes in each block of the fingerprint of the indexed part of the file
+_SAMPLE_SIZE = 4096
+# blocks in the fingerprint, spread evenly over the indexed part of the file
+_SAMPLES = 64
+# bumped when the layout of the index changes, older indexes are rebuilt
+_INDEX_VERSION = 2
+
+
+def line_hash(key):
+    # key is the line without trailing whitespace
+    return hashlib.blake2b(key, digest_size=HASH_SIZE).digest()
+
+
+def dedup(path, memory=DEFAULT_MEMORY * 1024 * 1024):
+    keep, lines, end = _last_occurrences(path, memory)
+    _rewrite(path, keep, lines, end)
+
+
+def _last_occurrences(path, memory):
+    # bitmap of the lines to keep, the number of lines and the offset just after the last one
+    # lines appended while this runs are past the offset and are left as they are
+    size = os.path.getsize(path)
+    max_entries = max(1, memory // (_ENTRY_OVERHEAD + HASH_SIZE))
+    # hash -> number of the last occurrence of its line, until there are more than max_entries
+    last = {}
+    spill = None
+    partitions = None
+    lines = 0
+    end = 0
+    try:
+        with open(path, "rb") as file:
+            while end < size:
+                batch = file.readlines(_READ_SIZE)
+                if not batch:
+                    break
+                read = sum(map(len, batch))
+                if end + read > size:
+                    # stop after the line that reaches the size the file had when it was opened
+                    count = 0
+                    while end < size:
+                        end += len(batch[count])
+                        count += 1
+                    del batch[count:]
+                else:
+                    end += read
+                # line_hash, inlined as it is the bulk of the time
+                hashes = [
+                    hashlib.blake2b(line.rstrip(), digest_size=HASH_SIZE).digest()
+                    for line in batch
+                ]
+                if partitions is not None:
+                    _write_records(
+                        partitions, hashes, range(lines, lines + len(hashes))
+                    )
+                else:
+                    last.update(zip(hashes, range(lines, lines + len(hashes))))
+                    if len(last) > max_entries:
+                        # the partitions are next to the file rather than in /tmp, which may be in memory
+                        spill = tempfile.TemporaryDirectory(
+                            dir=os.path.dirname(os.path.abspath(path))
+                        )
+                        partitions = _spill(last, max_entries, end, size, spill.name)
+                        last = None
+                lines += len(hashes)
+
+        keep = bytearray((lines + 7) // 8)
+        if partitions is None:
+            _mark(keep, last.values())
+            return keep, lines, end
+        for partition in partitions:
+            partition.close()
+            last = {}
+            with open(partition.name, "rb") as file:
+                # records are in line order, so the last one for a hash is its last occurrence
+                while True:
+                    data = file.read(_RECORD.size * 65536)
+                    if not data:
+                        break
+                    last.update(_RECORD.iter_unpack(data))
+            os.remove(partition.name)
+            _mark(keep, last.values())
+        return keep, lines, end
+    finally:
+        if spill is not None:
+            for partition in partitions or []:
+                partition.close()
+            spill.cleanup()
+
+
+def _spill(last, max_entries, position, size, directory):
+    # partition files for the rest of the file, with the hashes seen so far written to them
+    # there are enough partitions for the distinct hashes of each one to fit in memory, estimated from
+    # the lines seen so far (a heavily skewed file can still overfill a partition)
+    expected = len(last) * size / position
+    count = min(_MAX_PARTITIONS, max(2, math.ceil(2 * expected / max_entries)))
+    partitions = [
+        open(os.path.join(directory, f"{i}.part"), "wb") for i in range(count)
+    ]
+    _write_records(partitions, last.keys(), last.values())
+    return partitions
+
+
+def _write_records(partitions, hashes, indices):
+    # (hash, line number) records, appended to the partition of each hash
+    records = [[] for _ in partitions]
+    for h, i in zip(hashes, indices):
+        records[h[0] % len(partitions)].append(_RECORD.pack(h, i))
+    for partition, data in zip(partitions, records):
+        partition.write(b"".join(data))
+
+
+def _mark(keep, indices):
+    for i in indices:
+        keep[i >> 3] |= 1 << (i & 7)
+
+
+def _rewrite(path, keep, lines, end):
+    # the kept lines, then anything appended since the file was read, go to a temporary file that
+    # replaces the original
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "wb") as output, open(path, "rb") as file:
+            buffer = []
+            for i, line in enumerate(file):
+                if i >= lines:
+                    break
+                if keep[i >> 3] & (1 << (i & 7)):
+                    buffer.append(line.rstrip())
+                    if len(buffer) >= 4096:
+                        output.write(b"\n".join(buffer) + b"\n")
+                        buffer = []
+            if buffer:
+                output.write(b"\n".join(buffer) + b"\n")
+            file.seek(end)
+            while True:
+                data = file.read(1024 * 1024)
+                if not data:
+                    break
+                output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def incremental(path, memory=DEFAULT_MEMORY * 1024 * 1024, compact=DEFAULT_COMPACT):
+    # only one run at a time - the lock file is never replaced, unlike the file and the index
+    index_path = os.path.join(
+        os.path.dirname(os.path.abspath(path)), f".{os.path.basename(path)}.dedup"
+    )
+    with open(f"{index_path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = sqlite3.connect(index_path)
+        try:
+            _incremental(path, index, memory, compact)
+        finally:
+            index.close()
+
+
+def _incremental(path, index, memory, compact):
+    with index:
+        if index.execute("PRAGMA user_version").fetchone()[0] != _INDEX_VERSION:
+            # an index with an older layout is rebuilt
+            index.execute("DROP TABLE IF EXISTS lines")
+            index.execute("DROP TABLE IF EXISTS state")
+            index.execute(f"PRAGMA user_version = {_INDEX_VERSION}")
+        index.execute(
+            "CREATE TABLE IF NOT EXISTS lines (hash BLOB PRIMARY KEY) WITHOUT ROWID"
+        )
+        index.execute(
+            "CREATE TABLE IF NOT EXISTS state (inode INTEGER, offset INTEGER, lines INTEGER, duplicates INTEGER, fingerprint BLOB)"
+        )
+    state = index.execute(
+        "SELECT inode, offset, lines, duplicates, fingerprint FROM state"
+    ).fetchone()
+    with open(path, "rb") as file:
+        inode = os.fstat(file.fileno()).st_ino
+        if (
+            state is not None
+            and state[0] == inode
+            and _fingerprint(file, state[1]) == state[4]
+        ):
+            with index:
+                # the lines and the new state are committed together
+                offset, lines, duplicates = _index_lines(index, file, *state[1:4])
+                _save_state(index, inode, file, offset, lines, duplicates)
+            if duplicates <= compact * lines:
+                return
+    # a full run, and a new index of its result
+    dedup(path, memory)
+    with index, open(path, "rb") as file:
+        index.execute("DELETE FROM lines")
+        offset, lines, duplicates = _index_lines(index, file, 0, 0, 0)
+        _save_state(
+            index, os.fstat(file.fileno()).st_ino, file, offset, lines, duplicates
+        )
+
+
+def _index_lines(index, file, offset, lines, duplicates):
+    # adds the complete lines from offset to the index, returns the offset after the last one and
+    # the updated line and duplicate counts
+    # a line without a newline may still be being written, it is left for the next run
+    file.seek(offset)
+    cursor = index.cursor()
+    for line in file:
+        if not line.endswith(b"\n"):
+            break
+        cursor.execute(
+            "INSERT OR IGNORE INTO lines VALUES (?)", (line_hash(line.rstrip()),)
+        )
+        if cursor.rowcount == 0:
+            duplicates += 1
+        offset += len(line)
+        lines += 1
+    return offset, lines, duplicates
+
+
+def _save_state(index, inode, file, offset, lines, duplicates):
+    index.execute("DELETE FROM state")
+    index.execute(
+        "INSERT INTO state VALUES (?, ?, ?, ?, ?)",
+        (inode, offset, lines, duplicates, _fingerprint(file, offset)),
+    )
+
+
+def _fingerprint(file, offset):
+    # hash of _SAMPLES blocks spread over the first offset bytes, always including the block just before
+    # offset, None if the file is shorter than offset
+    # an edit that changes the length of that part shifts the bytes after it, which the last block catches
+    last = max(0, offset - _SAMPLE_SIZE)
+    step = max(_SAMPLE_SIZE, offset // _SAMPLES)
+    digest = hashlib.blake2b(digest_size=HASH_SIZE)
+    for start in list(range(0, last, step)) + [last]:
+        size = min(_SAMPLE_SIZE, offset - start)
+        file.seek(start)
+        data = file.read(size)
+        if len(data) < size:
+            return None
+        digest.update(data)
+    return digest.digest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove duplicate lines from a file in place, keeping the last occurrence of each line"
+    )
+    parser.add_argument(
+        "--memory",
+        "-m",
+        type=int,
+        default=DEFAULT_MEMORY,
+        help=f"MiB of memory for the hashes of the distinct lines before they are spilled to disk (default {DEFAULT_MEMORY})",
+    )
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help="Only read the lines appended since the last incremental run, using an index next to the file - duplicates are removed once they are more than --compact of the lines. The index is rebuilt if the file was edited, which is noticed from its length and a sample of its blocks, so run once without --incremental after an edit that keeps the length of the file",
+    )
+    parser.add_argument(
+        "--compact",
+        type=float,
+        default=DEFAULT_COMPACT,
+        help=f"Fraction of duplicate lines an incremental run leaves before it rewrites the file (default {DEFAULT_COMPACT})",
+    )
+    parser.add_argument("file")
+    if len(sys.argv) == 1:
+        parser.print_usage(sys.stderr)
+        exit(1)
+    args = parser.parse_args()
+    if args.incremental:
+        incremental(args.file, args.memory * 1024 * 1024, args.compact)
+    else:
+        dedup(args.file, args.memory * 1024 * 1024)
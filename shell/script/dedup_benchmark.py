@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Times dedup.py on a generated history-like file, in memory and with a memory budget small enough
+# to spill to disk, and checks both give the same result. --legacy also times the original
+# implementation, which holds every line in memory.
+
+_DEDUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dedup.py")
+
+_LEGACY = """
+import sys
+with open(sys.argv[1], "r") as file:
+    seen = set()
+    result = []
+    for line in reversed(list(file)):
+        line = line.rstrip()
+        if line not in seen:
+            seen.add(line)
+            result.append(line)
+with open(sys.argv[1], "w") as file:
+    for line in reversed(result):
+        file.write(line)
+        file.write("\\n")
+"""
+
+
+def generate(path, lines, distinct, seed=0):
+    # half the lines are a few common commands with a long tail, like a shell history, and half
+    # are spread over up to distinct lines
+    rand = random.Random(seed)
+    commands = [
+        "git status",
+        "ls -la",
+        "cd ..",
+        "kubectl get pods -n default",
+        "vi README.md",
+    ]
+    with open(path, "w") as file:
+        batch = []
+        for _ in range(lines):
+            if rand.random() < 0.5:
+                i = min(int(rand.paretovariate(0.5)), distinct) - 1
+            else:
+                i = rand.randrange(distinct)
+            batch.append(f"{commands[i % len(commands)]} # {i}\n")
+            if len(batch) >= 65536:
+                file.writelines(batch)
+                batch = []
+        file.writelines(batch)
+
+
+def run(command):
+    # wall seconds and peak RSS (MiB) of the command
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise Exception(f"{' '.join(command)} failed - status->{status}")
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dedup.py")
+    parser.add_argument(
+        "--lines", type=int, default=10_000_000, help="Lines in the generated file"
+    )
+    parser.add_argument(
+        "--distinct", type=int, default=2_000_000, help="Upper bound of distinct lines"
+    )
+    parser.add_argument(
+        "--spill-memory", type=int, default=32, help="MiB budget of the spilling run"
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also time the original in-memory implementation",
+    )
+    parser.add_argument(
+        "--dir",
+        help="Directory for the generated files (default: system temporary directory)",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        source = os.path.join(directory, "history")
+        start = time.perf_counter()
+        generate(source, args.lines, args.distinct)
+        size = os.path.getsize(source)
+        print(
+            f"generated {args.lines} lines ({size / 1024 / 1024:.0f} MiB) in {time.perf_counter() - start:.1f}s"
+        )
+
+        runs = [
+            ("in memory", [sys.executable, _DEDUP, "--memory", "4096"]),
+            (
+                f"spill {args.spill_memory} MiB",
+                [sys.executable, _DEDUP, "--memory", str(args.spill_memory)],
+            ),
+        ]
+        if args.legacy:
+            runs.append(("legacy", [sys.executable, "-c", _LEGACY]))
+        print(
+            f"{'run':<16}{'seconds':>10}{'lines/s':>12}{'peak MiB':>10}{'output':>18}"
+        )
+        digests = set()
+        for name, command in runs:
+            target = os.path.join(directory, "target")
+            with open(source, "rb") as i, open(target, "wb") as o:
+                while True:
+                    data = i.read(1024 * 1024)
+                    if not data:
+                        break
+                    o.write(data)
+            elapsed, rss = run(command + [target])
+            digests.add(digest(target))
+            print(
+                f"{name:<16}{elapsed:>10.2f}{args.lines / elapsed:>12.0f}{rss:>10.0f}{os.path.getsize(target) / 1024 / 1024:>14.1f} MiB"
+            )
+        if len(digests) != 1:
+            raise Exception("the runs gave different results")
@@ -1,5 +1,11 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+import glob
+import hashlib
+import json
+import os
+import sys
 
 import yaml
 
@@ -14,6 +20,13 @@ class UsageType(Enum):
     CASE = "case"
 
 
+class ParserType(Enum):
+    # getopt runs the external getopt binary in a subshell, bash parses the arguments in a loop without
+    # forking - it accepts the same arguments, except that long options cannot be abbreviated
+    GETOPT = "getopt"
+    BASH = "bash"
+
+
 class Option:
     def __init__(self, d):
         # Parse Inputs
@@ -66,13 +79,15 @@ class Option:
             self.usage = (f"  {self.ustring}", self.description)
         else:
             self.usage = (f"  {self.ustring}", "")
+        self.pattern = self.case
         if self.flag:
             if self.default is True:
-                self.case = f'{self.case}) {self.variable}="false"; shift ;;'
+                self.action = f'{self.variable}="false"; shift ;;'
             else:
-                self.case = f'{self.case}) {self.variable}="true"; shift ;;'
+                self.action = f'{self.variable}="true"; shift ;;'
         else:
-            self.case = f'{self.case}) {self.variable}="$2"; shift 2 ;;'
+            self.action = f'{self.variable}="$2"; shift 2 ;;'
+        self.case = f"{self.pattern}) {self.action}"
 
         del self.ustring
 
@@ -108,39 +123,7 @@ class Positional:
                 self.usage = f" [{self.ustring}]"
 
 
-parser = argparse.ArgumentParser(
-    description="Tool for generating skeleton code for a script or function which uses getopt to parse inputs"
-)
-parser.add_argument(
-    "configuration",
-    help="The configuration file that specifies the inputs, in YAML format",
-)
-args = parser.parse_args()
-
-# getopt parameters
-short_options = []
-long_options = []
-
-# what will go in usage output
-positional_usage = []
-required_option_usage = []
-optional_option_usage = []
-
-# bash variables
-variables = []
-variables_with_no_default = []
-variables_with_defaults = {}
-
-case_statements = []
-validation_statements = []
-
-
-def p(o, indent=0):
-    for line in o.split("\n"):
-        print(" " * (indent * 4) + line)
-
-
-def usage_statement(usage_type):
+def usage_statement(getopt_type, usage_name, usage_type):
     if getopt_type is GetoptType.SCRIPT:
         return "usage"
     if getopt_type is GetoptType.FUNCTION:
@@ -150,87 +133,132 @@ def usage_statement(usage_type):
             return f"{usage_name}; return 1"
 
 
-with open(args.configuration, "r") as cfg_yaml:
-    cfg = yaml.safe_load(cfg_yaml)
+def generate(cfg, parser_type=None):
+    # returns the name of the script or function, its type and its code
+    # parser_type overrides the "parser" of the configuration, which defaults to getopt
+    # getopt parameters
+    short_options = []
+    long_options = []
 
-try:
-    getopt_type = GetoptType(cfg["type"])
-except ValueError:
-    raise Exception(
-        f'"{cfg["type"]}" is not a valid type - valid types are: {" ".join([x.value for x in GetoptType])}'
-    )
+    # what will go in usage output
+    positional_usage = []
+    required_option_usage = []
+    optional_option_usage = []
 
-name = cfg["name"]
-if getopt_type is GetoptType.SCRIPT and not name.endswith(".sh"):
-    name += ".sh"
-
-try:
-    description = cfg["description"]
-except KeyError:
-    description = "This is a placeholder description"
-
-# usage function name
-if getopt_type is GetoptType.FUNCTION:
-    usage_name = f"_{name}_usage"
-    main_name = f"{name}"
-if getopt_type is GetoptType.SCRIPT:
-    usage_name = "usage"
-    main_name = "main"
-
-positional_usage_string = ""
-positional = None
-if "positional" in cfg:
-    positional = Positional(cfg["positional"])
-    positional_usage_string = positional.usage
-    positional_usage.append(("  " + positional.long.upper(), positional.description))
-    if positional.required:
-        if positional.multiple:
-            validation_statements.append(
-                f'[[ -z "$1" ]] && {usage_statement(UsageType.STANDARD)}'
-            )
-        else:
-            validation_statements.append(
-                f"[[ -z ${positional.variable} ]] && {usage_statement(UsageType.STANDARD)}"
-            )
+    # bash variables
+    variables = []
+    variables_with_no_default = []
+    variables_with_defaults = {}
+
+    case_statements = []
+    validation_statements = []
 
+    # for the bash parser
+    short_value_options = []
+    long_flags = ["help"]
 
-# TODO use case for no options?
-for o in cfg["options"]:
-    opt = Option(o)
-    variables.append(opt.variable)
+    try:
+        getopt_type = GetoptType(cfg["type"])
+    except ValueError:
+        raise Exception(
+            f'"{cfg["type"]}" is not a valid type - valid types are: {" ".join([x.value for x in GetoptType])}'
+        )
 
-    if opt.short:
-        short_options.append(opt.getopt_short)
+    if parser_type is None:
+        try:
+            parser_type = ParserType(cfg.get("parser", ParserType.GETOPT.value))
+        except ValueError:
+            raise Exception(
+                f'"{cfg["parser"]}" is not a valid parser - valid parsers are: {" ".join([x.value for x in ParserType])}'
+            )
 
-    case_statements.append(opt.case)
-    long_options.append(opt.getopt_long)
+    name = cfg["name"]
+    if getopt_type is GetoptType.SCRIPT and not name.endswith(".sh"):
+        name += ".sh"
 
-    if opt.required:
-        validation_statements.append(
-            f"[[ -z ${opt.variable} ]] && {usage_statement(UsageType.STANDARD)}"
+    try:
+        description = cfg["description"]
+    except KeyError:
+        description = "This is a placeholder description"
+
+    # usage function name
+    if getopt_type is GetoptType.FUNCTION:
+        usage_name = f"_{name}_usage"
+        main_name = f"{name}"
+    if getopt_type is GetoptType.SCRIPT:
+        usage_name = "usage"
+        main_name = "main"
+
+    def usage(usage_type):
+        return usage_statement(getopt_type, usage_name, usage_type)
+
+    positional_usage_string = ""
+    positional = None
+    if "positional" in cfg:
+        positional = Positional(cfg["positional"])
+        positional_usage_string = positional.usage
+        positional_usage.append(
+            ("  " + positional.long.upper(), positional.description)
         )
-        required_option_usage.append(opt.usage)
-    else:
-        optional_option_usage.append(opt.usage)
+        if positional.required:
+            if positional.multiple:
+                validation_statements.append(
+                    f'[[ -z "$1" ]] && {usage(UsageType.STANDARD)}'
+                )
+            else:
+                validation_statements.append(
+                    f"[[ -z ${positional.variable} ]] && {usage(UsageType.STANDARD)}"
+                )
+
+    # TODO use case for no options?
+    for o in cfg["options"]:
+        opt = Option(o)
+        variables.append(opt.variable)
+
+        if opt.short:
+            short_options.append(opt.getopt_short)
+
+        long_options.append(opt.getopt_long)
+        if parser_type is ParserType.BASH and not opt.flag:
+            # getopt makes sure the value is there
+            case_statements.append(
+                f"{opt.pattern}) (( $# > 1 )) || {usage(UsageType.STANDARD)}; {opt.action}"
+            )
+            if opt.short:
+                short_value_options.append(opt.short)
+        else:
+            case_statements.append(opt.case)
+            if opt.flag:
+                long_flags.append(opt.getopt_long)
+
+        if opt.required:
+            validation_statements.append(
+                f"[[ -z ${opt.variable} ]] && {usage(UsageType.STANDARD)}"
+            )
+            required_option_usage.append(opt.usage)
+        else:
+            optional_option_usage.append(opt.usage)
 
-    if opt.default is not None:
-        if type(opt.default) is bool:
-            variables_with_defaults[opt.variable] = str(opt.default).lower()
+        if opt.default is not None:
+            if type(opt.default) is bool:
+                variables_with_defaults[opt.variable] = str(opt.default).lower()
+            else:
+                variables_with_defaults[opt.variable] = opt.default
         else:
-            variables_with_defaults[opt.variable] = opt.default
-    else:
-        variables_with_no_default.append(opt.variable)
-
-# max option length for usage text
-mx = 0
-for u in required_option_usage + optional_option_usage + positional_usage:
-    mx = max(len(u[0]), mx)
-mx += 3
-
-# print it
-newline = "\n"
-print(
-    f"""{usage_name}() {{
+            variables_with_no_default.append(opt.variable)
+
+    # max option length for usage text
+    mx = 0
+    for u in required_option_usage + optional_option_usage + positional_usage:
+        mx = max(len(u[0]), mx)
+    mx += 3
+
+    # build it
+    lines = []
+    out = lines.append
+    newline = "\n"
+    out(
+        f"""{usage_name}() {{
     echo "usage: {name} [OPTIONS]{positional_usage_string}
 
 {newline.join([f'{u[0].ljust(mx)}{u[1]}' for u in sorted(positional_usage) + sorted(required_option_usage) + sorted(optional_option_usage)])}
@@ -242,61 +270,284 @@ Examples:
 
 See Also:
     reference" >&2"""
-)
-if getopt_type is GetoptType.SCRIPT:
-    print("    exit 1")
-print("}\n")
-
+    )
+    if getopt_type is GetoptType.SCRIPT:
+        out("    exit 1")
+    out("}\n")
 
-print(
-    f'''{main_name}()  {{
-    # Input Parsing
-    local opts
+    out(
+        f"""{main_name}()  {{
+    # Input Parsing"""
+    )
+    if parser_type is ParserType.GETOPT:
+        out(
+            f'''    local opts
     opts=$(getopt --options "{"".join(sorted(short_options))}" --longoptions "{",".join(sorted(long_options) + ["help"])}" -- "$@")
-    [[ $? != "0" ]] && {usage_statement(UsageType.STANDARD)}
+    [[ $? != "0" ]] && {usage(UsageType.STANDARD)}
     eval set -- "$opts"'''
-)
-if len(variables_with_no_default) > 0:
-    print(f'    local {" ".join(sorted(variables_with_no_default))}')
-if len(variables_with_defaults) > 0:
-    for v in sorted(variables_with_defaults.keys()):
-        print(f'    local {v}="{variables_with_defaults[v]}"')
-print(
-    """    while :; do
+        )
+    else:
+        # arguments that are not options are collected in _args, options can come after them like with getopt
+        out("    local _args=()")
+    if len(variables_with_no_default) > 0:
+        out(f'    local {" ".join(sorted(variables_with_no_default))}')
+    if len(variables_with_defaults) > 0:
+        for v in sorted(variables_with_defaults.keys()):
+            out(f'    local {v}="{variables_with_defaults[v]}"')
+    if parser_type is ParserType.GETOPT:
+        out(
+            """    while :; do
         case "$1" in"""
-)
-for c in sorted(case_statements):
-    print(f"            {c}")
-print(
-    f"""            --help) {usage_statement(UsageType.CASE)} ;;
+        )
+    else:
+        out(
+            """    while (( $# > 0 )); do
+        case "$1" in"""
+        )
+    for c in sorted(case_statements):
+        out(f"            {c}")
+    if parser_type is ParserType.GETOPT:
+        out(
+            f"""            --help) {usage(UsageType.CASE)} ;;
             --) shift; break ;;
-            *) {usage_statement(UsageType.CASE)} ;;
+            *) {usage(UsageType.CASE)} ;;
         esac
     done"""
-)
-if positional and not positional.multiple:
-    print(f'    local {positional.variable}="$1"')
+        )
+    else:
+        # --option=value and -ovalue are split into two arguments, and -abc into -a -bc, then parsed again
+        out(
+            f"""            --help) {usage(UsageType.CASE)} ;;
+            --) shift; _args+=("$@"); break ;;
+            {"|".join(f"--{f}=*" for f in sorted(long_flags))}) {usage(UsageType.CASE)} ;;
+            --?*=*) set -- "${{1%%=*}}" "${{1#*=}}" "${{@:2}}" ;;"""
+        )
+        if short_value_options:
+            out(
+                f"""            -[{"".join(sorted(short_value_options))}]?*) set -- "${{1:0:2}}" "${{1:2}}" "${{@:2}}" ;;"""
+            )
+        if short_options:
+            out("""            -[!-]?*) set -- "${1:0:2}" "-${1:2}" "${@:2}" ;;""")
+        out(
+            f'''            -?*) {usage(UsageType.CASE)} ;;
+            *) _args+=("$1"); shift ;;
+        esac
+    done
+    set -- "${{_args[@]}}"'''
+        )
+    if positional and not positional.multiple:
+        out(f'    local {positional.variable}="$1"')
 
-print(
-    """
+    out(
+        """
     # Input Validation"""
-)
-for v in sorted(validation_statements):
-    print(f"    {v}")
-print("\n    # Function")
-if positional and positional.multiple:
-    print(
-        f"""    local {positional.variable}
+    )
+    for v in sorted(validation_statements):
+        out(f"    {v}")
+    out("\n    # Function")
+    if positional and positional.multiple:
+        out(
+            f"""    local {positional.variable}
     for {positional.variable} in "$@"; do
         implement_me
     done
 }}"""
-    )
-else:
-    print(
-        """    implement_me
+        )
+    else:
+        out(
+            """    implement_me
 }"""
-    )
+        )
 
-if getopt_type is GetoptType.SCRIPT:
-    print('main "$@"')
+    if getopt_type is GetoptType.SCRIPT:
+        out('main "$@"')
+    return name, getopt_type, "\n".join(lines) + "\n"
+
+
+# Batch mode: every configuration in a directory or glob is generated in one process, and written to
+# --output-dir as <name>.sh. A manifest in the output directory records a hash of each configuration
+# (and of this script), so configurations that did not change since their file was written are skipped.
+
+MANIFEST = ".generate_getopt.json"
+# configurations generated per task when running in parallel
+_BATCH_SIZE = 16
+
+
+def find_configurations(paths):
+    # expands directories and globs (also when the shell did not) to configuration files
+    configurations = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, "*.yaml")) + glob.glob(
+                os.path.join(path, "*.yml")
+            )
+        elif glob.has_magic(path):
+            matches = glob.glob(path)
+        else:
+            matches = [path]
+        configurations.extend(sorted(matches))
+    return configurations
+
+
+def _generator_hash():
+    # outputs have to be regenerated when the generator changes
+    with open(os.path.abspath(__file__), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _generate_batch(batch, parser_type=None):
+    # generates each (path, content) of the batch, returns (path, output file, type, code, error) for each
+    results = []
+    for path, content in batch:
+        try:
+            name, getopt_type, code = generate(yaml.safe_load(content), parser_type)
+            if not name.endswith(".sh"):
+                name += ".sh"
+            results.append((path, name, getopt_type, code, None))
+        except Exception as e:
+            results.append((path, None, None, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def batch(configurations, output_dir, workers=1, force=False, parser_type=None):
+    # returns the number of configurations generated, skipped and failed
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    # entries of configurations that were renamed, deleted or are not part of this run are dropped, they
+    # would keep their output name taken
+    keys = {os.path.abspath(path) for path in configurations}
+    manifest = {
+        path: entry
+        for path, entry in manifest.items()
+        if path in keys and os.path.exists(path)
+    }
+    generator = _generator_hash()
+    if parser_type is not None:
+        generator += parser_type.value
+
+    pending = []
+    hashes = {}
+    skipped = 0
+    for path in configurations:
+        with open(path, "rb") as file:
+            content = file.read()
+        key = os.path.abspath(path)
+        hashes[key] = hashlib.sha256(generator.encode() + content).hexdigest()
+        entry = manifest.get(key)
+        if (
+            entry
+            and entry["hash"] == hashes[key]
+            and os.path.exists(os.path.join(output_dir, entry["output"]))
+        ):
+            skipped += 1
+            continue
+        pending.append((key, content))
+
+    batches = [
+        pending[i : i + _BATCH_SIZE] for i in range(0, len(pending), _BATCH_SIZE)
+    ]
+    results = []
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(
+                _generate_batch, batches, [parser_type] * len(batches)
+            ):
+                results.extend(result)
+    else:
+        for b in batches:
+            results.extend(_generate_batch(b, parser_type))
+
+    generated = 0
+    failed = 0
+    pending_paths = {path for path, _ in pending}
+    outputs = {
+        entry["output"]: path
+        for path, entry in manifest.items()
+        if path not in pending_paths
+    }
+    for path, output, getopt_type, code, error in results:
+        if error is None and outputs.get(output, path) != path:
+            error = f'"{output}" is also generated from {outputs[output]}'
+        if error is not None:
+            print(f"{path}: {error}", file=sys.stderr)
+            manifest.pop(path, None)
+            failed += 1
+            continue
+        with open(os.path.join(output_dir, output), "w") as file:
+            file.write(code)
+        if getopt_type is GetoptType.SCRIPT:
+            os.chmod(os.path.join(output_dir, output), 0o755)
+        outputs[output] = path
+        manifest[path] = {"hash": hashes[path], "output": output}
+        generated += 1
+
+    # written to a temporary file first, an interrupted run must not leave a manifest that skips
+    # configurations whose output was not written
+    tmp = f"{manifest_path}.tmp"
+    with open(tmp, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_path)
+    return generated, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tool for generating skeleton code for a script or function which uses getopt to parse inputs"
+    )
+    parser.add_argument(
+        "configuration",
+        nargs="+",
+        help="The configuration file that specifies the inputs, in YAML format - several files, a directory or a glob generate every configuration into --output-dir",
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        help="Directory the generated <name>.sh files are written to (default: the current directory when generating several configurations, otherwise the code is printed)",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of processes generating configurations in batch mode",
+    )
+    parser.add_argument(
+        "--parser",
+        "-p",
+        type=ParserType,
+        help=f'How the generated code parses its arguments, overriding the "parser" of the configurations - getopt (the default) forks a subshell for getopt on every call, bash parses them without forking, but long options cannot be abbreviated - valid values: {" ".join([x.value for x in ParserType])}',
+    )
+    parser.add_argument(
+        "--force",
+        "-f",
+        action="store_true",
+        help="Regenerate every configuration, ignoring the manifest of the output directory",
+    )
+    args = parser.parse_args()
+
+    configurations = find_configurations(args.configuration)
+    if (
+        args.output_dir is None
+        and len(args.configuration) == 1
+        and configurations == args.configuration
+    ):
+        with open(args.configuration[0], "r") as cfg_yaml:
+            print(generate(yaml.safe_load(cfg_yaml), args.parser)[2], end="")
+    else:
+        generated, skipped, failed = batch(
+            configurations,
+            args.output_dir or ".",
+            args.workers,
+            args.force,
+            args.parser,
+        )
+        print(
+            f"{generated} generated, {skipped} unchanged, {failed} failed",
+            file=sys.stderr,
+        )
+        if failed > 0:
+            exit(1)
@@ -251,7 +251,143 @@ input = 'testinput'
 input = 'testinput2'"
 testf_pass "$expected" ./tmp.sh --thing testthing --widget testwidget testinput testinput2
 
-rm tmp.sh
+# the bash parser has to accept and reject the same arguments as getopt
+run_parsed() {
+    local file="$1"
+    local type="$2"
+    shift 2
+    if [[ $type == "function" ]]; then
+        (source "$file"; "$(sed -n 's/^name: *//p' "$config")" "$@")
+    else
+        bash "$file" "$@"
+    fi
+}
+
+compare_parsers() {
+    test_count=$((test_count + 1))
+    local args expected actual
+    eval "args=($1)"
+    expected="$(run_parsed tmp_getopt.sh "$type" "${args[@]}" 2>/dev/null; echo "rc=$?")"
+    actual="$(run_parsed tmp_bash.sh "$type" "${args[@]}" 2>/dev/null; echo "rc=$?")"
+    [[ $actual != "$expected" ]] && fail "bash parser output did not match getopt
+bash:
+$actual
+
+getopt:
+$expected
+" "$config" "${args[@]}"
+}
+
+cases=(
+    ""
+    "-w testwidget"
+    "--thing testthing --widget testwidget testinput"
+    "--example-flag -w testwidget testinput"
+    "-z -t testthing -w testwidget testinput"
+    "-f --no-other-flag --thing testthing --widget testwidget testinput"
+    "-f -z --thing testthing --widget testwidget testinput testinput2"
+    "-fz -ttestthing -wtestwidget testinput"
+    "-fzttestthing -w testwidget testinput"
+    "--thing=testthing --widget=testwidget testinput"
+    "--thing=a=b --widget= testinput"
+    "--thing '' -w 'test widget' 'test input'"
+    "testinput -w testwidget testinput2 -f"
+    "-w testwidget -- -f --thing"
+    "-w testwidget --thing -f testinput"
+    "-w testwidget - testinput"
+    "-w testwidget -t"
+    "-w testwidget --thing"
+    "-w testwidget --example-flag=true testinput"
+    "-w testwidget --no-other-flag= testinput"
+    "-w testwidget --bogus testinput"
+    "-w testwidget --bogus=value testinput"
+    "-w testwidget -x testinput"
+    "-w testwidget -fx testinput"
+    "--help"
+    "-w testwidget testinput --help"
+)
+
+for config in ./function.yaml ./function2.yaml ./script.yaml ./script2.yaml; do
+    type="$(sed -n 's/^type: *//p' "$config")"
+    for parser in getopt bash; do
+        python ../generate_getopt.py --parser "$parser" "$config" > "tmp_$parser.sh"
+        sed -i '/# Function/a \
+    echo "example_flag=$example_flag other_flag=$other_flag thing=$thing widget=$widget input=$input args=$(printf "<%s>" "$@")"' "tmp_$parser.sh"
+        sed -i 's/implement_me/:/' "tmp_$parser.sh"
+    done
+    for c in "${cases[@]}"; do
+        compare_parsers "$c"
+    done
+done
+
+# the bash parser must not leave variables behind either
+python ../generate_getopt.py --parser bash ./function.yaml > tmp.sh
+sed -i '/implement_me/a \
+    echo "thing = '\''$thing'\''"' tmp.sh
+sed -i '/implement_me/d' tmp.sh
+source tmp.sh
+testf_pass "thing = 'testthing'" example_function -fz -ttestthing --widget=testwidget testinput
+
+# batch mode only regenerates configurations that changed, and forgets configurations that are gone
+testf_batch() {
+    test_count=$((test_count + 1))
+    local expected="$1"
+    shift
+    local actual
+    actual="$(python ../generate_getopt.py -o tmp_batch/out "$@" 2>&1 >/dev/null | tail -1; echo "rc=${PIPESTATUS[0]}")"
+    [[ $actual != "$expected" ]] && fail "batch run did not report the expected counts
+actual:
+$actual
+
+expected:
+$expected
+" "$@"
+}
+
+mkdir -p tmp_batch/config
+cp function.yaml function2.yaml script.yaml tmp_batch/config
+testf_batch "3 generated, 0 unchanged, 0 failed
+rc=0" tmp_batch/config
+diff <(python ../generate_getopt.py function.yaml) tmp_batch/out/example_function.sh >/dev/null || fail "batch output did not match the single configuration output" tmp_batch/config
+testf_batch "0 generated, 3 unchanged, 0 failed
+rc=0" tmp_batch/config
+echo "# changed" >> tmp_batch/config/script.yaml
+testf_batch "1 generated, 2 unchanged, 0 failed
+rc=0" tmp_batch/config
+rm tmp_batch/out/example_function2.sh
+testf_batch "1 generated, 2 unchanged, 0 failed
+rc=0" tmp_batch/config
+mv tmp_batch/config/function.yaml tmp_batch/config/renamed.yaml
+testf_batch "1 generated, 2 unchanged, 0 failed
+rc=0" tmp_batch/config
+grep -q '/function.yaml"' tmp_batch/out/.generate_getopt.json && fail "manifest kept a configuration that was renamed" tmp_batch/config
+cp tmp_batch/config/renamed.yaml tmp_batch/config/copy.yaml
+testf_batch "0 generated, 3 unchanged, 1 failed
+rc=1" tmp_batch/config
+rm tmp_batch/config/copy.yaml
+testf_batch "3 generated, 0 unchanged, 0 failed
+rc=0" --force tmp_batch/config
+testf_batch "0 generated, 2 unchanged, 0 failed
+rc=0" tmp_batch/config/function2.yaml tmp_batch/config/script.yaml
+testf_batch "1 generated, 2 unchanged, 0 failed
+rc=0" tmp_batch/config
+
+# time both parsers, the getopt parser forks for every call
+calls=1000
+for parser in getopt bash; do
+    python ../generate_getopt.py --parser "$parser" ./function.yaml > tmp.sh
+    sed -i 's/implement_me/:/' tmp.sh
+    source tmp.sh
+    start=$EPOCHREALTIME
+    for ((i = 0; i < calls; i++)); do
+        example_function -f --thing testthing -w testwidget testinput
+    done
+    end=$EPOCHREALTIME
+    echo "$parser parser: $(( (${end/./} - ${start/./}) / calls )) us per call"
+done
+
+rm tmp.sh tmp_getopt.sh tmp_bash.sh
+rm -r tmp_batch
 rm -r test-venv
 
 (( rcode > 0 )) && echo "$rcode/$test_count test cases failed" >&2
@@ -0,0 +1,187 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dedup
+
+LINES = [f"command {i % 50} --flag {i}\n" for i in range(2000)]
+
+
+def _write(path, lines, mode="w"):
+    with open(path, mode) as file:
+        file.write("".join(lines))
+
+
+def _read(path):
+    with open(path) as file:
+        return file.readlines()
+
+
+def _last_occurrences(lines):
+    # the lines dedup keeps, in order
+    seen = set()
+    result = []
+    for line in reversed(lines):
+        line = line.rstrip() + "\n"
+        if line not in seen:
+            seen.add(line)
+            result.append(line)
+    return result[::-1]
+
+
+def _legacy(path):
+    # the original implementation, which holds every line in memory
+    with open(path, "r") as file:
+        seen = set()
+        result = []
+        for line in reversed(list(file)):
+            line = line.rstrip()
+            if line not in seen:
+                seen.add(line)
+                result.append(line)
+
+    with open(path, "w") as file:
+        for line in reversed(result):
+            file.write(line)
+            file.write("\n")
+
+
+def _state(path):
+    # (offset, lines, duplicates) of the index next to the file
+    index = sqlite3.connect(
+        os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.dedup")
+    )
+    try:
+        return index.execute("SELECT offset, lines, duplicates FROM state").fetchone()
+    finally:
+        index.close()
+
+
+@pytest.fixture
+def history(tmp_path):
+    # deduplicated by a first run, which builds the index
+    path = str(tmp_path / "history")
+    _write(path, LINES[:500] + LINES[:100])
+    dedup.incremental(path)
+    assert _read(path) == _last_occurrences(LINES[:500] + LINES[:100])
+    assert _state(path) == (os.path.getsize(path), 500, 0)
+    return path
+
+
+def test_appended_lines_are_indexed(history):
+    before = _read(history)
+    _write(history, LINES[500:600], "a")
+    inode = os.stat(history).st_ino
+    dedup.incremental(history)
+    # nothing to remove, so the file is not rewritten
+    assert os.stat(history).st_ino == inode
+    assert _read(history) == before + LINES[500:600]
+    assert _state(history) == (os.path.getsize(history), 600, 0)
+
+
+def test_appended_duplicates_are_counted(history):
+    before = _read(history)
+    _write(history, LINES[:30], "a")
+    dedup.incremental(history)
+    # 30 duplicates of 530 lines is below --compact
+    assert _read(history) == before + LINES[:30]
+    assert _state(history) == (os.path.getsize(history), 530, 30)
+
+
+def test_duplicates_are_compacted(history):
+    lines = _read(history) + LINES[:30]
+    _write(history, LINES[:30], "a")
+    dedup.incremental(history)
+    _write(history, LINES[30:60] + LINES[600:610], "a")
+    lines += LINES[30:60] + LINES[600:610]
+    dedup.incremental(history)
+    # 60 duplicates of 570 lines
+    assert _read(history) == _last_occurrences(lines)
+    assert _state(history) == (os.path.getsize(history), 510, 0)
+
+
+def test_partial_last_line_is_left_for_next_run(history):
+    _write(history, LINES[500:510] + [LINES[510][:5]], "a")
+    dedup.incremental(history)
+    assert _state(history)[1:] == (510, 0)
+    _write(history, [LINES[510][5:]], "a")
+    dedup.incremental(history)
+    assert _read(history)[-1] == LINES[510]
+    assert _state(history) == (os.path.getsize(history), 511, 0)
+
+
+def test_truncated_file_is_rebuilt(history):
+    inode = os.stat(history).st_ino
+    with open(history, "r+") as file:
+        file.truncate(0)
+        file.write("".join(LINES[1000:1010] + LINES[1000:1005]))
+    assert os.stat(history).st_ino == inode
+    dedup.incremental(history)
+    assert _read(history) == _last_occurrences(LINES[1000:1010] + LINES[1000:1005])
+    assert _state(history) == (os.path.getsize(history), 10, 0)
+
+
+def test_replaced_file_is_rebuilt(history):
+    replacement = f"{history}.new"
+    _write(replacement, LINES[:500] + LINES[:100] + LINES[500:520])
+    os.replace(replacement, history)
+    dedup.incremental(history)
+    assert _read(history) == _last_occurrences(
+        LINES[:500] + LINES[:100] + LINES[500:520]
+    )
+    assert _state(history) == (os.path.getsize(history), 520, 0)
+
+
+@pytest.mark.parametrize("line", [0, 250, 499])
+def test_edited_file_is_rebuilt(history, line):
+    # the line is overwritten with another line of the same length, so the file keeps
+    # its length and has a duplicate that only a full run removes - at the start, in
+    # the middle and at the end
+    lines = _read(history)
+    other = next(
+        candidate
+        for candidate in lines[::-1]
+        if len(candidate) == len(lines[line]) and candidate != lines[line]
+    )
+    with open(history, "r+") as file:
+        file.seek(len("".join(lines[:line])))
+        file.write(other)
+    lines[line] = other
+    _write(history, LINES[:1], "a")
+    dedup.incremental(history)
+    assert _read(history) == _last_occurrences(lines + LINES[:1])
+
+
+@pytest.mark.parametrize(
+    "memory, read_size",
+    [
+        # in memory, in one read and in many
+        (dedup.DEFAULT_MEMORY * 1024 * 1024, dedup._READ_SIZE),
+        (dedup.DEFAULT_MEMORY * 1024 * 1024, 256),
+        # spilled after the first read, and part way through the file
+        (1, 256),
+        (4096, 256),
+    ],
+)
+def test_matches_legacy(tmp_path, monkeypatch, memory, read_size):
+    monkeypatch.setattr(dedup, "_READ_SIZE", read_size)
+    rng = random.Random(memory + read_size)
+    # trailing whitespace, blank lines and a last line without a newline
+    lines = [
+        rng.choice(LINES[:300]).rstrip() + rng.choice(["", " ", "\t", "  "]) + "\n"
+        for _ in range(3000)
+    ]
+    lines += ["\n", "  \n"]
+    rng.shuffle(lines)
+    lines.append(LINES[0].rstrip())
+    expected = str(tmp_path / "expected")
+    path = str(tmp_path / "history")
+    _write(expected, lines)
+    _write(path, lines)
+    _legacy(expected)
+    dedup.dedup(path, memory)
+    assert _read(path) == _read(expected)